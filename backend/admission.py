@@ -0,0 +1,123 @@
+# GuardCloud Upload Admission
+# Turns away uploads that can't be stored before their body is read
+#
+# FastAPI only runs the upload endpoint once the whole multipart body has
+# been received, so its quota check comes after the bytes went through. This
+# middleware looks at the headers first: the token, Content-Length and the
+# optional X-Upload-Size (exact file size) are checked against the user's
+# remaining storage and MAX_UPLOAD_SIZE, and the request is answered without
+# reading the body if it can't fit. Clients sending Expect: 100-continue get
+# the error instead of the 100, since the server only sends that once the
+# app starts reading. Bodies without a length are counted as they arrive and
+# cut off once they pass the limit.
+
+import json
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+
+from database import get_storage_used
+from security import decode_jwt_token
+import revocation
+
+# Room in Content-Length for multipart boundaries, part headers and the
+# other form fields next to the file
+FORM_OVERHEAD = 64 * 1024
+
+
+class UploadTooLarge(Exception):
+    """The body grew past what the upload is allowed to be."""
+
+
+class UploadAdmission:
+    """ASGI middleware checking uploads to `paths` before their body is read."""
+
+    def __init__(self, app, paths, storage_limit, max_upload_size=0):
+        self.app = app
+        self.paths = set(paths)
+        self.storage_limit = storage_limit
+        self.max_upload_size = max_upload_size
+
+    def _admit(self, authorization):
+        """Get the largest file the user may upload now, or None if not logged in."""
+        if not authorization or not authorization.startswith("Bearer "):
+            return None
+        claims = decode_jwt_token(authorization.split(" ", 1)[1])
+        if not claims or revocation.is_revoked(claims):
+            return None
+        limit = self.storage_limit - get_storage_used(claims["sub"])
+        if self.max_upload_size:
+            limit = min(limit, self.max_upload_size)
+        return limit
+
+    def _too_large_detail(self, limit):
+        if self.max_upload_size and limit >= self.max_upload_size:
+            return "File exceeds the maximum upload size"
+        return "Storage limit exceeded"
+
+    async def _reject(self, send, status, detail):
+        body = json.dumps({"detail": detail}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                # The client may still be sending, don't wait for the rest
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        limit = await run_in_threadpool(self._admit, headers.get("authorization"))
+        if limit is None:
+            await self._reject(send, 401, "Invalid or expired token")
+            return
+
+        try:
+            declared = int(headers.get("x-upload-size", 0))
+            content_length = int(headers.get("content-length", 0))
+        except ValueError:
+            await self._reject(send, 400, "Invalid Content-Length or X-Upload-Size")
+            return
+        if declared > limit or content_length > limit + FORM_OVERHEAD:
+            await self._reject(send, 413, self._too_large_detail(limit))
+            return
+
+        # Content-Length can't be exceeded, but a chunked body has none
+        body_limit = limit + FORM_OVERHEAD
+        received = 0
+        too_large = False
+        rejected = False
+
+        async def receive_limited():
+            nonlocal received, too_large
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > body_limit:
+                    too_large = True
+                    raise UploadTooLarge()
+            return message
+
+        async def send_checked(message):
+            nonlocal rejected
+            # The form parser turns our exception into a 400, answer 413 instead
+            if too_large:
+                if not rejected:
+                    rejected = True
+                    await self._reject(send, 413, self._too_large_detail(limit))
+                return
+            await send(message)
+
+        try:
+            await self.app(scope, receive_limited, send_checked)
+        except UploadTooLarge:
+            if not rejected:
+                await self._reject(send, 413, self._too_large_detail(limit))
@@ -0,0 +1,480 @@
+# GuardCloud Backup
+# Online backups of the encrypted database and the blob store, taken while
+# the server keeps running
+#
+#   cd backend
+#   python backup.py create /mnt/backups/guardcloud
+#   python backup.py verify /mnt/backups/guardcloud
+#   python backup.py restore /mnt/backups/guardcloud --db-file restored.db --storage-root restored
+#   python backup.py prune /mnt/backups/guardcloud --keep 14
+#
+# The database is copied with SQLite's online backup API, a few pages per
+# step with a pause in between, so live requests keep getting the write
+# lock. The copy stays encrypted with SQLCIPHER_KEY and is useless without it.
+# With DB_SHARDS every shard is copied the same way, one after the other, so
+# don't move users between shards while a backup runs.
+#
+# Blobs are stored once by content hash under blobs/, and each snapshot gets
+# a manifest of the blobs its database copy refers to. A blob whose size and
+# mtime match the previous manifest is taken from it without reading the
+# file again, so a snapshot only copies what changed since the last one.
+# Uploads that weren't encrypted by the browser are kept as they are on
+# disk, so the backup directory needs the same protection as STORAGE_ROOT.
+#
+#   <backup dir>/blobs/ab/abcdef...            blob contents by sha256
+#   <backup dir>/snapshots/<time>/guardcloud.db
+#   <backup dir>/snapshots/<time>/guardcloud.shardN.db   with DB_SHARDS
+#   <backup dir>/snapshots/<time>/manifest.json written last, marks it complete
+
+from datetime import datetime, timezone
+from pathlib import Path
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+import config
+from sqlcipher3 import dbapi2 as sqlite3
+from database import check_schema, open_connection, db_file, all_shards, shard_file
+
+STORAGE_ROOT = Path(os.getenv("STORAGE_ROOT", "storage"))
+
+# Pages copied per backup step and the pause between steps
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_SLEEP = float(os.getenv("BACKUP_STEP_SLEEP", "0.05"))
+
+# Blob copy rate limit in MB/s, 0 for none
+BACKUP_MAX_MB_S = float(os.getenv("BACKUP_MAX_MB_S", "0"))
+
+# A write from another connection restarts a paged backup. After this many
+# restarts the rest is copied in one step, which can't be interrupted.
+MAX_RESTARTS = 5
+
+DB_NAME = "guardcloud.db"
+MANIFEST_NAME = "manifest.json"
+CHUNK_SIZE = 1024 * 1024
+
+
+class BackupRestarted(Exception):
+    """The paged backup started over too many times."""
+
+
+class Throttle:
+    """Sleeps just enough to keep copying under max_mb_s."""
+
+    def __init__(self, max_mb_s):
+        self.rate = max_mb_s * 1024 * 1024
+        self.started = time.monotonic()
+        self.copied = 0
+
+    def __call__(self, size):
+        if not self.rate:
+            return
+        self.copied += size
+        ahead = self.copied / self.rate - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def open_database(path):
+    """Open a SQLCipher database other than DB_FILE with SQLCIPHER_KEY."""
+    key = os.getenv("SQLCIPHER_KEY")
+    if not key:
+        raise RuntimeError("Missing SQLCIPHER_KEY environment variable")
+    conn = sqlite3.connect(str(path))
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA key = '{key}';")
+    return conn
+
+
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def copy_hashed(source, dest, throttle=None):
+    """Copy source to dest through a temp file. Returns the sha256 of what was copied."""
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.with_name(f"{dest.name}.{os.getpid()}.tmp")
+    hasher = hashlib.sha256()
+    with open(source, "rb") as src, open(tmp, "wb") as out:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+            hasher.update(chunk)
+            out.write(chunk)
+            if throttle:
+                throttle(len(chunk))
+    os.replace(tmp, dest)
+    return hasher.hexdigest()
+
+
+def blob_path(backup_dir, sha256):
+    return Path(backup_dir, "blobs", sha256[:2], sha256)
+
+
+def snapshots(backup_dir):
+    """Names of the complete snapshots, oldest first."""
+    root = Path(backup_dir, "snapshots")
+    if not root.is_dir():
+        return []
+    return sorted(p.name for p in root.iterdir() if (p / MANIFEST_NAME).is_file())
+
+
+def load_manifest(backup_dir, snapshot=None):
+    """Read a snapshot's manifest, the latest one by default."""
+    names = snapshots(backup_dir)
+    if snapshot is None:
+        if not names:
+            raise ValueError(f"No snapshots in {backup_dir}")
+        snapshot = names[-1]
+    elif snapshot not in names:
+        raise ValueError(f"Snapshot {snapshot} not found in {backup_dir}")
+    return json.loads(Path(backup_dir, "snapshots", snapshot, MANIFEST_NAME).read_text())
+
+
+def referenced_blobs(conn):
+    """Every stored_path a database refers to."""
+    rows = conn.execute("SELECT stored_path FROM files UNION SELECT stored_path FROM share_copies").fetchall()
+    return sorted(row[0] for row in rows)
+
+
+# ============== Backup ==============
+
+def backup_database(dest, pages=None, sleep=None, progress=print, shard=0):
+    """Copy DB_FILE (or a shard) to dest with the online backup API. Returns the number of pages."""
+    pages = pages or BACKUP_PAGES_PER_STEP
+    sleep = BACKUP_STEP_SLEEP if sleep is None else sleep
+    source = open_connection(read_only=True, path=shard_file(shard))
+    target = open_database(dest)
+    last = {"remaining": None, "restarts": 0, "total": 0}
+
+    def on_step(status, remaining, total):
+        if last["remaining"] is not None and remaining > last["remaining"]:
+            last["restarts"] += 1
+            if last["restarts"] > MAX_RESTARTS:
+                raise BackupRestarted()
+        last["remaining"] = remaining
+        last["total"] = total
+
+    try:
+        try:
+            source.backup(target, pages=pages, progress=on_step, sleep=sleep)
+        except BackupRestarted:
+            progress(f"database: restarted {MAX_RESTARTS} times by writes, copying the rest in one step")
+            source.backup(target)
+    finally:
+        target.close()
+        source.close()
+    return last["total"]
+
+
+def create_backup(backup_dir, pages=None, sleep=None, max_mb_s=None, progress=print):
+    """Take a snapshot of the database and the blobs it refers to. Returns its manifest."""
+    backup_dir = Path(backup_dir)
+    name = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    snapshot_dir = backup_dir / "snapshots" / name
+    snapshot_dir.mkdir(parents=True)
+    started = time.monotonic()
+
+    # Databases first: every blob they refer to was written before its row
+    databases = []
+    paths = set()
+    for shard in all_shards():
+        db_path = Path(shard_file(shard, str(snapshot_dir / DB_NAME)))
+        db_pages = backup_database(db_path, pages, sleep, progress, shard)
+        conn = open_database(db_path)
+        schema_version = conn.execute("PRAGMA user_version").fetchone()[0]
+        shard_paths = referenced_blobs(conn)
+        conn.close()
+        paths.update(shard_paths)
+        databases.append({"shard": shard, "file": db_path.name, "size": db_path.stat().st_size,
+                          "sha256": file_sha256(db_path)})
+        progress(f"database {db_path.name}: {db_pages} pages, {len(shard_paths)} blobs referenced")
+    paths = sorted(paths)
+
+    try:
+        previous = load_manifest(backup_dir)["blobs"]
+    except ValueError:
+        previous = {}
+
+    throttle = Throttle(BACKUP_MAX_MB_S if max_mb_s is None else max_mb_s)
+    blobs = {}
+    missing = []
+    copied = 0
+    copied_bytes = 0
+    for index, path in enumerate(paths, start=1):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            # Deleted since the database was copied
+            missing.append(path)
+            continue
+        known = previous.get(path)
+        if (known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns
+                and blob_path(backup_dir, known["sha256"]).exists()):
+            blobs[path] = known
+            continue
+
+        tmp = backup_dir / "blobs" / f"incoming.{os.getpid()}"
+        sha256 = copy_hashed(path, tmp, throttle)
+        dest = blob_path(backup_dir, sha256)
+        if dest.exists():
+            tmp.unlink()
+        else:
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp, dest)
+            copied += 1
+            copied_bytes += stat.st_size
+        blobs[path] = {"sha256": sha256, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        if index % 1000 == 0:
+            progress(f"blobs: {index}/{len(paths)}, {copied} copied")
+
+    manifest = {
+        "snapshot": name,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "storage_root": str(STORAGE_ROOT),
+        "schema_version": schema_version,
+        "db": databases[0],
+        "shards": databases[1:],
+        "blobs": blobs,
+        "missing": missing,
+        "copied": copied,
+        "copied_bytes": copied_bytes,
+        "seconds": round(time.monotonic() - started, 3),
+    }
+    tmp = snapshot_dir / f"{MANIFEST_NAME}.tmp"
+    tmp.write_text(json.dumps(manifest, indent=1))
+    os.replace(tmp, snapshot_dir / MANIFEST_NAME)
+    progress(
+        f"snapshot {name}: {len(blobs)} blobs, {copied} new ({copied_bytes} bytes), "
+        f"{len(missing)} deleted while copying"
+    )
+    return manifest
+
+
+# ============== Verify and Restore ==============
+
+def check_database(path, manifest):
+    """Problems found opening and checking a database copy, empty if none."""
+    problems = []
+    conn = open_database(path)
+    try:
+        # HMAC of every page, then SQLite's own structure checks
+        problems += [f"database: {row[0]}" for row in conn.execute("PRAGMA cipher_integrity_check")]
+        result = [row[0] for row in conn.execute("PRAGMA integrity_check")]
+        if result != ["ok"]:
+            problems += [f"database: {line}" for line in result]
+        if conn.execute("PRAGMA user_version").fetchone()[0] != manifest["schema_version"]:
+            problems.append("database: schema version differs from the manifest")
+        unlisted = set(referenced_blobs(conn)) - set(manifest["blobs"]) - set(manifest["missing"])
+        problems += [f"blob not in manifest: {path}" for path in sorted(unlisted)]
+    except sqlite3.DatabaseError as e:
+        problems.append(f"database: {e}")
+    finally:
+        conn.close()
+    return problems
+
+
+def verify_backup(backup_dir, snapshot=None, quick=False):
+    """Check a snapshot can be restored. Returns (manifest, problems).
+
+    The database copy must decrypt and pass its integrity checks, and every
+    blob must be there with its hash (only its size with quick).
+    """
+    manifest = load_manifest(backup_dir, snapshot)
+    problems = []
+    for database in [manifest["db"], *manifest.get("shards", [])]:
+        db_path = Path(backup_dir, "snapshots", manifest["snapshot"], database["file"])
+        if file_sha256(db_path) != database["sha256"]:
+            problems.append(f"database {database['file']}: file does not match its hash")
+        else:
+            problems += check_database(db_path, manifest)
+
+    checked = {}
+    for path, blob in manifest["blobs"].items():
+        sha256 = blob["sha256"]
+        if sha256 not in checked:
+            stored = blob_path(backup_dir, sha256)
+            if not stored.exists():
+                checked[sha256] = "missing"
+            elif quick:
+                checked[sha256] = None if stored.stat().st_size == blob["size"] else "wrong size"
+            else:
+                checked[sha256] = None if file_sha256(stored) == sha256 else "hash mismatch"
+        if checked[sha256]:
+            problems.append(f"blob {checked[sha256]}: {path}")
+    return manifest, problems
+
+
+def restored_path(path, old_root, new_root):
+    """Where a stored_path goes when restoring from old_root to new_root."""
+    if Path(path).is_relative_to(old_root):
+        return str(new_root / Path(path).relative_to(old_root))
+    return path
+
+
+def restore_backup(backup_dir, db_file, storage_root, snapshot=None, force=False, progress=print):
+    """Restore a snapshot to db_file and storage_root, checking everything copied.
+
+    Blobs go to the same place relative to storage_root as they had to the
+    backed up STORAGE_ROOT, and the stored paths in the database are
+    rewritten if the root changed. Returns the list of problems found.
+    """
+    manifest = load_manifest(backup_dir, snapshot)
+    db_file = Path(db_file)
+    storage_root = Path(storage_root)
+    if db_file.exists() and not force:
+        raise ValueError(f"{db_file} already exists, use --force to replace it")
+
+    old_root = Path(manifest["storage_root"])
+    problems = []
+    for index, (path, blob) in enumerate(sorted(manifest["blobs"].items()), start=1):
+        dest = Path(restored_path(path, old_root, storage_root))
+        source = blob_path(backup_dir, blob["sha256"])
+        if not source.exists():
+            problems.append(f"blob missing: {path}")
+            continue
+        if copy_hashed(source, dest) != blob["sha256"]:
+            problems.append(f"blob hash mismatch: {path}")
+        if index % 1000 == 0:
+            progress(f"blobs: {index}/{len(manifest['blobs'])}")
+
+    # Copy each database to a temp file next to where it goes, check them
+    # all, then swap them in. Shards go next to db_file like they were next
+    # to DB_FILE.
+    restored = []
+    for database in [manifest["db"], *manifest.get("shards", [])]:
+        dest = Path(shard_file(database.get("shard", 0), str(db_file)))
+        tmp = dest.with_name(f"{dest.name}.restore")
+        restored.append((dest, tmp))
+        source = Path(backup_dir, "snapshots", manifest["snapshot"], database["file"])
+        database_problems = restore_database(source, tmp, database["sha256"], manifest, old_root, storage_root)
+        if database_problems:
+            for _, tmp in restored:
+                for suffix in ("", "-wal", "-shm"):
+                    Path(f"{tmp}{suffix}").unlink(missing_ok=True)
+            return problems + database_problems
+
+    for dest, tmp in restored:
+        for suffix in ("-wal", "-shm"):
+            Path(f"{dest}{suffix}").unlink(missing_ok=True)
+            Path(f"{tmp}{suffix}").unlink(missing_ok=True)
+        os.replace(tmp, dest)
+    progress(f"restored snapshot {manifest['snapshot']} to {db_file} and {storage_root}")
+    return problems
+
+
+def restore_database(source, tmp, sha256, manifest, old_root, storage_root):
+    """Copy one database of a snapshot to tmp and point it at storage_root. Returns problems."""
+    if copy_hashed(source, tmp) != sha256:
+        return [f"database {source.name}: file does not match its hash"]
+
+    conn = open_database(tmp)
+    if str(old_root) != str(storage_root):
+        prefix = str(old_root) + os.sep
+        for table in ("files", "share_copies"):
+            conn.execute(
+                f"""UPDATE {table} SET stored_path = ? || substr(stored_path, ?)
+                    WHERE substr(stored_path, 1, ?) = ?""",
+                (str(storage_root) + os.sep, len(prefix) + 1, len(prefix), prefix),
+            )
+        conn.commit()
+    # A WAL copy still has the journal mode set, checkpoint what the rewrite wrote
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+    return check_database(tmp, {
+        **manifest,
+        "blobs": {restored_path(p, old_root, storage_root): b for p, b in manifest["blobs"].items()},
+        "missing": [restored_path(p, old_root, storage_root) for p in manifest["missing"]],
+    })
+
+
+def prune_backups(backup_dir, keep):
+    """Delete all but the newest `keep` snapshots and the blobs only they used.
+
+    Returns (snapshots deleted, blobs deleted).
+    """
+    names = snapshots(backup_dir)
+    doomed = names[:-keep] if keep else names
+    for name in doomed:
+        shutil.rmtree(Path(backup_dir, "snapshots", name))
+
+    used = set()
+    for name in snapshots(backup_dir):
+        used.update(blob["sha256"] for blob in load_manifest(backup_dir, name)["blobs"].values())
+    removed = 0
+    blobs_dir = Path(backup_dir, "blobs")
+    if blobs_dir.is_dir():
+        for stored in blobs_dir.glob("??/*"):
+            if stored.name not in used:
+                stored.unlink()
+                removed += 1
+    return len(doomed), removed
+
+
+# ============== Command Line ==============
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Back up, verify and restore GuardCloud data.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    create = commands.add_parser("create", help="take a snapshot while the server runs")
+    create.add_argument("backup_dir")
+    create.add_argument("--pages", type=int, help="database pages per step (BACKUP_PAGES_PER_STEP)")
+    create.add_argument("--sleep", type=float, help="seconds between steps (BACKUP_STEP_SLEEP)")
+    create.add_argument("--max-mb-s", type=float, help="blob copy rate limit (BACKUP_MAX_MB_S)")
+
+    verify = commands.add_parser("verify", help="check a snapshot can be restored")
+    verify.add_argument("backup_dir")
+    verify.add_argument("--snapshot", help="default the latest")
+    verify.add_argument("--quick", action="store_true", help="check blob sizes instead of hashes")
+
+    restore = commands.add_parser("restore", help="restore a snapshot")
+    restore.add_argument("backup_dir")
+    restore.add_argument("--snapshot", help="default the latest")
+    restore.add_argument("--db-file", default=db_file, help="default DB_FILE")
+    restore.add_argument("--storage-root", default=str(STORAGE_ROOT), help="default STORAGE_ROOT")
+    restore.add_argument("--force", action="store_true", help="replace an existing database")
+
+    prune = commands.add_parser("prune", help="delete old snapshots and unused blobs")
+    prune.add_argument("backup_dir")
+    prune.add_argument("--keep", type=int, required=True, help="snapshots to keep")
+
+    args = parser.parse_args(argv)
+    log = lambda message: print(message, file=sys.stderr)
+
+    try:
+        if args.command == "create":
+            check_schema()
+            manifest = create_backup(args.backup_dir, args.pages, args.sleep, args.max_mb_s, progress=log)
+            print(manifest["snapshot"])
+            problems = []
+        elif args.command == "verify":
+            manifest, problems = verify_backup(args.backup_dir, args.snapshot, args.quick)
+            if not problems:
+                print(f"Snapshot {manifest['snapshot']} OK: {len(manifest['blobs'])} blobs")
+        elif args.command == "restore":
+            problems = restore_backup(
+                args.backup_dir, args.db_file, args.storage_root, args.snapshot, args.force, progress=log
+            )
+        else:
+            deleted, removed = prune_backups(args.backup_dir, args.keep)
+            print(f"Deleted {deleted} snapshots and {removed} blobs")
+            problems = []
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
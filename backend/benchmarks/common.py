@@ -0,0 +1,191 @@
+# GuardCloud Benchmark Helpers
+# Shared setup for the benchmark scripts: temp environments, starting the
+# server, a tiny HTTP client and latency statistics.
+
+from contextlib import contextmanager
+from pathlib import Path
+import http.client
+import json
+import os
+import secrets
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+# ============== Environment ==============
+
+@contextmanager
+def temp_environment(keep=False):
+    """Create a throwaway DB_FILE and STORAGE_ROOT. Yields the env vars to use."""
+    root = Path(tempfile.mkdtemp(prefix="guardcloud-bench-"))
+    env = {
+        "DB_FILE": str(root / "bench.db"),
+        "STORAGE_ROOT": str(root / "storage"),
+        "SQLCIPHER_KEY": secrets.token_hex(32),
+        "SECRET_KEY": secrets.token_hex(32),
+        "TOKEN_EXPIRY_MINUTES": "600",
+    }
+    try:
+        yield env
+    finally:
+        if not keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def apply_environment(env):
+    """Put benchmark env vars into this process before importing backend modules."""
+    os.environ.update(env)
+    if str(BACKEND_DIR) not in sys.path:
+        sys.path.insert(0, str(BACKEND_DIR))
+
+
+def free_port():
+    """Find an unused local TCP port."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextmanager
+def run_server(env, workers=1, port=None, extra_args=(), health_interval=0.2):
+    """Start uvicorn with the app in a subprocess. Yields (host, port)."""
+    port = port or free_port()
+    cmd = [
+        sys.executable, "-m", "uvicorn", "server:app",
+        "--host", "127.0.0.1", "--port", str(port),
+        "--workers", str(workers), "--log-level", "warning",
+        *extra_args,
+    ]
+    proc = subprocess.Popen(cmd, cwd=BACKEND_DIR, env={**os.environ, **env})
+    try:
+        wait_for_health("127.0.0.1", port, proc, interval=health_interval)
+        yield "127.0.0.1", port
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def wait_for_health(host, port, proc=None, timeout=60, interval=0.2):
+    """Block until GET /health answers."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError("Server exited during startup")
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=2)
+            conn.request("GET", "/health")
+            if conn.getresponse().status == 200:
+                conn.close()
+                return
+        except OSError:
+            pass
+        time.sleep(interval)
+    raise RuntimeError("Server did not become healthy in time")
+
+
+# ============== HTTP Client ==============
+
+class Client:
+    """Minimal keep-alive HTTP client so benchmarks need no extra packages."""
+
+    def __init__(self, host, port, token=None):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.conn = http.client.HTTPConnection(host, port, timeout=120)
+
+    def request(self, method, path, body=None, headers=None, json_body=None):
+        """Send a request. Returns (status, body bytes)."""
+        headers = dict(headers or {})
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        if json_body is not None:
+            body = json.dumps(json_body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            return response.status, response.read()
+        except (http.client.HTTPException, OSError):
+            # Reconnect once if the server dropped the keep-alive connection
+            self.conn.close()
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=120)
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            return response.status, response.read()
+
+    def json(self, method, path, **kwargs):
+        """Send a request and decode the JSON response."""
+        status, body = self.request(method, path, **kwargs)
+        return status, (json.loads(body) if body else None)
+
+    def close(self):
+        self.conn.close()
+
+
+def multipart(fields=None, files=None):
+    """Encode form fields and files as multipart/form-data. Returns (body, headers)."""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in (fields or {}).items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode("utf-8")
+        )
+    for name, (filename, content, mime_type) in (files or {}).items():
+        parts.append(
+            (
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                f"Content-Type: {mime_type}\r\n\r\n"
+            ).encode("utf-8")
+            + content
+            + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode("utf-8"))
+    body = b"".join(parts)
+    return body, {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+
+# ============== Statistics ==============
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(latencies, elapsed=None, errors=0):
+    """Turn a list of latencies in seconds into a stats dict in milliseconds."""
+    ms = [v * 1000 for v in latencies]
+    stats = {
+        "count": len(ms),
+        "errors": errors,
+        "mean_ms": round(sum(ms) / len(ms), 3) if ms else None,
+        "p50_ms": round(percentile(ms, 50), 3) if ms else None,
+        "p95_ms": round(percentile(ms, 95), 3) if ms else None,
+        "p99_ms": round(percentile(ms, 99), 3) if ms else None,
+        "max_ms": round(max(ms), 3) if ms else None,
+    }
+    if elapsed:
+        stats["throughput_rps"] = round(len(ms) / elapsed, 2)
+    return stats
+
+
+def write_report(report, output=None):
+    """Print a JSON report and optionally save it to a file."""
+    text = json.dumps(report, indent=2)
+    if output:
+        Path(output).write_text(text + "\n")
+    print(text)
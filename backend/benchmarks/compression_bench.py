@@ -0,0 +1,132 @@
+# GuardCloud Compression Benchmark
+# Stores sample payloads (logs, JSON, CSV, text, random bytes) through
+# storage.write_blob with each available codec and reports disk savings,
+# write and read throughput, and the cost of a small Range read.
+#
+#   cd backend
+#   python -m benchmarks.compression_bench --size-mb 16 --output compression.json
+
+import argparse
+import io
+import json
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.common import apply_environment, write_report
+from benchmarks import dataset
+
+
+def sample_payloads(size, seed):
+    """Payloads of roughly `size` bytes, from very compressible to not at all."""
+    rng = random.Random(seed)
+
+    def repeat(make_line):
+        lines = []
+        total = 0
+        while total < size:
+            line = make_line()
+            lines.append(line)
+            total += len(line) + 1
+        return "\n".join(lines).encode("utf-8")[:size]
+
+    return {
+        "log": repeat(lambda: (
+            f"2026-10-19 12:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d} "
+            f"{rng.choice(['INFO', 'INFO', 'WARN', 'ERROR'])} request_id={rng.getrandbits(32):08x} "
+            f"path=/files/{rng.randint(1, 99999)} status={rng.choice([200, 200, 404, 500])} "
+            f"ms={rng.random() * 100:.2f}"
+        )),
+        "json": repeat(lambda: json.dumps({
+            "id": rng.randint(1, 10 ** 6),
+            "name": f"{rng.choice(dataset.WORDS)}_{rng.randint(1, 999)}",
+            "tags": rng.sample(dataset.WORDS, 3),
+            "score": round(rng.random(), 4),
+        })),
+        "csv": repeat(lambda: ",".join([
+            str(rng.randint(1, 10 ** 6)),
+            rng.choice(dataset.WORDS),
+            f"{rng.random() * 1000:.2f}",
+            rng.choice(["true", "false"]),
+        ])),
+        "text": repeat(lambda: " ".join(rng.choice(dataset.WORDS) for _ in range(12))),
+        "random": os.urandom(size),
+    }
+
+
+def measure(storage, data, path, iterations):
+    write_times = []
+    read_times = []
+    range_times = []
+    stored = 0
+    codec = 0
+    for _ in range(iterations):
+        start = time.perf_counter()
+        _, stored, codec = storage.write_blob(path, io.BytesIO(data))
+        write_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in storage.read_blob(path, compression=codec):
+            pass
+        read_times.append(time.perf_counter() - start)
+
+        offset = len(data) // 2
+        start = time.perf_counter()
+        for _ in storage.read_blob(path, offset, offset + 4095, compression=codec):
+            pass
+        range_times.append(time.perf_counter() - start)
+
+    mb = len(data) / 1024 ** 2
+    return {
+        "compressed": codec != storage.CODEC_NONE,
+        "size": len(data),
+        "stored": stored,
+        "ratio": round(stored / len(data), 4) if data else 1.0,
+        "saved_pct": round((1 - stored / len(data)) * 100, 2) if data else 0.0,
+        "write_mb_s": round(mb / (sum(write_times) / iterations), 1),
+        "read_mb_s": round(mb / (sum(read_times) / iterations), 1),
+        "range_4k_ms": round(sum(range_times) / iterations * 1000, 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure storage compression savings and cost.")
+    parser.add_argument("--size-mb", type=float, default=8, help="size of each sample payload")
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    apply_environment({})
+    import storage
+
+    payloads = sample_payloads(int(args.size_mb * 1024 ** 2), args.seed)
+    modes = ["off", "zlib"] + (["zstd"] if storage.zstandard else [])
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="guardcloud-bench-") as root:
+        path = os.path.join(root, "blob")
+        for mode in modes:
+            storage.STORAGE_COMPRESSION = mode
+            results[mode] = {
+                name: measure(storage, data, path, args.iterations)
+                for name, data in payloads.items()
+            }
+            total = sum(r["size"] for r in results[mode].values())
+            stored = sum(r["stored"] for r in results[mode].values())
+            results[mode]["total_saved_pct"] = round((1 - stored / total) * 100, 2)
+
+    write_report(
+        {
+            "payload_mb": args.size_mb,
+            "segment_size": storage.STORAGE_SEGMENT_SIZE,
+            "zstandard_installed": storage.zstandard is not None,
+            "modes": results,
+        },
+        args.output,
+    )
+
+
+if __name__ == "__main__":
+    main()
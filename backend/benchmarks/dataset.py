@@ -0,0 +1,270 @@
+# GuardCloud Synthetic Dataset
+# Fills a SQLCipher database with realistic volumes of users, deep folder
+# trees, files, share links and activity rows for benchmarking.
+#
+# Only database rows are generated, no blobs are written to STORAGE_ROOT.
+#
+#   cd backend
+#   python -m benchmarks.dataset --db bench.db --key <hex key> --users 200 --files 1000000
+
+from datetime import datetime, timedelta
+import argparse
+import json
+import os
+import random
+import secrets
+import time
+
+from benchmarks.common import apply_environment
+
+MIME_TYPES = [
+    ("text/plain", ".txt"),
+    ("application/json", ".json"),
+    ("text/csv", ".csv"),
+    ("application/pdf", ".pdf"),
+    ("image/jpeg", ".jpg"),
+    ("image/png", ".png"),
+    ("video/mp4", ".mp4"),
+    ("audio/mpeg", ".mp3"),
+    ("application/zip", ".zip"),
+    (None, ".bin"),
+]
+
+ACTIONS = ["login", "upload", "rename", "move", "trash", "restore", "share", "delete", "create_folder"]
+
+WORDS = [
+    "report", "invoice", "photo", "backup", "notes", "draft", "final", "budget",
+    "project", "scan", "contract", "summary", "holiday", "meeting", "data", "export",
+]
+
+
+def _timestamp(rng, days):
+    """Random timestamp within the last `days` days, in SQLite's format."""
+    moment = datetime.now() - timedelta(seconds=rng.randint(0, days * 86400))
+    return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _user_weights(count):
+    """Zipf-like weights so a few users own most of the data, like real accounts."""
+    return [1 / (i + 1) for i in range(count)]
+
+
+def generate(
+    users=50,
+    folders_per_user=200,
+    depth=8,
+    files=100_000,
+    trashed_ratio=0.05,
+    shares=10_000,
+    activity=200_000,
+    days=365,
+    batch_size=20_000,
+    seed=1,
+    progress=print,
+):
+    """Generate the dataset into the database configured by DB_FILE/SQLCIPHER_KEY.
+
+    Returns a dict with the number of rows created per table.
+    """
+    import database
+
+    rng = random.Random(seed)
+    database.Initialize_db()
+    conn = database.db_connection()
+    conn.execute("PRAGMA synchronous = OFF")
+    cursor = conn.cursor()
+    started = time.perf_counter()
+
+    # Users, all with the same (unusable) password hash
+    usernames = [f"user{i:05d}" for i in range(users)]
+    cursor.executemany(
+        "INSERT OR IGNORE INTO users (username, password, email) VALUES (?, ?, ?)",
+        [(name, "!", f"{name}@example.com") for name in usernames],
+    )
+    conn.commit()
+    progress(f"users: {users}")
+
+    # Folder trees: one chain `depth` levels deep, the rest hang off random
+    # folders that are not already at the maximum depth
+    folders_by_user = {}
+    for name in usernames:
+        ids = []
+        levels = {}
+        parent = None
+        for level in range(min(depth, folders_per_user)):
+            cursor.execute(
+                "INSERT INTO folders (owner, name, parent_id, created_at) VALUES (?, ?, ?, ?)",
+                (name, f"level{level}", parent, _timestamp(rng, days)),
+            )
+            parent = cursor.lastrowid
+            ids.append(parent)
+            levels[parent] = level
+        for n in range(folders_per_user - len(ids)):
+            candidates = [i for i in ids[-50:] if levels[i] < depth - 1] or [None]
+            parent = rng.choice(candidates + [None])
+            cursor.execute(
+                "INSERT INTO folders (owner, name, parent_id, created_at) VALUES (?, ?, ?, ?)",
+                (name, f"{rng.choice(WORDS)}-{n}", parent, _timestamp(rng, days)),
+            )
+            ids.append(cursor.lastrowid)
+            levels[cursor.lastrowid] = 0 if parent is None else levels[parent] + 1
+        folders_by_user[name] = ids
+    conn.commit()
+    progress(f"folders: {users * folders_per_user}")
+
+    # Files, spread over users with a heavy tail
+    weights = _user_weights(users)
+    created = 0
+    while created < files:
+        rows = []
+        for _ in range(min(batch_size, files - created)):
+            owner = rng.choices(usernames, weights)[0]
+            mime_type, ext = rng.choice(MIME_TYPES)
+            filename = f"{rng.choice(WORDS)}_{rng.randint(1, 99999)}{ext}"
+            folder_id = rng.choice(folders_by_user[owner] + [None])
+            trashed = rng.random() < trashed_ratio
+            created_at = _timestamp(rng, days)
+            rows.append((
+                owner,
+                filename,
+                f"storage/{owner}/{secrets.token_hex(8)}{ext}",
+                int(rng.lognormvariate(11, 2)) % (2 * 1024 ** 3),
+                mime_type,
+                folder_id,
+                int(trashed),
+                created_at if trashed else None,
+                created_at,
+                created_at,
+            ))
+        cursor.executemany(
+            """INSERT INTO files (owner, filename, stored_path, size, mime_type, folder_id,
+                                  is_trashed, trashed_at, created_at, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            rows,
+        )
+        conn.commit()
+        created += len(rows)
+        progress(f"files: {created}/{files}")
+
+    # Share links on random files
+    cursor.execute("SELECT MIN(id), MAX(id) FROM files")
+    low, high = cursor.fetchone()
+    rows = []
+    for _ in range(shares if low else 0):
+        file_id = rng.randint(low, high)
+        rows.append((
+            file_id,
+            secrets.token_urlsafe(32),
+            None,
+            (datetime.now() + timedelta(days=rng.randint(-30, 30))).isoformat() if rng.random() < 0.5 else None,
+            rng.choice([None, None, 10, 100]),
+            rng.randint(0, 50),
+            None,
+        ))
+    cursor.executemany(
+        """INSERT INTO share_links (file_id, token, password_hash, expires_at, max_downloads,
+                                    download_count, share_stored_path, created_by)
+           SELECT ?, ?, ?, ?, ?, ?, ?, owner FROM files WHERE id = ?""",
+        [row + (row[0],) for row in rows],
+    )
+    share_count = max(cursor.rowcount, 0)
+    conn.commit()
+    progress(f"share links: {share_count}")
+
+    # Activity log, one partition per month. Ids are given explicitly so
+    # they stay unique across partitions filled out of order.
+    created = 0
+    while created < activity:
+        partitions = {}
+        for n in range(min(batch_size, activity - created)):
+            created_at = _timestamp(rng, days)
+            partitions.setdefault(database.activity_partition_name(created_at), []).append((
+                created + n + 1,
+                rng.choices(usernames, weights)[0],
+                rng.choice(ACTIONS),
+                "file",
+                rng.randint(1, max(files, 1)),
+                f"{rng.choice(WORDS)}.txt",
+                None,
+                f"10.0.{rng.randint(0, 255)}.{rng.randint(1, 254)}",
+                created_at,
+            ))
+        for name, rows in partitions.items():
+            database.ensure_activity_partition(cursor, name)
+            cursor.executemany(
+                f"""INSERT INTO {name} (id, username, action, target_type, target_id, target_name,
+                                        details, ip_address, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                rows,
+            )
+        conn.commit()
+        created += sum(len(rows) for rows in partitions.values())
+        progress(f"activity: {created}/{activity}")
+
+    # Generated rows bypass the mutation functions, journal them for sync
+    database.backfill_change_journal(conn)
+    conn.commit()
+
+    conn.execute(f"PRAGMA synchronous = {database.DB_SYNCHRONOUS}")
+    conn.close()
+
+    # Fill the daily analytics rollups from the generated activity
+    database.rollup_activity()
+    progress(f"done in {time.perf_counter() - started:.1f}s")
+    return {
+        "users": users,
+        "folders": users * folders_per_user,
+        "files": files,
+        "share_links": share_count,
+        "activity": activity,
+    }
+
+
+def add_arguments(parser):
+    """Dataset size options, shared with the micro-benchmarks."""
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--folders-per-user", type=int, default=200)
+    parser.add_argument("--depth", type=int, default=8, help="deepest folder nesting")
+    parser.add_argument("--files", type=int, default=100_000)
+    parser.add_argument("--trashed-ratio", type=float, default=0.05)
+    parser.add_argument("--shares", type=int, default=10_000)
+    parser.add_argument("--activity", type=int, default=200_000)
+    parser.add_argument("--days", type=int, default=365, help="spread timestamps over this many days")
+    parser.add_argument("--batch-size", type=int, default=20_000, help="rows per insert transaction")
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def dataset_options(args):
+    """Pull the dataset options out of parsed arguments."""
+    return {
+        "users": args.users,
+        "folders_per_user": args.folders_per_user,
+        "depth": args.depth,
+        "files": args.files,
+        "trashed_ratio": args.trashed_ratio,
+        "shares": args.shares,
+        "activity": args.activity,
+        "days": args.days,
+        "batch_size": args.batch_size,
+        "seed": args.seed,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic GuardCloud database.")
+    parser.add_argument("--db", required=True, help="database file to create or extend")
+    parser.add_argument("--key", help="SQLCipher key (defaults to SQLCIPHER_KEY)")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    env = {"DB_FILE": os.path.abspath(args.db)}
+    if args.key:
+        env["SQLCIPHER_KEY"] = args.key
+    apply_environment(env)
+
+    counts = generate(**dataset_options(args))
+    print(json.dumps(counts, indent=2))
+
+
+if __name__ == "__main__":
+    main()
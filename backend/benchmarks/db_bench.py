@@ -0,0 +1,234 @@
+# GuardCloud Database Micro-Benchmarks
+# Calls each database.py function many times against a large dataset and
+# reports per-call latency, time spent in SQL, rows returned and how much
+# work SQLite did (VM steps and query plans).
+#
+#   cd backend
+#   python -m benchmarks.db_bench --files 1000000 --output db.json       # temp dataset
+#   python -m benchmarks.db_bench --db bench.db --key <hex key>          # existing dataset
+
+import argparse
+import logging
+import os
+import random
+import time
+
+from benchmarks.common import apply_environment, summarize, temp_environment, write_report
+from benchmarks import dataset
+
+
+class Samples:
+    """Random valid arguments drawn from the dataset."""
+
+    def __init__(self, conn, rng, size=500):
+        self.rng = rng
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT username FROM users ORDER BY RANDOM() LIMIT ?", (size,))
+        self.users = [row["username"] for row in cursor.fetchall()]
+
+        cursor.execute(
+            "SELECT id, owner, folder_id FROM files WHERE is_trashed = 0 ORDER BY RANDOM() LIMIT ?",
+            (size,),
+        )
+        self.files = [(row["id"], row["owner"], row["folder_id"]) for row in cursor.fetchall()]
+
+        cursor.execute(
+            "SELECT id, owner FROM folders WHERE is_trashed = 0 ORDER BY RANDOM() LIMIT ?",
+            (size,),
+        )
+        self.folders = [(row["id"], row["owner"]) for row in cursor.fetchall()]
+
+        # Folders with no children are the deepest point of their branch
+        cursor.execute(
+            """SELECT f.id, f.owner FROM folders f
+               WHERE NOT EXISTS (SELECT 1 FROM folders c WHERE c.parent_id = f.id)
+               ORDER BY RANDOM() LIMIT ?""",
+            (size,),
+        )
+        self.leaf_folders = [(row["id"], row["owner"]) for row in cursor.fetchall()]
+
+        cursor.execute(
+            "SELECT sl.token, sl.file_id, f.owner FROM share_links sl JOIN files f ON f.id = sl.file_id ORDER BY RANDOM() LIMIT ?",
+            (size,),
+        )
+        self.shares = [(row["token"], row["file_id"], row["owner"]) for row in cursor.fetchall()]
+
+    def user(self):
+        return self.rng.choice(self.users)
+
+    def file(self):
+        return self.rng.choice(self.files)
+
+    def folder(self):
+        return self.rng.choice(self.folders)
+
+    def leaf_folder(self):
+        return self.rng.choice(self.leaf_folders or self.folders)
+
+    def share(self):
+        return self.rng.choice(self.shares)
+
+    def take_file(self):
+        """Remove a file from the samples, for destructive benchmarks."""
+        return self.files.pop(self.rng.randrange(len(self.files)))
+
+    def take_folder(self):
+        return self.folders.pop(self.rng.randrange(len(self.folders)))
+
+
+def benchmarks(db, s):
+    """Map of benchmark name to a function that makes one call."""
+
+    def list_folder():
+        file_id, owner, folder_id = s.file()
+        return db.get_user_files(owner, folder_id)
+
+    def file_share_links():
+        token, file_id, owner = s.share()
+        return db.get_file_share_links(file_id, owner)
+
+    def rename():
+        file_id, owner, _ = s.file()
+        return db.rename_file(file_id, owner, f"renamed_{file_id}.txt")
+
+    def move():
+        file_id, owner, _ = s.file()
+        folder_id = next((f for f, o in s.folders if o == owner), None)
+        return db.move_file(file_id, owner, folder_id)
+
+    def trash_restore():
+        file_id, owner, _ = s.file()
+        db.trash_file(file_id, owner)
+        return db.restore_file(file_id, owner)
+
+    def delete_file():
+        file_id, owner, _ = s.take_file()
+        return db.delete_file_permanent(file_id, owner)
+
+    def rename_request():
+        # What the rename endpoint does: look up, rename and log in one unit of work
+        file_id, owner, _ = s.file()
+        with db.UnitOfWork(owner) as work:
+            old_name = work.file(file_id)["filename"]
+            work.rename_file(file_id, f"renamed_{file_id}.txt")
+            work.log_activity("rename", target_type="file", target_id=file_id, details=f"Renamed from {old_name}")
+
+    def trash_folder():
+        folder_id, owner = s.take_folder()
+        return db.trash_folder(folder_id, owner)
+
+    return {
+        "user_exists": lambda: db.user_exists(s.user()),
+        "get_user_info": lambda: db.get_user_info(s.user()),
+        "get_user_files_root": lambda: db.get_user_files(s.user()),
+        "get_user_files_folder": list_folder,
+        "get_trashed_files": lambda: db.get_trashed_files(s.user()),
+        "get_file_by_id": lambda: db.get_file_by_id(*s.file()[:2]),
+        "search_files": lambda: db.search_files(s.user(), s.rng.choice(dataset.WORDS)),
+        "get_folders_root": lambda: db.get_folders(s.user()),
+        "get_folders_child": lambda: db.get_folders(s.folder()[1], s.folder()[0]),
+        "get_folder_by_id": lambda: db.get_folder_by_id(*s.folder()),
+        "get_folder_path": lambda: db.get_folder_path(*s.leaf_folder()),
+        "get_share_link": lambda: db.get_share_link(s.share()[0]),
+        "get_file_share_links": file_share_links,
+        "get_user_activity": lambda: db.get_user_activity(s.user(), 50),
+        "get_activity_rollups_user": lambda: db.get_activity_rollups(30, username=s.user()),
+        "get_top_active_users": lambda: db.get_top_active_users(7),
+        "get_storage_used": lambda: db.get_storage_used(s.user()),
+        "get_file_count": lambda: db.get_file_count(s.user()),
+        "save_file_metadata": lambda: db.save_file_metadata(s.user(), "bench.txt", "storage/bench.txt", 1024, "text/plain"),
+        "log_activity": lambda: db.log_activity(s.user(), "login", ip_address="127.0.0.1"),
+        "rollup_activity": db.rollup_activity,
+        "increment_share_download": lambda: db.increment_share_download(s.share()[0]),
+        "rename_file": rename,
+        "rename_file_request": rename_request,
+        "move_file": move,
+        "trash_and_restore_file": trash_restore,
+        "trash_folder": trash_folder,
+        "delete_file_permanent": delete_file,
+    }
+
+
+def run_benchmark(name, fn, iterations):
+    """Time `iterations` calls of fn, then one diagnostic call with plans."""
+    from querylog import capture
+
+    latencies = []
+    sql_ms = []
+    rows = []
+    for _ in range(iterations):
+        with capture() as statements:
+            start = time.perf_counter()
+            fn()
+            latencies.append(time.perf_counter() - start)
+        sql_ms.append(sum(st["duration_ms"] for st in statements))
+        rows.append(sum(st["rows"] for st in statements))
+
+    with capture(plans=True) as statements:
+        fn()
+
+    result = summarize(latencies)
+    result["sql_mean_ms"] = round(sum(sql_ms) / len(sql_ms), 3)
+    result["rows_mean"] = round(sum(rows) / len(rows), 1)
+    result["statements"] = [
+        {
+            "sql": st["fingerprint"],
+            "rows": st["rows"],
+            "vm_steps": st["vm_steps"],
+            "plan": st["plan"],
+        }
+        for st in statements
+    ]
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmark database.py functions.")
+    parser.add_argument("--db", help="existing dataset to use (otherwise a temp one is generated)")
+    parser.add_argument("--key", help="SQLCipher key for --db (defaults to SQLCIPHER_KEY)")
+    parser.add_argument("--iterations", type=int, default=100, help="calls per function")
+    parser.add_argument("--only", help="comma separated benchmark names to run")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    dataset.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    # Every call is timed here, the slow query log would only add noise
+    logging.getLogger("guardcloud.db").setLevel(logging.ERROR)
+
+    with temp_environment() as env:
+        if args.db:
+            env = {"DB_FILE": os.path.abspath(args.db)}
+            if args.key:
+                env["SQLCIPHER_KEY"] = args.key
+        apply_environment(env)
+        import database
+
+        counts = None
+        if not args.db:
+            counts = dataset.generate(**dataset.dataset_options(args), progress=lambda msg: None)
+
+        rng = random.Random(args.seed)
+        conn = database.db_connection()
+        samples = Samples(conn, rng, size=max(500, args.iterations * 2))
+        conn.close()
+
+        selected = set(args.only.split(",")) if args.only else None
+        results = {}
+        for name, fn in benchmarks(database, samples).items():
+            if selected and name not in selected:
+                continue
+            results[name] = run_benchmark(name, fn, args.iterations)
+
+    write_report(
+        {
+            "dataset": counts or {"db": args.db},
+            "iterations": args.iterations,
+            "functions": results,
+        },
+        args.output,
+    )
+
+
+if __name__ == "__main__":
+    main()
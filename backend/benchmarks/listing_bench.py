@@ -0,0 +1,139 @@
+# GuardCloud Listing Format Benchmark
+# Compares the default /files response (one object per file, encoded by
+# FastAPI) with the compact columnar format (column names once, one array
+# per file) for very large folders. Reports query and serialization time
+# plus payload size.
+#
+#   cd backend
+#   python -m benchmarks.listing_bench --sizes 10000,100000 --output listing.json
+
+import argparse
+import json
+import logging
+import random
+import time
+
+from benchmarks.common import apply_environment, summarize, temp_environment, write_report
+from benchmarks import dataset
+
+
+def fill_folder(database, owner, count, seed):
+    """Create a user with one folder holding `count` files. Returns the folder id."""
+    rng = random.Random(seed)
+    conn = database.db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT INTO users (username, password, email) VALUES (?, ?, ?)",
+        (owner, "!", f"{owner}@example.com"),
+    )
+    cursor.execute("INSERT INTO folders (owner, name) VALUES (?, ?)", (owner, "big"))
+    folder_id = cursor.lastrowid
+    rows = []
+    for n in range(count):
+        mime_type, ext = rng.choice(dataset.MIME_TYPES)
+        created_at = dataset._timestamp(rng, 365)
+        rows.append((
+            owner,
+            f"{rng.choice(dataset.WORDS)}_{n}{ext}",
+            f"storage/{owner}/{n}{ext}",
+            rng.randint(1, 50 * 1024 ** 2),
+            mime_type,
+            folder_id,
+            created_at,
+            created_at,
+        ))
+    cursor.executemany(
+        """INSERT INTO files (owner, filename, stored_path, size, mime_type, folder_id,
+                              created_at, updated_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+        rows,
+    )
+    conn.commit()
+    conn.close()
+    return folder_id
+
+
+def measure(query, encode, iterations):
+    """Time query() and encode(result) separately over several runs."""
+    query_times = []
+    encode_times = []
+    size = 0
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = query()
+        middle = time.perf_counter()
+        body = encode(result)
+        end = time.perf_counter()
+        query_times.append(middle - start)
+        encode_times.append(end - middle)
+        size = len(body)
+    return {
+        "query": summarize(query_times),
+        "serialize": summarize(encode_times),
+        "total_mean_ms": round((sum(query_times) + sum(encode_times)) / iterations * 1000, 3),
+        "bytes": size,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare default and compact listing formats.")
+    parser.add_argument("--sizes", default="10000,100000", help="comma separated files per folder")
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    with temp_environment() as env:
+        apply_environment(env)
+        from fastapi.encoders import jsonable_encoder
+        from fastapi.responses import JSONResponse
+        import database
+        import server
+
+        database.check_schema()
+        logging.getLogger("guardcloud.db").setLevel(logging.ERROR)
+
+        def fastapi_encode(files):
+            # What FastAPI does with a plain dict return value
+            return JSONResponse(jsonable_encoder({"files": files})).body
+
+        def stdlib_encode(files):
+            return json.dumps({"files": files}, separators=(",", ":")).encode("utf-8")
+
+        results = {}
+        for size in [int(s) for s in args.sizes.split(",")]:
+            owner = f"bench{size}"
+            folder_id = fill_folder(database, owner, size, args.seed)
+
+            formats = {
+                "default": measure(
+                    lambda: database.get_user_files(owner, folder_id),
+                    fastapi_encode,
+                    args.iterations,
+                ),
+                "compact_json": measure(
+                    lambda: database.get_user_files(owner, folder_id, compact=True),
+                    stdlib_encode,
+                    args.iterations,
+                ),
+            }
+            if server.orjson:
+                formats["compact_orjson"] = measure(
+                    lambda: database.get_user_files(owner, folder_id, compact=True),
+                    lambda files: server.orjson.dumps({"files": files}),
+                    args.iterations,
+                )
+            results[str(size)] = formats
+
+    write_report(
+        {
+            "iterations": args.iterations,
+            "orjson": server.orjson is not None,
+            "sizes": results,
+        },
+        args.output,
+    )
+
+
+if __name__ == "__main__":
+    main()
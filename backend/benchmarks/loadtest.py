@@ -0,0 +1,248 @@
+# GuardCloud Load Test
+# Drives a realistic mix of API calls against a running server and reports
+# throughput and p50/p95/p99 latency per endpoint as JSON.
+#
+# By default it starts its own server against a temp SQLCipher DB and
+# STORAGE_ROOT, so runs are reproducible and never touch real data:
+#
+#   cd backend
+#   python -m benchmarks.loadtest --concurrency 16 --duration 30 --output before.json
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import os
+import random
+import threading
+import time
+
+from benchmarks.common import Client, multipart, run_server, summarize, temp_environment, write_report
+
+PASSWORD = "LoadTest-Password1!"
+
+# Relative weights of each operation in the traffic mix
+DEFAULT_MIX = {
+    "login": 2,
+    "list_files": 30,
+    "search": 10,
+    "upload_small": 10,
+    "upload_large": 1,
+    "download": 20,
+    "create_share": 4,
+    "share_info": 8,
+    "share_download": 15,
+}
+
+
+def parse_mix(text):
+    """Parse 'login=2,list_files=30' into a weights dict."""
+    mix = dict(DEFAULT_MIX)
+    if text:
+        for item in text.split(","):
+            name, weight = (part.strip() for part in item.split("="))
+            if name not in DEFAULT_MIX:
+                raise SystemExit(f"Unknown operation in mix: {name}")
+            mix[name] = int(weight)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+class LoadTest:
+    """Holds the shared state (users, files, share tokens) for one run."""
+
+    def __init__(self, host, port, args):
+        self.host = host
+        self.port = port
+        self.args = args
+        self.mix = parse_mix(args.mix)
+        self.users = []
+        self.lock = threading.Lock()
+        self.results = {name: [] for name in self.mix}
+        self.errors = {name: 0 for name in self.mix}
+        self.small_payload = os.urandom(args.small_size)
+        self.large_payload = os.urandom(args.large_size)
+
+    # ----- setup -----
+
+    def setup(self):
+        """Create users, folders, files and share links to run against."""
+        client = Client(self.host, self.port)
+        for i in range(self.args.users):
+            username = f"load{i}"
+            client.json("POST", "/auth/signup", json_body={"username": username, "password": PASSWORD})
+            status, body = client.json("POST", "/auth/login", json_body={"username": username, "password": PASSWORD})
+            if status != 200:
+                raise RuntimeError(f"Could not log in {username}: {status}")
+
+            user = {"name": username, "token": body["token"], "files": [], "shares": [], "folders": [None]}
+            user_client = Client(self.host, self.port, user["token"])
+            for f in range(self.args.folders):
+                _, folder = user_client.json("POST", "/folders", json_body={"name": f"folder{f}"})
+                user["folders"].append(folder["folder_id"])
+            for n in range(self.args.seed_files):
+                file_id = self._upload(user_client, user, f"seed{n}.txt", self.small_payload)
+                if n < 3:
+                    self._share(user_client, user, file_id)
+            user_client.close()
+            self.users.append(user)
+        client.close()
+
+    def _upload(self, client, user, filename, payload, rng=random):
+        folder_id = rng.choice(user["folders"])
+        path = "/files/upload" + (f"?folder_id={folder_id}" if folder_id else "")
+        body, headers = multipart(files={"file": (filename, payload, "application/octet-stream")})
+        status, data = client.json("POST", path, body=body, headers=headers)
+        if status != 200:
+            return None
+        with self.lock:
+            user["files"].append(data["file_id"])
+        return data["file_id"]
+
+    def _share(self, client, user, file_id):
+        body, headers = multipart(fields={"expires_in_days": "7"})
+        status, data = client.json("POST", f"/files/{file_id}/share", body=body, headers=headers)
+        if status != 200:
+            return None
+        with self.lock:
+            user["shares"].append(data["token"])
+        return data["token"]
+
+    # ----- operations -----
+
+    def run_op(self, name, client, user, rng):
+        """Run one operation. Returns True when the server answered as expected."""
+        if name == "login":
+            status, _ = client.request(
+                "POST", "/auth/login", json_body={"username": user["name"], "password": PASSWORD}
+            )
+            return status == 200
+        if name == "list_files":
+            folder_id = rng.choice(user["folders"])
+            status, _ = client.request("GET", "/files" + (f"?folder_id={folder_id}" if folder_id else ""))
+            return status == 200
+        if name == "search":
+            status, _ = client.request("GET", f"/files/search?q=seed{rng.randint(0, 9)}")
+            return status == 200
+        if name == "upload_small":
+            return self._upload(client, user, f"small{rng.randint(0, 10**9)}.bin", self.small_payload, rng) is not None
+        if name == "upload_large":
+            return self._upload(client, user, f"large{rng.randint(0, 10**9)}.bin", self.large_payload, rng) is not None
+        if name == "download":
+            if not user["files"]:
+                return True
+            status, _ = client.request("GET", f"/files/{rng.choice(user['files'])}/download")
+            return status == 200
+        if name == "create_share":
+            if not user["files"]:
+                return True
+            return self._share(client, user, rng.choice(user["files"])) is not None
+        if name == "share_info":
+            if not user["shares"]:
+                return True
+            status, _ = client.request("GET", f"/share/{rng.choice(user['shares'])}")
+            return status == 200
+        if name == "share_download":
+            if not user["shares"]:
+                return True
+            status, _ = client.request("POST", f"/share/{rng.choice(user['shares'])}/download")
+            return status == 200
+        raise ValueError(name)
+
+    def worker(self, index, deadline):
+        """Loop over random operations until the deadline."""
+        rng = random.Random(self.args.seed + index)
+        user = self.users[index % len(self.users)]
+        client = Client(self.host, self.port, user["token"])
+        names = list(self.mix)
+        weights = [self.mix[n] for n in names]
+        latencies = {name: [] for name in names}
+        errors = {name: 0 for name in names}
+
+        while time.monotonic() < deadline:
+            name = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                ok = self.run_op(name, client, user, rng)
+            except Exception:
+                ok = False
+            latencies[name].append(time.perf_counter() - start)
+            if not ok:
+                errors[name] += 1
+        client.close()
+
+        with self.lock:
+            for name in names:
+                self.results[name].extend(latencies[name])
+                self.errors[name] += errors[name]
+
+    def run(self):
+        """Run all workers and build the report."""
+        deadline = time.monotonic() + self.args.duration
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            for i in range(self.args.concurrency):
+                pool.submit(self.worker, i, deadline)
+        elapsed = time.perf_counter() - started
+
+        total = sum(len(v) for v in self.results.values())
+        return {
+            "config": {
+                "concurrency": self.args.concurrency,
+                "duration_s": self.args.duration,
+                "users": self.args.users,
+                "server_workers": self.args.workers,
+                "small_size": self.args.small_size,
+                "large_size": self.args.large_size,
+                "seed": self.args.seed,
+                "mix": self.mix,
+            },
+            "elapsed_s": round(elapsed, 3),
+            "total_requests": total,
+            "total_errors": sum(self.errors.values()),
+            "throughput_rps": round(total / elapsed, 2),
+            "endpoints": {
+                name: summarize(self.results[name], elapsed, self.errors[name])
+                for name in self.mix
+            },
+        }
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Load test the GuardCloud API.")
+    parser.add_argument("--url", help="Use an already running server, e.g. http://127.0.0.1:8000")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes when starting a server")
+    parser.add_argument("--concurrency", type=int, default=8, help="parallel client threads")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to run")
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--folders", type=int, default=3, help="folders per user")
+    parser.add_argument("--seed-files", type=int, default=20, help="files uploaded per user before the run")
+    parser.add_argument("--small-size", type=int, default=16 * 1024)
+    parser.add_argument("--large-size", type=int, default=8 * 1024 * 1024)
+    parser.add_argument("--mix", help="operation weights, e.g. list_files=50,upload_large=0")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    return parser
+
+
+def run_loadtest(args, host, port):
+    """Set up data and run one load test against host:port."""
+    random.seed(args.seed)
+    test = LoadTest(host, port, args)
+    test.setup()
+    return test.run()
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    if args.url:
+        hostport = args.url.split("://", 1)[-1].rstrip("/")
+        host, _, port = hostport.partition(":")
+        report = run_loadtest(args, host, int(port or 80))
+    else:
+        with temp_environment() as env, run_server(env, workers=args.workers) as (host, port):
+            report = run_loadtest(args, host, port)
+
+    write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
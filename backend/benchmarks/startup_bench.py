@@ -0,0 +1,139 @@
+# GuardCloud Startup Benchmark
+# Measures how fast a new worker is ready against an existing database:
+# importing server.py, running the app's startup, spawning uvicorn until
+# /health answers, and the latency of the first requests it serves.
+#
+#   cd backend
+#   python -m benchmarks.startup_bench --runs 5 --output startup.json
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks.common import (
+    BACKEND_DIR,
+    Client,
+    apply_environment,
+    run_server,
+    summarize,
+    temp_environment,
+    write_report,
+)
+from benchmarks.loadtest import PASSWORD
+
+# Runs in a fresh interpreter, so nothing is imported or cached yet
+STARTUP_PROBE = """
+import asyncio, json, time
+start = time.perf_counter()
+import server
+imported = time.perf_counter()
+
+async def start_app():
+    async with server.app.router.lifespan_context(server.app):
+        return time.perf_counter()
+
+ready = asyncio.run(start_app())
+print(json.dumps({"import": imported - start, "startup": ready - imported}))
+"""
+
+
+def probe(env):
+    """Import the server and run its startup in a new process. Returns seconds."""
+    result = subprocess.run(
+        [sys.executable, "-c", STARTUP_PROBE],
+        cwd=BACKEND_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(env, top):
+    """The modules server.py imports directly, slowest first (python -X importtime)."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import server"],
+        cwd=BACKEND_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imports = []
+    children = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        # Modules are listed after everything they import, indented one level deeper
+        depth = len(name) - len(name.lstrip()) - 1
+        if depth == 2:
+            children.append({"module": name.strip(), "cumulative_ms": round(int(cumulative) / 1000, 2)})
+        elif depth == 0:
+            if name.strip() == "server":
+                imports = children
+            children = []
+    imports.sort(key=lambda i: i["cumulative_ms"], reverse=True)
+    return imports[:top]
+
+
+def first_requests(env, token):
+    """Start uvicorn and time until /health answers and the first requests after it."""
+    spawned = time.perf_counter()
+    with run_server(env, health_interval=0.01) as (host, port):
+        healthy = time.perf_counter() - spawned
+        client = Client(host, port, token)
+        timings = {}
+        for name, path in [("first_files", "/files"), ("second_files", "/files"), ("first_me", "/auth/me")]:
+            start = time.perf_counter()
+            status, _ = client.request("GET", path)
+            timings[name] = time.perf_counter() - start
+            if status != 200:
+                raise RuntimeError(f"GET {path} returned {status}")
+        client.close()
+    return {"health": healthy, **timings}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure worker import, startup and first-request latency.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top-imports", type=int, default=10, help="slowest direct imports to list")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    with temp_environment() as env:
+        apply_environment(env)
+        child_env = dict(os.environ)
+
+        # The first start creates the schema, later ones only check its version
+        with run_server(env) as (host, port):
+            client = Client(host, port)
+            client.request("POST", "/auth/signup", json_body={"username": "bench", "password": PASSWORD})
+            _, body = client.json("POST", "/auth/login", json_body={"username": "bench", "password": PASSWORD})
+            token = body["token"]
+            client.close()
+
+        probes = [probe(child_env) for _ in range(args.runs)]
+        served = [first_requests(env, token) for _ in range(args.runs)]
+
+        report = {
+            "runs": args.runs,
+            "import": summarize([p["import"] for p in probes]),
+            "startup": summarize([p["startup"] for p in probes]),
+            "spawn_to_health": summarize([s["health"] for s in served]),
+        }
+        for name in ("first_files", "second_files", "first_me"):
+            report[name] = summarize([s[name] for s in served])
+        report["slowest_imports"] = slowest_imports(child_env, args.top_imports)
+
+    write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
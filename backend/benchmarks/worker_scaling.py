@@ -0,0 +1,57 @@
+# GuardCloud Worker Scaling Benchmark
+# Runs the same load test against 1, 2, 4... uvicorn workers and reports
+# how throughput and latency change with the worker count.
+#
+#   cd backend
+#   python -m benchmarks.worker_scaling --workers 1,2,4,8 --concurrency 32 --duration 20
+
+import argparse
+
+from benchmarks import loadtest
+from benchmarks.common import run_server, temp_environment, write_report
+
+# Mostly reads with a steady trickle of writes, like the dashboard
+DEFAULT_MIX = "login=1,list_files=40,search=10,upload_small=8,upload_large=0,download=20,create_share=2,share_info=8,share_download=10"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure throughput as the worker count grows.")
+    parser.add_argument("--workers", default="1,2,4", help="comma separated worker counts")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    runs = []
+    for workers in [int(w) for w in args.workers.split(",")]:
+        load_args = loadtest.build_parser().parse_args([
+            "--workers", str(workers),
+            "--concurrency", str(args.concurrency),
+            "--duration", str(args.duration),
+            "--users", str(args.users),
+            "--mix", args.mix,
+        ])
+        # Fresh database per run so earlier uploads don't skew later ones
+        with temp_environment() as env, run_server(env, workers=workers) as (host, port):
+            report = loadtest.run_loadtest(load_args, host, port)
+
+        runs.append({
+            "workers": workers,
+            "throughput_rps": report["throughput_rps"],
+            "total_errors": report["total_errors"],
+            "p50_ms": {name: e["p50_ms"] for name, e in report["endpoints"].items()},
+            "p95_ms": {name: e["p95_ms"] for name, e in report["endpoints"].items()},
+            "p99_ms": {name: e["p99_ms"] for name, e in report["endpoints"].items()},
+        })
+
+    baseline = runs[0]["throughput_rps"] or 1
+    for run in runs:
+        run["speedup"] = round(run["throughput_rps"] / baseline, 2)
+
+    write_report({"concurrency": args.concurrency, "duration_s": args.duration, "runs": runs}, args.output)
+
+
+if __name__ == "__main__":
+    main()
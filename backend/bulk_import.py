@@ -0,0 +1,247 @@
+# GuardCloud Bulk Import
+# Imports an existing directory tree into a user's files, for onboarding a
+# customer whose data already sits on a file share
+#
+#   cd backend
+#   python bulk_import.py alice /mnt/share --workers 8
+#
+# Directories become folders (merged into folders of the same name that
+# already exist) and files are copied into STORAGE_ROOT by a pool of
+# workers, going through the same blob format as uploads, so they are
+# compressed when STORAGE_COMPRESSION is on. With --link, files are
+# hardlinked instead of copied when compression is off and the source is
+# on the same filesystem; the stored file then IS the source file, so the
+# source must not be changed afterwards.
+#
+# Rows are inserted in one transaction per --batch-size files. Every file
+# of an import is stored under STORAGE_ROOT/<user>/imports/<name>/ with its
+# relative path, so running the same command again after an interruption
+# skips the files whose batch was committed and redoes the rest.
+#
+# Symlinks are skipped. Set EVENT_BROKER like the server's so open browser
+# tabs refresh as batches land.
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import argparse
+import hashlib
+import mimetypes
+import os
+import sys
+import time
+
+import config
+from database import (
+    check_schema,
+    user_exists,
+    get_folder_by_id,
+    get_storage_used,
+    find_or_create_folders,
+    get_stored_paths,
+    save_files_metadata,
+    log_activity,
+)
+import storage
+
+STORAGE_ROOT = Path(os.getenv("STORAGE_ROOT", "storage"))
+
+# Same limit the server enforces on uploads
+STORAGE_LIMIT = int(os.getenv("STORAGE_LIMIT", 15 * 1024 * 1024 * 1024))
+
+
+def default_import_name(source):
+    """A name that stays the same when the same directory is imported again."""
+    source = Path(source).resolve()
+    digest = hashlib.sha256(str(source).encode("utf-8", "surrogateescape")).hexdigest()[:8]
+    return f"{source.name or 'root'}-{digest}"
+
+
+def scan(source, errors):
+    """Walk source. Returns (folders, files) as tuples of relative path parts.
+
+    Folders are listed parents first. Files are (parts, size).
+    """
+    folders = []
+    files = []
+    pending = [()]
+    while pending:
+        parts = pending.pop()
+        try:
+            entries = sorted(os.scandir(Path(source, *parts)), key=lambda e: e.name)
+        except OSError as e:
+            errors.append((Path(source, *parts), str(e)))
+            continue
+        for entry in entries:
+            try:
+                entry.name.encode("utf-8")
+            except UnicodeEncodeError:
+                errors.append((entry.path, "file name is not valid UTF-8"))
+                continue
+            if entry.is_symlink():
+                continue
+            try:
+                if entry.is_dir():
+                    folders.append(parts + (entry.name,))
+                    pending.append(parts + (entry.name,))
+                elif entry.is_file():
+                    files.append((parts + (entry.name,), entry.stat().st_size))
+            except OSError as e:
+                errors.append((entry.path, str(e)))
+    folders.sort(key=len)
+    return folders, files
+
+
+def copy_file(source, dest, link):
+    """Store source at dest. Returns the plaintext size and the codec it is stored with."""
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    if link:
+        # A blob left by an interrupted run is replaced
+        dest.unlink(missing_ok=True)
+        try:
+            os.link(source, dest)
+            return os.path.getsize(dest), storage.CODEC_NONE
+        except OSError:
+            pass  # other filesystem, copy instead
+    with open(source, "rb") as f:
+        size, _, codec = storage.write_blob(dest, f)
+    return size, codec
+
+
+def format_bytes(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+def run_import(owner, source, folder_id=None, name=None, workers=8, batch_size=1000,
+               link=False, ignore_quota=False, progress=print):
+    """Import the directory tree at source into owner's files below folder_id.
+
+    Returns a dict with what was imported, skipped and failed.
+    """
+    source = Path(source)
+    if not source.is_dir():
+        raise ValueError(f"{source} is not a directory")
+    if not user_exists(owner):
+        raise ValueError(f"User {owner} does not exist")
+    if folder_id is not None and not get_folder_by_id(folder_id, owner):
+        raise ValueError(f"Folder {folder_id} not found for {owner}")
+
+    name = name or default_import_name(source)
+    import_root = STORAGE_ROOT / owner / "imports" / name
+    # Hardlinks would make the source file the stored file, which compression rewrites
+    link = link and storage.compression_codec() is None
+
+    errors = []
+    folders, files = scan(source, errors)
+    folder_ids = find_or_create_folders(owner, folder_id, folders)
+
+    # Files whose batch was committed by an earlier run of the same import
+    done = get_stored_paths(owner, str(import_root) + os.sep)
+    pending = [(parts, size) for parts, size in files if str(import_root.joinpath(*parts)) not in done]
+    total_bytes = sum(size for _, size in pending)
+    progress(
+        f"{source}: {len(folders)} folders, {len(files)} files, "
+        f"{len(files) - len(pending)} already imported, {format_bytes(total_bytes)} to go"
+    )
+
+    if not ignore_quota and get_storage_used(owner) + total_bytes > STORAGE_LIMIT:
+        raise ValueError(f"Importing {format_bytes(total_bytes)} would put {owner} over the storage limit")
+
+    def store(task):
+        parts, _ = task
+        try:
+            stored = copy_file(source.joinpath(*parts), import_root.joinpath(*parts), link)
+        except OSError as e:
+            return parts, None, str(e)
+        return parts, stored, None
+
+    imported = 0
+    imported_bytes = 0
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for offset in range(0, len(pending), batch_size):
+            rows = []
+            for parts, stored, error in executor.map(store, pending[offset:offset + batch_size]):
+                if error:
+                    errors.append((source.joinpath(*parts), error))
+                    continue
+                mime_type, _ = mimetypes.guess_type(parts[-1])
+                rows.append({
+                    "filename": parts[-1],
+                    "stored_path": str(import_root.joinpath(*parts)),
+                    "size": stored[0],
+                    "compression": stored[1],
+                    "mime_type": mime_type,
+                    "folder_id": folder_ids[parts[:-1]],
+                })
+            save_files_metadata(owner, rows)
+
+            imported += len(rows)
+            imported_bytes += sum(row["size"] for row in rows)
+            elapsed = time.monotonic() - started
+            rate = imported_bytes / elapsed if elapsed else 0
+            eta = (total_bytes - imported_bytes) / rate if rate else 0
+            progress(
+                f"files: {min(offset + batch_size, len(pending))}/{len(pending)}, "
+                f"{format_bytes(imported_bytes)} at {format_bytes(rate)}/s, eta {eta:.0f}s"
+            )
+
+    if imported:
+        log_activity(
+            owner, "import",
+            target_type="folder", target_id=folder_id, target_name=source.name,
+            details=f"{imported} files", size=imported_bytes,
+        )
+    return {
+        "import": name,
+        "folders": len(folders),
+        "files": len(files),
+        "skipped": len(files) - len(pending),
+        "imported": imported,
+        "bytes": imported_bytes,
+        "errors": [{"path": str(path), "error": error} for path, error in errors],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import a directory tree into a user's files.")
+    parser.add_argument("owner", help="username to import for")
+    parser.add_argument("source", help="directory to import")
+    parser.add_argument("--folder-id", type=int, help="folder to import into, default the root")
+    parser.add_argument("--name", help="import name, reuse it to resume (default from the source path)")
+    parser.add_argument("--workers", type=int, default=8, help="files copied at the same time")
+    parser.add_argument("--batch-size", type=int, default=1000, help="files per database transaction")
+    parser.add_argument("--link", action="store_true", help="hardlink instead of copying where possible")
+    parser.add_argument("--ignore-quota", action="store_true", help="import even past STORAGE_LIMIT")
+    args = parser.parse_args(argv)
+
+    check_schema()
+    try:
+        result = run_import(
+            args.owner, args.source,
+            folder_id=args.folder_id,
+            name=args.name,
+            workers=args.workers,
+            batch_size=args.batch_size,
+            link=args.link,
+            ignore_quota=args.ignore_quota,
+            progress=lambda message: print(message, file=sys.stderr),
+        )
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    for error in result["errors"]:
+        print(f"Failed: {error['path']}: {error['error']}", file=sys.stderr)
+    print(
+        f"Imported {result['imported']} files ({format_bytes(result['bytes'])}) as {result['import']}, "
+        f"{result['skipped']} already there, {len(result['errors'])} failed"
+    )
+    sys.exit(1 if result["errors"] else 0)
+
+
+if __name__ == "__main__":
+    main()
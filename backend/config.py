@@ -0,0 +1,10 @@
+# GuardCloud Config
+# Loads the .env file, once per process
+#
+# Every module that reads its settings from the environment at import time
+# imports this first, so whether .env has been loaded never depends on which
+# module happened to be imported before it.
+
+from dotenv import load_dotenv
+
+load_dotenv()
@@ -14,29 +14,256 @@
 
 from sqlcipher3 import dbapi2 as sqlite3
 from security import authentication
-from dotenv import load_dotenv
+from querylog import QueryLogConnection
+from events import publish
+from contextlib import contextmanager
+import gzip
+import hashlib
+import json
 import os
+import queue
 import secrets
-from datetime import datetime, timedelta
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+import config
 
-load_dotenv()
 db_file = os.getenv("DB_FILE")
 
-def db_connection():
-    """Create a connection to the encrypted SQLCipher database."""
+# How long a connection waits for another worker's write lock before failing
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+
+# NORMAL is safe with WAL: a power loss can only lose the last commits, never corrupt
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+
+# Database files users' files, folders, shares and activity are spread over,
+# see Sharding below. 1 keeps everything in DB_FILE.
+DB_SHARDS = int(os.getenv("DB_SHARDS", "1"))
+
+
+def shard_file(shard, base=None):
+    """Path of a shard's database file. Shard 0 is DB_FILE (or base) itself."""
+    base = base or db_file
+    if shard == 0:
+        return base
+    root, ext = os.path.splitext(base)
+    return f"{root}.shard{shard}{ext}"
+
+
+def open_connection(read_only=False, factory=QueryLogConnection, path=None):
+    """Open a new connection to the encrypted SQLCipher database (DB_FILE by default)."""
     key = os.getenv("SQLCIPHER_KEY")
     if not key:
         raise RuntimeError("Missing SQLCIPHER_KEY environment variable")
 
-    conn = sqlite3.connect(db_file)
+    path = path or db_file
+    conn = sqlite3.connect(
+        path,
+        factory=factory,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+    )
     conn.row_factory = sqlite3.Row
     conn.execute(f"PRAGMA key = '{key}';")
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+    if read_only:
+        conn.execute("PRAGMA query_only = ON")
     return conn
 
 
-def Initialize_db():
+class PooledConnection(QueryLogConnection):
+    """Connection that goes back to its pool when closed instead of closing."""
+
+    pool = None
+    shard = 0
+
+    def close(self):
+        if self.pool is None:
+            super().close()
+        else:
+            self.finish_statements()
+            self.pool.release(self)
+
+    def discard(self):
+        """Really close the connection."""
+        self.pool = None
+        super().close()
+
+
+class ConnectionPool:
+    """Keeps up to `size` open connections around for reuse.
+
+    Opening a SQLCipher connection derives the key from SQLCIPHER_KEY, which
+    is far slower than most of our queries, so we only want to pay it once
+    per connection. The pool never blocks: if every connection is busy a new
+    one is opened, and extra connections are closed when they come back.
+    """
+
+    def __init__(self, size, read_only=False, shard=0):
+        self.size = size
+        self.read_only = read_only
+        self.shard = shard
+        self.idle = queue.LifoQueue()
+
+    def acquire(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = open_connection(self.read_only, factory=PooledConnection, path=shard_file(self.shard))
+            conn.shard = self.shard
+        conn.pool = self
+        return conn
+
+    def release(self, conn):
+        try:
+            # Throw away anything a failed function left uncommitted
+            conn.rollback()
+        except sqlite3.Error:
+            conn.discard()
+            return
+        if self.idle.qsize() < self.size:
+            self.idle.put_nowait(conn)
+        else:
+            conn.discard()
+
+    def clear(self):
+        """Close all idle connections."""
+        while True:
+            try:
+                self.idle.get_nowait().discard()
+            except queue.Empty:
+                return
+
+
+# Reads get their own query_only connections. With WAL they run alongside
+# the writer, so listing traffic never waits on uploads or log inserts.
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "8"))
+DB_WRITE_POOL_SIZE = int(os.getenv("DB_WRITE_POOL_SIZE", "2"))
+
+read_pool = ConnectionPool(DB_READ_POOL_SIZE, read_only=True)
+write_pool = ConnectionPool(DB_WRITE_POOL_SIZE)
+
+# Pools of the other shards, opened when first used
+_shard_pools = {(0, True): read_pool, (0, False): write_pool}
+_shard_pools_lock = threading.Lock()
+
+
+def shard_pool(shard, read_only):
+    """The read or write pool of a shard's database."""
+    pool = _shard_pools.get((shard, read_only))
+    if pool is None:
+        with _shard_pools_lock:
+            pool = _shard_pools.setdefault(
+                (shard, read_only),
+                ConnectionPool(DB_READ_POOL_SIZE if read_only else DB_WRITE_POOL_SIZE, read_only, shard),
+            )
+    return pool
+
+
+def db_connection(owner=None, shard=None):
+    """Get a connection for functions that write to the database.
+
+    Pass the owner of what gets written to land on their shard, or a shard
+    number. Without either it is DB_FILE, which also holds users, share
+    tokens and token revocations.
+    """
+    if shard is None:
+        shard = user_shard(owner, write=True) if owner else 0
+    return shard_pool(shard, False).acquire()
+
+
+def db_read_connection(owner=None, shard=None):
+    """Get a read-only connection for functions that only query, see db_connection."""
+    if shard is None:
+        shard = user_shard(owner) if owner else 0
+    return shard_pool(shard, True).acquire()
+
+
+def fetch_columnar(cursor):
+    """Fetch the rest of a query as {"columns": [...], "rows": [[...], ...]}.
+
+    Rows come straight from SQLite as tuples, no dict is built per row.
+    Values are left as stored, so flags like is_trashed stay 0/1.
+    """
+    cursor.row_factory = None
+    rows = cursor.fetchall()
+    return {"columns": [col[0] for col in cursor.description], "rows": rows}
+
+
+@contextmanager
+def schema_lock(path=None):
+    """Cross-process lock so only one worker at a time initializes the schema."""
+    with open(f"{path or db_file}.lock", "a+b") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def Initialize_db(shard=0):
+    """Set up the database once, no matter how many workers start at the same time."""
+    with schema_lock(shard_file(shard)):
+        conn = db_connection(shard=shard)
+
+        # WAL lets readers run while a writer commits, the setting sticks to the file
+        conn.execute("PRAGMA journal_mode = WAL")
+
+        # Run each migration the database hasn't seen yet, in order
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, migrate in enumerate(MIGRATIONS, start=1):
+            if version < number:
+                migrate(conn)
+                conn.execute(f"PRAGMA user_version = {number}")
+                conn.commit()
+        conn.close()
+
+
+def check_schema():
+    """Make sure the schema is current, migrating only if it is behind.
+
+    An up to date database costs one PRAGMA, so a worker starting up doesn't
+    take the schema lock or touch the DDL. Fails if the database was migrated
+    by a newer version of the server. Every shard is checked, DB_FILE first
+    since it says which other shards are in use.
+    """
+    check_shard_schema(0)
+    for shard in all_shards()[1:]:
+        check_shard_schema(shard)
+
+
+def check_shard_schema(shard):
+    """check_schema for a single shard, creating its database if it's new."""
+    conn = db_read_connection(shard=shard)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    conn.close()
+    if version > len(MIGRATIONS):
+        raise RuntimeError(
+            f"Database schema version {version} of {shard_file(shard)} is newer than "
+            f"this server supports ({len(MIGRATIONS)})"
+        )
+    if version < len(MIGRATIONS):
+        Initialize_db(shard)
+
+
+def create_schema(conn):
     """Create all tables if they don't exist."""
-    conn = db_connection()
     cursor = conn.cursor()
 
     # Users table
@@ -113,8 +340,8 @@ def Initialize_db():
     try:
         cursor.execute("ALTER TABLE share_links ADD COLUMN share_stored_path TEXT")
         conn.commit()
-    except:
-        pass
+    except sqlite3.OperationalError:
+        pass  # already there
 
     # Activity log table
     cursor.execute(
@@ -134,14 +361,376 @@ def Initialize_db():
     )
 
     conn.commit()
-    conn.close()
+
+
+def add_change_journal(conn):
+    """Add the sync change journal and record every existing file and folder in it."""
+    cursor = conn.cursor()
+
+    # One row per change to a file or folder, seq only ever goes up
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS change_journal(
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            entity_type TEXT NOT NULL,
+            entity_id INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_change_journal_user_seq ON change_journal(username, seq)"
+    )
+
+    # Compacted journal: only the latest change per file or folder
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS journal_snapshot(
+            username TEXT NOT NULL,
+            entity_type TEXT NOT NULL,
+            entity_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            PRIMARY KEY (username, entity_type, entity_id)
+        )
+        """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_journal_snapshot_user_seq ON journal_snapshot(username, seq)"
+    )
+
+    backfill_change_journal(conn)
+    conn.commit()
+
+
+def add_token_revocations(conn):
+    """Add the table of revoked login tokens."""
+    cursor = conn.cursor()
+
+    # A row with a jti revokes that one token. A row without one revokes every
+    # token the user got before not_before (password change). Rows are only
+    # needed until expires_at, after that the tokens are expired anyway.
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS token_revocations(
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            jti TEXT,
+            not_before REAL,
+            expires_at REAL NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+    conn.commit()
+
+
+def add_share_copies(conn):
+    """Add shared, reference counted share copies and adopt the existing ones."""
+    cursor = conn.cursor()
+
+    # One decrypted copy per file and content hash, used by ref_count links
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS share_copies(
+            id INTEGER PRIMARY KEY,
+            file_id INTEGER NOT NULL,
+            content_hash TEXT NOT NULL,
+            stored_path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (file_id, content_hash)
+        )
+        """
+    )
+    cursor.execute("ALTER TABLE share_links ADD COLUMN share_copy_id INTEGER REFERENCES share_copies(id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_share_links_copy ON share_links(share_copy_id)")
+
+    # Older copies were made per link and we don't know their hash, give
+    # each its own entry so deleting the link collects it
+    cursor.execute("SELECT id, file_id, share_stored_path FROM share_links WHERE share_stored_path IS NOT NULL")
+    for link in cursor.fetchall():
+        path = link["share_stored_path"]
+        cursor.execute(
+            """INSERT INTO share_copies (file_id, content_hash, stored_path, size, ref_count)
+               VALUES (?, ?, ?, ?, 1)""",
+            (link["file_id"], f"link-{link['id']}", path, os.path.getsize(path) if os.path.exists(path) else 0),
+        )
+        cursor.execute(
+            "UPDATE share_links SET share_copy_id = ? WHERE id = ?",
+            (cursor.lastrowid, link["id"]),
+        )
+    conn.commit()
+
+
+def partition_activity_log(conn):
+    """Move activity_log into monthly partitions and drop it."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT DISTINCT substr(COALESCE(created_at, CURRENT_TIMESTAMP), 1, 7) AS month FROM activity_log")
+    for month in [row["month"] for row in cursor.fetchall()]:
+        name = ensure_activity_partition(cursor, activity_partition_name(month))[0]
+        cursor.execute(
+            f"""INSERT INTO {name} (id, username, action, target_type, target_id, target_name,
+                                  details, ip_address, created_at)
+                SELECT id, username, action, target_type, target_id, target_name,
+                       details, ip_address, COALESCE(created_at, CURRENT_TIMESTAMP)
+                FROM activity_log
+                WHERE substr(COALESCE(created_at, CURRENT_TIMESTAMP), 1, 7) = ?""",
+            (month,),
+        )
+    cursor.execute("DROP TABLE activity_log")
+    conn.commit()
+
+
+def add_activity_rollups(conn):
+    """Add the daily activity rollups and a size column to activity partitions."""
+    cursor = conn.cursor()
+    for partition in activity_partitions(cursor):
+        columns = [row["name"] for row in cursor.execute(f"PRAGMA table_info({partition})").fetchall()]
+        if "size" not in columns:
+            cursor.execute(f"ALTER TABLE {partition} ADD COLUMN size INTEGER")
+
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS activity_daily(
+            day TEXT NOT NULL,
+            username TEXT NOT NULL,
+            action TEXT NOT NULL,
+            events INTEGER NOT NULL DEFAULT 0,
+            bytes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, username, action)
+        )
+        """
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_activity_daily_user_day ON activity_daily(username, day)")
+
+    # Highest activity id already folded into activity_daily, per partition
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS activity_rollup_state(
+            partition_name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL
+        )
+        """
+    )
+    conn.commit()
+
+
+# Storage category of a file by its mime type, used by the storage_usage triggers
+MIME_CATEGORY_SQL = """CASE
+    WHEN {m} LIKE 'image/%' THEN 'images'
+    WHEN {m} LIKE 'video/%' THEN 'videos'
+    WHEN {m} LIKE 'audio/%' THEN 'audio'
+    WHEN {m} LIKE 'text/%' OR {m} IN ('application/pdf', 'application/msword', 'application/rtf')
+         OR {m} LIKE 'application/vnd.openxmlformats-officedocument.%'
+         OR {m} LIKE 'application/vnd.ms-%'
+         OR {m} LIKE 'application/vnd.oasis.opendocument.%' THEN 'documents'
+    WHEN {m} IN ('application/zip', 'application/gzip', 'application/x-tar', 'application/x-7z-compressed',
+                 'application/x-rar-compressed', 'application/vnd.rar', 'application/x-bzip2',
+                 'application/x-xz') THEN 'archives'
+    ELSE 'other'
+END"""
+
+
+def add_storage_usage(conn):
+    """Add per-user storage totals by category, kept up to date by triggers on files."""
+    cursor = conn.cursor()
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_owner_size ON files(owner, size)")
+
+    # Bytes and file count per owner, category and trashed state
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS storage_usage(
+            owner TEXT NOT NULL,
+            category TEXT NOT NULL,
+            is_trashed INTEGER NOT NULL,
+            bytes INTEGER NOT NULL DEFAULT 0,
+            files INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (owner, category, is_trashed)
+        )
+        """
+    )
+
+    # The triggers run inside the statement that changes files, so every
+    # write path (including bulk trash and delete of folders) keeps the
+    # totals exact without anything having to remember to update them
+    add_new = f"""
+        INSERT INTO storage_usage (owner, category, is_trashed, bytes, files)
+        VALUES (NEW.owner, {MIME_CATEGORY_SQL.format(m="NEW.mime_type")}, COALESCE(NEW.is_trashed, 0), NEW.size, 1)
+        ON CONFLICT (owner, category, is_trashed)
+        DO UPDATE SET bytes = bytes + excluded.bytes, files = files + 1;
+    """
+    remove_old = f"""
+        UPDATE storage_usage SET bytes = bytes - OLD.size, files = files - 1
+        WHERE owner = OLD.owner
+          AND category = {MIME_CATEGORY_SQL.format(m="OLD.mime_type")}
+          AND is_trashed = COALESCE(OLD.is_trashed, 0);
+    """
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS files_usage_insert AFTER INSERT ON files BEGIN {add_new} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS files_usage_delete AFTER DELETE ON files BEGIN {remove_old} END")
+    cursor.execute(
+        f"""CREATE TRIGGER IF NOT EXISTS files_usage_update
+            AFTER UPDATE OF owner, size, mime_type, is_trashed ON files
+            BEGIN {remove_old} {add_new} END"""
+    )
+
+    cursor.execute("DELETE FROM storage_usage")
+    cursor.execute(
+        f"""INSERT INTO storage_usage (owner, category, is_trashed, bytes, files)
+            SELECT owner, {MIME_CATEGORY_SQL.format(m="mime_type")}, COALESCE(is_trashed, 0), SUM(size), COUNT(*)
+            FROM files
+            GROUP BY 1, 2, 3"""
+    )
+    conn.commit()
+
+
+# A folder and all of its ancestors, starting from the folder id {start}.
+# UNION stops on a cycle instead of looping forever.
+FOLDER_CHAIN_SQL = """WITH RECURSIVE chain(id) AS (
+    SELECT {start}
+    UNION
+    SELECT f.parent_id FROM folders f JOIN chain ON f.id = chain.id WHERE f.parent_id IS NOT NULL
+) SELECT id FROM chain"""
+
+
+def add_folder_totals(conn):
+    """Add subtree byte and file counters to folders, kept up to date by triggers."""
+    cursor = conn.cursor()
+    cursor.execute("ALTER TABLE folders ADD COLUMN subtree_bytes INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("ALTER TABLE folders ADD COLUMN subtree_files INTEGER NOT NULL DEFAULT 0")
+
+    # Files outside the trash count towards their folder and every folder above it
+    add_file = f"""
+        UPDATE folders SET subtree_bytes = subtree_bytes + NEW.size, subtree_files = subtree_files + 1
+        WHERE NEW.is_trashed = 0 AND id IN ({FOLDER_CHAIN_SQL.format(start="NEW.folder_id")});
+    """
+    remove_file = f"""
+        UPDATE folders SET subtree_bytes = subtree_bytes - OLD.size, subtree_files = subtree_files - 1
+        WHERE OLD.is_trashed = 0 AND id IN ({FOLDER_CHAIN_SQL.format(start="OLD.folder_id")});
+    """
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS files_folder_insert AFTER INSERT ON files BEGIN {add_file} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS files_folder_delete AFTER DELETE ON files BEGIN {remove_file} END")
+    cursor.execute(
+        f"""CREATE TRIGGER IF NOT EXISTS files_folder_update
+            AFTER UPDATE OF folder_id, size, is_trashed ON files
+            BEGIN {remove_file} {add_file} END"""
+    )
+
+    # A moved or deleted folder takes its totals away from its old ancestors
+    remove_folder = f"""
+        UPDATE folders SET subtree_bytes = subtree_bytes - OLD.subtree_bytes,
+                           subtree_files = subtree_files - OLD.subtree_files
+        WHERE id IN ({FOLDER_CHAIN_SQL.format(start="OLD.parent_id")});
+    """
+    add_folder = f"""
+        UPDATE folders SET subtree_bytes = subtree_bytes + NEW.subtree_bytes,
+                           subtree_files = subtree_files + NEW.subtree_files
+        WHERE id IN ({FOLDER_CHAIN_SQL.format(start="NEW.parent_id")});
+    """
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS folders_totals_delete AFTER DELETE ON folders BEGIN {remove_folder} END")
+    cursor.execute(
+        f"""CREATE TRIGGER IF NOT EXISTS folders_totals_move AFTER UPDATE OF parent_id ON folders
+            WHEN OLD.parent_id IS NOT NEW.parent_id
+            BEGIN {remove_folder} {add_folder} END"""
+    )
+
+    recount_folder_totals(cursor)
+    conn.commit()
+
+
+def recount_folder_totals(cursor):
+    """Recompute every folder's subtree totals from the files table."""
+    cursor.execute(
+        """UPDATE folders SET subtree_bytes = COALESCE(totals.bytes, 0), subtree_files = COALESCE(totals.files, 0)
+           FROM (SELECT folders.id AS id, t.bytes AS bytes, t.files AS files
+                 FROM folders LEFT JOIN (
+                     WITH RECURSIVE chain(folder_id, ancestor) AS (
+                         SELECT id, id FROM folders
+                         UNION
+                         SELECT chain.folder_id, f.parent_id
+                         FROM chain JOIN folders f ON f.id = chain.ancestor
+                         WHERE f.parent_id IS NOT NULL
+                     )
+                     SELECT chain.ancestor AS id, SUM(direct.bytes) AS bytes, SUM(direct.files) AS files
+                     FROM chain
+                     JOIN (SELECT folder_id, SUM(size) AS bytes, COUNT(*) AS files
+                           FROM files
+                           WHERE is_trashed = 0 AND folder_id IS NOT NULL
+                           GROUP BY folder_id) direct ON direct.folder_id = chain.folder_id
+                     GROUP BY chain.ancestor
+                 ) t ON t.id = folders.id) AS totals
+           WHERE folders.id = totals.id"""
+    )
+
+
+def add_sharding(conn):
+    """Add the shard directory and the share token index, see Sharding.
+
+    Every shard gets them, only the ones in DB_FILE are used.
+    """
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_shards(
+            username TEXT PRIMARY KEY,
+            shard INTEGER NOT NULL,
+            moving INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_shards_shard ON user_shards(shard)")
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS share_index(
+            token TEXT PRIMARY KEY,
+            owner TEXT NOT NULL
+        )
+        """
+    )
+    conn.commit()
+
+
+def add_file_compression(conn):
+    """Record how each upload is stored, instead of going by the blob's header.
+
+    Uploads are the users' own bytes and can start with any header. Blobs
+    stored before this are checked once here, going by their header.
+    """
+    import storage
+
+    cursor = conn.cursor()
+    cursor.execute(f"ALTER TABLE files ADD COLUMN compression INTEGER NOT NULL DEFAULT {storage.CODEC_NONE}")
+    rows = cursor.execute("SELECT id, stored_path FROM files").fetchall()
+    cursor.executemany(
+        "UPDATE files SET compression = ? WHERE id = ?",
+        [(codec, row["id"]) for row in rows if (codec := storage.detect_compression(row["stored_path"]))],
+    )
+    conn.commit()
+
+
+# Schema migrations, applied in order by Initialize_db. Only ever append.
+MIGRATIONS = [
+    create_schema,
+    add_change_journal,
+    add_token_revocations,
+    add_share_copies,
+    partition_activity_log,
+    add_activity_rollups,
+    add_storage_usage,
+    add_folder_totals,
+    add_sharding,
+    add_file_compression,
+]
 
 
 # ============== User Functions ==============
 
 def user_exists(username):
     """Check if a username is already taken."""
-    conn = db_connection()
+    conn = db_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT 1 FROM users WHERE username = ?", (username,))
     user = cursor.fetchone()
@@ -167,6 +756,11 @@ def signup_db(username, password_hash, email=None):
         "INSERT INTO users (username, password, email) VALUES (?, ?, ?)",
         (username, password_hash, email),
     )
+    if DB_SHARDS > 1:
+        cursor.execute(
+            "INSERT OR IGNORE INTO user_shards (username, shard) VALUES (?, ?)",
+            (username, placement(username)),
+        )
     conn.commit()
     conn.close()
     return True
@@ -174,7 +768,7 @@ def signup_db(username, password_hash, email=None):
 
 def login_db(username, password):
     """Verify login credentials."""
-    conn = db_connection()
+    conn = db_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT password FROM users WHERE username = ?", (username,))
     user = cursor.fetchone()
@@ -187,7 +781,7 @@ def login_db(username, password):
 
 def get_user_info(username):
     """Get user profile data."""
-    conn = db_connection()
+    conn = db_read_connection()
     cursor = conn.cursor()
     cursor.execute(
         "SELECT id, username, email, created_at FROM users WHERE username = ?",
@@ -216,6 +810,7 @@ def update_user_email(username, email):
     )
     conn.commit()
     conn.close()
+    publish(username, "user.updated", {"email": email})
     return True
 
 
@@ -239,18 +834,27 @@ This meets Functional Requirement #4:
 FR-4: The user SHALL be able to upload files in the file management system.
 """
 
-def save_file_metadata(owner, filename, stored_path, size, mime_type=None, folder_id=None):
-    """Save file info to database after upload."""
-    conn = db_connection()
+def save_file_metadata(owner, filename, stored_path, size, mime_type=None, folder_id=None, compression=0):
+    """Save file info to database after upload. compression is the codec storage.write_blob used."""
+    conn = db_connection(owner)
     cursor = conn.cursor()
     cursor.execute(
-        """INSERT INTO files (owner, filename, stored_path, size, mime_type, folder_id)
-           VALUES (?, ?, ?, ?, ?, ?)""",
-        (owner, filename, stored_path, size, mime_type, folder_id),
+        f"""INSERT INTO files (id, owner, filename, stored_path, size, mime_type, folder_id, compression)
+            VALUES ({new_id_sql(conn, "files")}, ?, ?, ?, ?, ?, ?, ?)""",
+        (owner, filename, stored_path, size, mime_type, folder_id, compression),
     )
     file_id = cursor.lastrowid
+    journal_change(cursor, owner, "file", file_id)
     conn.commit()
     conn.close()
+    publish(owner, "file.created", {
+        "id": file_id,
+        "filename": filename,
+        "size": size,
+        "mime_type": mime_type,
+        "folder_id": folder_id,
+    })
+    publish(owner, "usage.changed")
     return file_id
 
 
@@ -259,9 +863,13 @@ This meets Functional Requirement #3:
 FR-3: The user SHALL be presented with a file management system after successfully logging in.
 """
 
-def get_user_files(owner, folder_id=None, include_trashed=False):
-    """Get files for a user in a specific folder."""
-    conn = db_connection()
+def get_user_files(owner, folder_id=None, include_trashed=False, compact=False):
+    """Get files for a user in a specific folder.
+
+    With compact=True returns {"columns", "rows"} instead of a list of dicts,
+    see fetch_columnar.
+    """
+    conn = db_read_connection(owner)
     cursor = conn.cursor()
     
     if include_trashed:
@@ -299,6 +907,11 @@ def get_user_files(owner, folder_id=None, include_trashed=False):
                 (owner, folder_id),
             )
     
+    if compact:
+        result = fetch_columnar(cursor)
+        conn.close()
+        return result
+
     rows = cursor.fetchall()
     conn.close()
 
@@ -317,9 +930,9 @@ def get_user_files(owner, folder_id=None, include_trashed=False):
     ]
 
 
-def get_trashed_files(owner):
+def get_trashed_files(owner, compact=False):
     """Get all files in trash."""
-    conn = db_connection()
+    conn = db_read_connection(owner)
     cursor = conn.cursor()
     cursor.execute(
         """SELECT id, filename, size, mime_type, folder_id, trashed_at, created_at
@@ -328,6 +941,10 @@ def get_trashed_files(owner):
            ORDER BY trashed_at DESC""",
         (owner,),
     )
+    if compact:
+        result = fetch_columnar(cursor)
+        conn.close()
+        return result
     rows = cursor.fetchall()
     conn.close()
 
@@ -351,14 +968,15 @@ FR-8: The user SHALL be able to view file information via the web app.
 FR-15: The user SHALL be able to view file details.
 """
 
+FILE_COLUMNS = "id, owner, filename, stored_path, size, mime_type, folder_id, is_trashed, compression"
+
+
 def get_file_by_id(file_id, owner):
     """Get a single file's details."""
-    conn = db_connection()
+    conn = db_read_connection(owner)
     cursor = conn.cursor()
     cursor.execute(
-        """SELECT id, owner, filename, stored_path, size, mime_type, folder_id, is_trashed
-           FROM files
-           WHERE id = ? AND owner = ?""",
+        f"SELECT {FILE_COLUMNS} FROM files WHERE id = ? AND owner = ?",
         (file_id, owner),
     )
     row = cursor.fetchone()
@@ -374,18 +992,8 @@ FR-11: The user SHALL be able to manage files.
 
 def rename_file(file_id, owner, new_filename):
     """Change a file's name."""
-    conn = db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        """UPDATE files 
-           SET filename = ?, updated_at = CURRENT_TIMESTAMP 
-           WHERE id = ? AND owner = ?""",
-        (new_filename, file_id, owner),
-    )
-    affected = cursor.rowcount
-    conn.commit()
-    conn.close()
-    return affected > 0
+    with UnitOfWork(owner) as work:
+        return work.rename_file(file_id, new_filename) is not None
 
 
 """
@@ -395,18 +1003,8 @@ FR-16: The user SHALL be able to view the location of files.
 
 def move_file(file_id, owner, folder_id):
     """Move a file to a different folder."""
-    conn = db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        """UPDATE files 
-           SET folder_id = ?, updated_at = CURRENT_TIMESTAMP 
-           WHERE id = ? AND owner = ?""",
-        (folder_id, file_id, owner),
-    )
-    affected = cursor.rowcount
-    conn.commit()
-    conn.close()
-    return affected > 0
+    with UnitOfWork(owner) as work:
+        return work.move_file(file_id, folder_id) is not None
 
 
 """
@@ -416,65 +1014,25 @@ FR-13: The user SHALL be able to delete files.
 
 def trash_file(file_id, owner):
     """Move a file to trash."""
-    conn = db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        """UPDATE files 
-           SET is_trashed = 1, trashed_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP 
-           WHERE id = ? AND owner = ?""",
-        (file_id, owner),
-    )
-    affected = cursor.rowcount
-    conn.commit()
-    conn.close()
-    return affected > 0
+    with UnitOfWork(owner) as work:
+        return work.trash_file(file_id) is not None
 
 
 def restore_file(file_id, owner):
     """Restore a file from trash."""
-    conn = db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        """UPDATE files 
-           SET is_trashed = 0, trashed_at = NULL, updated_at = CURRENT_TIMESTAMP 
-           WHERE id = ? AND owner = ?""",
-        (file_id, owner),
-    )
-    affected = cursor.rowcount
-    conn.commit()
-    conn.close()
-    return affected > 0
+    with UnitOfWork(owner) as work:
+        return work.restore_file(file_id) is not None
 
 
 def delete_file_permanent(file_id, owner):
-    """Permanently delete a file."""
-    conn = db_connection()
-    cursor = conn.cursor()
-    
-    # Get file path first
-    cursor.execute(
-        "SELECT stored_path FROM files WHERE id = ? AND owner = ?",
-        (file_id, owner),
-    )
-    row = cursor.fetchone()
-    
-    if row:
-        # Delete from database
-        cursor.execute(
-            "DELETE FROM files WHERE id = ? AND owner = ?",
-            (file_id, owner),
-        )
-        # Delete share links too
-        cursor.execute(
-            "DELETE FROM share_links WHERE file_id = ?",
-            (file_id,),
-        )
-        conn.commit()
-        conn.close()
-        return row["stored_path"]
-    
-    conn.close()
-    return None
+    """Permanently delete a file.
+
+    Returns the stored paths of the file and its share copies, to remove
+    from disk, or None if there was no such file.
+    """
+    with UnitOfWork(owner) as work:
+        row = work.delete_file(file_id)
+    return [row["stored_path"]] + work.share_copy_paths if row else None
 
 
 """
@@ -482,9 +1040,9 @@ This meets Functional Requirement #10:
 FR-10: The user SHALL be able find files using a search function.
 """
 
-def search_files(owner, query):
+def search_files(owner, query, compact=False):
     """Search files by name."""
-    conn = db_connection()
+    conn = db_read_connection(owner)
     cursor = conn.cursor()
     cursor.execute(
         """SELECT id, filename, size, mime_type, folder_id, created_at
@@ -494,6 +1052,10 @@ def search_files(owner, query):
            LIMIT 50""",
         (owner, f"%{query}%"),
     )
+    if compact:
+        result = fetch_columnar(cursor)
+        conn.close()
+        return result
     rows = cursor.fetchall()
     conn.close()
 
@@ -514,27 +1076,29 @@ def search_files(owner, query):
 
 def create_folder(owner, name, parent_id=None):
     """Create a new folder."""
-    conn = db_connection()
+    conn = db_connection(owner)
     cursor = conn.cursor()
     cursor.execute(
-        """INSERT INTO folders (owner, name, parent_id)
-           VALUES (?, ?, ?)""",
+        f"""INSERT INTO folders (id, owner, name, parent_id)
+            VALUES ({new_id_sql(conn, "folders")}, ?, ?, ?)""",
         (owner, name, parent_id),
     )
     folder_id = cursor.lastrowid
+    journal_change(cursor, owner, "folder", folder_id)
     conn.commit()
     conn.close()
+    publish(owner, "folder.created", {"id": folder_id, "name": name, "parent_id": parent_id})
     return folder_id
 
 
-def get_folders(owner, parent_id=None):
+def get_folders(owner, parent_id=None, compact=False):
     """Get folders in a specific directory."""
-    conn = db_connection()
+    conn = db_read_connection(owner)
     cursor = conn.cursor()
     
     if parent_id is None:
         cursor.execute(
-            """SELECT id, name, parent_id, created_at
+            """SELECT id, name, parent_id, created_at, subtree_bytes, subtree_files
                FROM folders
                WHERE owner = ? AND parent_id IS NULL AND is_trashed = 0
                ORDER BY name""",
@@ -542,13 +1106,18 @@ def get_folders(owner, parent_id=None):
         )
     else:
         cursor.execute(
-            """SELECT id, name, parent_id, created_at
+            """SELECT id, name, parent_id, created_at, subtree_bytes, subtree_files
                FROM folders
                WHERE owner = ? AND parent_id = ? AND is_trashed = 0
                ORDER BY name""",
             (owner, parent_id),
         )
     
+    if compact:
+        result = fetch_columnar(cursor)
+        conn.close()
+        return result
+
     rows = cursor.fetchall()
     conn.close()
 
@@ -558,19 +1127,22 @@ def get_folders(owner, parent_id=None):
             "name": row["name"],
             "parent_id": row["parent_id"],
             "created_at": row["created_at"],
+            "subtree_bytes": row["subtree_bytes"],
+            "subtree_files": row["subtree_files"],
         }
         for row in rows
     ]
 
 
+FOLDER_COLUMNS = "id, name, parent_id, created_at, subtree_bytes, subtree_files"
+
+
 def get_folder_by_id(folder_id, owner):
     """Get a single folder's details."""
-    conn = db_connection()
+    conn = db_read_connection(owner)
     cursor = conn.cursor()
     cursor.execute(
-        """SELECT id, name, parent_id, created_at
-           FROM folders
-           WHERE id = ? AND owner = ?""",
+        f"SELECT {FOLDER_COLUMNS} FROM folders WHERE id = ? AND owner = ?",
         (folder_id, owner),
     )
     row = cursor.fetchone()
@@ -582,13 +1154,15 @@ def get_folder_by_id(folder_id, owner):
             "name": row["name"],
             "parent_id": row["parent_id"],
             "created_at": row["created_at"],
+            "subtree_bytes": row["subtree_bytes"],
+            "subtree_files": row["subtree_files"],
         }
     return None
 
 
 def rename_folder(folder_id, owner, new_name):
     """Change a folder's name."""
-    conn = db_connection()
+    conn = db_connection(owner)
     cursor = conn.cursor()
     cursor.execute(
         """UPDATE folders 
@@ -597,14 +1171,42 @@ def rename_folder(folder_id, owner, new_name):
         (new_name, folder_id, owner),
     )
     affected = cursor.rowcount
+    if affected:
+        journal_change(cursor, owner, "folder", folder_id)
+    conn.commit()
+    conn.close()
+    if affected:
+        publish(owner, "folder.updated", {"id": folder_id, "name": new_name})
+    return affected > 0
+
+
+def move_folder(folder_id, owner, parent_id):
+    """Move a folder under another folder (None for the root).
+
+    Refuses to move a folder into itself or one of its own subfolders.
+    """
+    conn = db_connection(owner)
+    cursor = conn.cursor()
+    cursor.execute(
+        f"""UPDATE folders
+            SET parent_id = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND owner = ?
+              AND (? IS NULL OR ? NOT IN ({FOLDER_CHAIN_SQL.format(start="?")}))""",
+        (parent_id, folder_id, owner, parent_id, folder_id, parent_id),
+    )
+    affected = cursor.rowcount
+    if affected:
+        journal_change(cursor, owner, "folder", folder_id)
     conn.commit()
     conn.close()
+    if affected:
+        publish(owner, "folder.moved", {"id": folder_id, "parent_id": parent_id})
     return affected > 0
 
 
 def trash_folder(folder_id, owner):
     """Move a folder and its contents to trash."""
-    conn = db_connection()
+    conn = db_connection(owner)
     cursor = conn.cursor()
     
     # Trash folder
@@ -614,6 +1216,7 @@ def trash_folder(folder_id, owner):
            WHERE id = ? AND owner = ?""",
         (folder_id, owner),
     )
+    trashed = cursor.rowcount
     
     # Trash files inside
     cursor.execute(
@@ -622,15 +1225,24 @@ def trash_folder(folder_id, owner):
            WHERE folder_id = ? AND owner = ?""",
         (folder_id, owner),
     )
+
+    if trashed:
+        journal_change(cursor, owner, "folder", folder_id)
+        journal_folder_files(cursor, owner, folder_id)
     
     conn.commit()
     conn.close()
+    publish(owner, "folder.trashed", {"id": folder_id})
+    publish(owner, "usage.changed")
     return True
 
 
 def delete_folder_permanent(folder_id, owner):
-    """Permanently delete a folder and all files in it."""
-    conn = db_connection()
+    """Permanently delete a folder and all files in it.
+
+    Returns the stored paths of the files and their share copies, to remove from disk.
+    """
+    conn = db_connection(owner)
     cursor = conn.cursor()
     
     # Get file paths
@@ -639,7 +1251,22 @@ def delete_folder_permanent(folder_id, owner):
         (folder_id, owner),
     )
     file_paths = [row["stored_path"] for row in cursor.fetchall()]
+    journal_folder_files(cursor, owner, folder_id, "delete")
     
+    # Delete their share links and share copies
+    cursor.execute(
+        """DELETE FROM share_links WHERE file_id IN (SELECT id FROM files WHERE folder_id = ? AND owner = ?)
+           RETURNING token""",
+        (folder_id, owner),
+    )
+    tokens = [link["token"] for link in cursor.fetchall()]
+    cursor.execute(
+        """DELETE FROM share_copies WHERE file_id IN (SELECT id FROM files WHERE folder_id = ? AND owner = ?)
+           RETURNING stored_path""",
+        (folder_id, owner),
+    )
+    file_paths += [copy["stored_path"] for copy in cursor.fetchall()]
+
     # Delete files
     cursor.execute(
         "DELETE FROM files WHERE folder_id = ? AND owner = ?",
@@ -651,16 +1278,21 @@ def delete_folder_permanent(folder_id, owner):
         "DELETE FROM folders WHERE id = ? AND owner = ?",
         (folder_id, owner),
     )
+    if cursor.rowcount:
+        journal_change(cursor, owner, "folder", folder_id, "delete")
     
     conn.commit()
     conn.close()
+    unindex_share_tokens(tokens)
+    publish(owner, "folder.deleted", {"id": folder_id})
+    publish(owner, "usage.changed")
     return file_paths
 
 
 def get_folder_path(folder_id, owner):
     """Build breadcrumb path for a folder."""
     path = []
-    conn = db_connection()
+    conn = db_read_connection(owner)
     cursor = conn.cursor()
     
     current_id = folder_id
@@ -680,6 +1312,129 @@ def get_folder_path(folder_id, owner):
     return path
 
 
+# ============== Bulk Import ==============
+
+def find_or_create_folders(owner, parent_id, paths):
+    """Get folder ids for a tree of folders below parent_id, creating missing ones.
+
+    paths are tuples of folder names relative to parent_id, each listed after
+    its parent. Folders that already exist (and aren't trashed) are reused,
+    so importing into the same place again merges. Returns {path: folder_id}.
+    """
+    conn = db_connection(owner)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT id, name, parent_id FROM folders WHERE owner = ? AND is_trashed = 0 ORDER BY id DESC",
+        (owner,),
+    )
+    # Oldest folder wins when names repeat
+    existing = {(row["parent_id"], row["name"]): row["id"] for row in cursor.fetchall()}
+
+    ids = {(): parent_id}
+    created = 0
+    for path in paths:
+        parent = ids[path[:-1]]
+        folder_id = existing.get((parent, path[-1]))
+        if folder_id is None:
+            cursor.execute(
+                f"INSERT INTO folders (id, owner, name, parent_id) VALUES ({new_id_sql(conn, 'folders')}, ?, ?, ?)",
+                (owner, path[-1], parent),
+            )
+            folder_id = cursor.lastrowid
+            journal_change(cursor, owner, "folder", folder_id)
+            created += 1
+        ids[path] = folder_id
+    conn.commit()
+    conn.close()
+    if created:
+        publish(owner, "resync")
+    return ids
+
+
+def get_stored_paths(owner, prefix):
+    """Get the stored_path of every file of the owner stored under prefix."""
+    conn = db_read_connection(owner)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT stored_path FROM files WHERE owner = ? AND substr(stored_path, 1, ?) = ?",
+        (owner, len(prefix), prefix),
+    )
+    paths = {row["stored_path"] for row in cursor.fetchall()}
+    conn.close()
+    return paths
+
+
+def save_files_metadata(owner, files):
+    """Save many stored files in one transaction. Returns their ids.
+
+    files are dicts with the arguments of save_file_metadata. Open clients
+    are told to resync once instead of getting an event per file.
+    """
+    conn = db_connection(owner)
+    cursor = conn.cursor()
+    ids = []
+    for f in files:
+        cursor.execute(
+            f"""INSERT INTO files (id, owner, filename, stored_path, size, mime_type, folder_id, compression)
+                VALUES ({new_id_sql(conn, "files")}, ?, ?, ?, ?, ?, ?, ?)""",
+            (owner, f["filename"], f["stored_path"], f["size"], f.get("mime_type"), f.get("folder_id"),
+             f.get("compression", 0)),
+        )
+        ids.append(cursor.lastrowid)
+    cursor.executemany(
+        "INSERT INTO change_journal (username, entity_type, entity_id, op) VALUES (?, 'file', ?, 'upsert')",
+        [(owner, file_id) for file_id in ids],
+    )
+    conn.commit()
+    conn.close()
+    if ids:
+        publish(owner, "resync")
+        publish(owner, "usage.changed")
+    return ids
+
+
+# ============== Storage Scrub ==============
+
+def rows_after(sql, after_id, limit):
+    """Run an "id > ? ORDER BY id LIMIT ?" query on every shard, merged by id."""
+    rows = []
+    for shard in all_shards():
+        conn = db_read_connection(shard=shard)
+        rows += [dict(row) for row in conn.execute(sql, (after_id, limit)).fetchall()]
+        conn.close()
+    rows.sort(key=lambda row: row["id"])
+    return rows[:limit]
+
+
+def get_file_blobs(after_id=0, limit=1000):
+    """Get id, owner, filename, stored_path, size and compression of the files after after_id, by id."""
+    return rows_after(
+        "SELECT id, owner, filename, stored_path, size, compression FROM files WHERE id > ? ORDER BY id LIMIT ?",
+        after_id, limit,
+    )
+
+
+def get_share_copy_blobs(after_id=0, limit=1000):
+    """Get id, file_id, stored_path and size of the share copies after after_id, by id."""
+    return rows_after(
+        "SELECT id, file_id, stored_path, size FROM share_copies WHERE id > ? ORDER BY id LIMIT ?",
+        after_id, limit,
+    )
+
+
+def get_referenced_paths():
+    """Get every stored_path a file or share copy refers to."""
+    paths = set()
+    for shard in all_shards():
+        conn = db_read_connection(shard=shard)
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        cursor.execute("SELECT stored_path FROM files UNION ALL SELECT stored_path FROM share_copies")
+        paths.update(row[0] for row in cursor.fetchall())
+        conn.close()
+    return paths
+
+
 # ============== Share Functions ==============
 
 """
@@ -689,32 +1444,33 @@ FR-14: The user SHALL be able to share files.
 FR-18: The user SHALL be able to grant file access permissions.
 """
 
-def create_share_link(file_id, created_by, password_hash=None, expires_in_days=None, max_downloads=None, share_stored_path=None):
-    """Create a share link for a file."""
-    token = secrets.token_urlsafe(32)
-    expires_at = None
-    
-    if expires_in_days:
-        expires_at = (datetime.now() + timedelta(days=expires_in_days)).isoformat()
-    
-    conn = db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        """INSERT INTO share_links (file_id, token, password_hash, expires_at, max_downloads, share_stored_path, created_by)
-           VALUES (?, ?, ?, ?, ?, ?, ?)""",
-        (file_id, token, password_hash, expires_at, max_downloads, share_stored_path, created_by),
-    )
-    conn.commit()
-    conn.close()
-    return token
+def create_share_link(file_id, created_by, password_hash=None, expires_in_days=None, max_downloads=None,
+                      share_stored_path=None, content_hash=None, share_size=None):
+    """Create a share link for a file.
+
+    With content_hash the link uses the file's share copy with that hash.
+    share_stored_path/share_size describe a copy just written for it, which
+    becomes that copy if none exists yet. Without share_stored_path the copy
+    must already exist, otherwise no link is created and None is returned.
+    """
+    with UnitOfWork(created_by) as work:
+        return work.create_share_link(
+            file_id,
+            password_hash=password_hash,
+            expires_in_days=expires_in_days,
+            max_downloads=max_downloads,
+            share_stored_path=share_stored_path,
+            content_hash=content_hash,
+            share_size=share_size,
+        )
 
 
 def get_share_link(token):
     """Get share link info by token."""
-    conn = db_connection()
+    conn = db_read_connection(share_owner(token))
     cursor = conn.cursor()
     cursor.execute(
-        """SELECT sl.*, f.filename, f.size, f.stored_path, f.mime_type
+        """SELECT sl.*, f.owner, f.filename, f.size, f.stored_path, f.mime_type, f.compression
            FROM share_links sl
            JOIN files f ON sl.file_id = f.id
            WHERE sl.token = ?""",
@@ -729,6 +1485,7 @@ def get_share_link(token):
         return {
             "id": row["id"],
             "file_id": row["file_id"],
+            "owner": row["owner"],
             "token": row["token"],
             "has_password": row["password_hash"] is not None,
             "password_hash": row["password_hash"],
@@ -739,27 +1496,94 @@ def get_share_link(token):
             "size": row["size"],
             "stored_path": stored_path,
             "mime_type": row["mime_type"],
+            "compression": row["compression"],
             "share_stored_path": row["share_stored_path"],
         }
     return None
 
 
+def find_share_copy(file_id, owner, content_hash):
+    """Get the share copy of a file with the given content hash, if there is one."""
+    conn = db_read_connection(owner)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT id, stored_path, size, ref_count FROM share_copies WHERE file_id = ? AND content_hash = ?",
+        (file_id, content_hash),
+    )
+    row = cursor.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+def collect_share_copies(owner=None):
+    """Delete share copies no usable link needs anymore.
+
+    A copy goes once its last link was deleted, its file was deleted, or
+    every link using it has expired or used up its downloads. Those dead
+    links are kept (they still answer 410) but stop pointing at the copy.
+    Only looks at the owner's shard if given. Returns the stored paths to
+    remove from disk.
+
+    This reads every share link on the shard, so it runs as a periodic
+    sweep. Deleting a file or link deletes the copies it frees itself.
+    """
+    # Copies of every user on the shard are collected, a move can't be hurt by it
+    shards = [user_shard(owner)] if owner else all_shards()
+    paths = []
+    for shard in shards:
+        paths += collect_shard_share_copies(shard)
+    return paths
+
+
+def collect_shard_share_copies(shard):
+    """collect_share_copies for one shard."""
+    conn = db_connection(shard=shard)
+    cursor = conn.cursor()
+    cursor.execute(
+        """SELECT share_copy_id FROM share_links
+           WHERE share_copy_id IS NOT NULL
+           GROUP BY share_copy_id
+           HAVING MAX((expires_at IS NULL OR expires_at > ?)
+                      AND (max_downloads IS NULL OR download_count < max_downloads)) = 0""",
+        (datetime.now().isoformat(),),
+    )
+    dead = [row["share_copy_id"] for row in cursor.fetchall()]
+    for copy_id in dead:
+        cursor.execute(
+            "UPDATE share_links SET share_copy_id = NULL, share_stored_path = NULL WHERE share_copy_id = ?",
+            (copy_id,),
+        )
+        cursor.execute("UPDATE share_copies SET ref_count = 0 WHERE id = ?", (copy_id,))
+
+    cursor.execute(
+        """DELETE FROM share_copies
+           WHERE ref_count <= 0 OR file_id NOT IN (SELECT id FROM files)
+           RETURNING stored_path"""
+    )
+    paths = [row["stored_path"] for row in cursor.fetchall()]
+    conn.commit()
+    conn.close()
+    return paths
+
+
 def get_file_share_links(file_id, owner):
-    """Get all share links for a file."""
-    conn = db_connection()
+    """Get all share links for a file. None if the owner has no such file."""
+    conn = db_read_connection(owner)
     cursor = conn.cursor()
     cursor.execute(
         """SELECT sl.id, sl.token, sl.expires_at, sl.max_downloads, sl.download_count, sl.created_at,
                   (sl.password_hash IS NOT NULL) as has_password
-           FROM share_links sl
-           JOIN files f ON sl.file_id = f.id
-           WHERE sl.file_id = ? AND f.owner = ?
+           FROM files f
+           LEFT JOIN share_links sl ON sl.file_id = f.id
+           WHERE f.id = ? AND f.owner = ?
            ORDER BY sl.created_at DESC""",
         (file_id, owner),
     )
     rows = cursor.fetchall()
     conn.close()
 
+    if not rows:
+        return None
     return [
         {
             "id": row["id"],
@@ -771,19 +1595,41 @@ def get_file_share_links(file_id, owner):
             "created_at": row["created_at"],
         }
         for row in rows
+        if row["id"] is not None
     ]
 
 
-def increment_share_download(token):
-    """Count a download on a share link."""
-    conn = db_connection()
+def get_share_download_count(token, owner=None):
+    """Current download count of a share link, None if the link is gone."""
+    conn = db_read_connection(owner or share_owner(token))
+    row = conn.execute("SELECT download_count FROM share_links WHERE token = ?", (token,)).fetchone()
+    conn.close()
+    return row["download_count"] if row else None
+
+
+def increment_share_download(token, owner=None):
+    """Count a download on a share link.
+
+    Only counts it while the link is under max_downloads, so concurrent
+    downloads can't go over the limit. Returns the new download count, 0 if
+    the limit was already reached, or None if the link is gone. Pass the
+    link's owner if known, it saves looking it up.
+    """
+    conn = db_connection(owner or share_owner(token))
     cursor = conn.cursor()
     cursor.execute(
-        "UPDATE share_links SET download_count = download_count + 1 WHERE token = ?",
+        """UPDATE share_links SET download_count = download_count + 1
+           WHERE token = ? AND (max_downloads IS NULL OR download_count < max_downloads)
+           RETURNING download_count""",
         (token,),
     )
+    row = cursor.fetchone()
+    if row is None:
+        cursor.execute("SELECT 0 AS download_count FROM share_links WHERE token = ?", (token,))
+        row = cursor.fetchone()
     conn.commit()
     conn.close()
+    return row["download_count"] if row else None
 
 
 """
@@ -793,48 +1639,377 @@ FR-19: The user SHALL be able to revoke file access permissions.
 """
 
 def delete_share_link(link_id, owner):
-    """Delete a share link to revoke access."""
-    conn = db_connection()
+    """Delete a share link to revoke access.
+
+    Drops the link's reference to its share copy and deletes the copy if
+    that was the last one. Returns the copy's stored paths to remove from
+    disk, or None if there was no such link.
+    """
+    conn = db_connection(owner)
     cursor = conn.cursor()
     cursor.execute(
         """DELETE FROM share_links 
-           WHERE id = ? AND file_id IN (SELECT id FROM files WHERE owner = ?)""",
+           WHERE id = ? AND file_id IN (SELECT id FROM files WHERE owner = ?)
+           RETURNING share_copy_id, token""",
         (link_id, owner),
     )
-    affected = cursor.rowcount
+    deleted = cursor.fetchall()
+    paths = []
+    if deleted and deleted[0]["share_copy_id"]:
+        cursor.execute(
+            "UPDATE share_copies SET ref_count = ref_count - 1 WHERE id = ?",
+            (deleted[0]["share_copy_id"],),
+        )
+        cursor.execute(
+            "DELETE FROM share_copies WHERE id = ? AND ref_count <= 0 RETURNING stored_path",
+            (deleted[0]["share_copy_id"],),
+        )
+        paths = [copy["stored_path"] for copy in cursor.fetchall()]
     conn.commit()
     conn.close()
-    return affected > 0
+    unindex_share_tokens([link["token"] for link in deleted])
+    if not deleted:
+        return None
+    publish(owner, "share.deleted", {"id": link_id})
+    return paths
+
+
+# ============== Unit of Work ==============
+
+class UnitOfWork:
+    """What one request reads and changes of a user's files, on one connection.
+
+    Rows looked up through it are remembered, so checking that a file exists
+    and then changing it fetches it once, and the changes hand back the row
+    they changed (UPDATE ... RETURNING) instead of a separate lookup. The
+    first change starts a transaction that commits when the block ends,
+    together with any activity logged through the unit. Events go out after
+    the commit. An exception rolls everything back and publishes nothing.
+
+        with UnitOfWork(owner) as work:
+            row = work.trash_file(file_id)
+            if row:
+                work.log_activity("trash", target_type="file", target_id=file_id, target_name=row["filename"])
+
+    Lookups don't take the write lock, only changes do, so make the changes
+    at the end of the block. Don't call the other write functions here for
+    the same user inside it, they would wait for its transaction. Keep the
+    block short, with no uploads or other long waits in it: the connection
+    is on the user's shard when the unit opens, and a shard move only waits
+    SHARD_MOVE_DRAIN_SECONDS for writes already running.
+    """
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.conn = None
+        self.rows = {}
+        self.events = []
+        self.indexed = []
+        self.unindexed = []
+        self.partitions = []
+        # Share copies deleted in the unit, remove them from disk once it commits
+        self.share_copy_paths = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.conn is None:
+            return False
+        conn, self.conn = self.conn, None
+        if exc_type is not None:
+            # Partitions created in the rolled back transaction are gone again
+            for name, _ in self.partitions:
+                _activity_partitions.discard((conn.shard, name))
+            conn.close()
+            return False
+
+        conn.commit()
+        conn.close()
+        index_share_tokens(self.owner, self.indexed)
+        unindex_share_tokens(self.unindexed)
+        for event, data in self.events:
+            publish(self.owner, event, data)
+        if any(created for _, created in self.partitions):
+            archive_new_month()
+        return False
+
+    def cursor(self, write=False):
+        """A cursor on the unit's connection. With write, inside its transaction."""
+        if self.conn is None:
+            self.conn = db_connection(self.owner)
+        if write and not self.conn.in_transaction:
+            self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn.cursor()
+
+    def file(self, file_id):
+        """The owner's file with this id, or None."""
+        key = ("file", file_id)
+        if key not in self.rows:
+            self.rows[key] = self.cursor().execute(
+                f"SELECT {FILE_COLUMNS} FROM files WHERE id = ? AND owner = ?",
+                (file_id, self.owner),
+            ).fetchone()
+        return self.rows[key]
+
+    def folder(self, folder_id):
+        """The owner's folder with this id, or None."""
+        key = ("folder", folder_id)
+        if key not in self.rows:
+            self.rows[key] = self.cursor().execute(
+                f"SELECT {FOLDER_COLUMNS} FROM folders WHERE id = ? AND owner = ?",
+                (folder_id, self.owner),
+            ).fetchone()
+        return self.rows[key]
+
+    def update_file(self, file_id, assignments, params, event, data, usage=False):
+        """Apply SET assignments to the owner's file. Returns the changed row, None if there is no such file."""
+        cursor = self.cursor(write=True)
+        cursor.execute(
+            f"""UPDATE files SET {assignments}, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND owner = ?
+                RETURNING {FILE_COLUMNS}""",
+            (*params, file_id, self.owner),
+        )
+        row = self.rows[("file", file_id)] = cursor.fetchone()
+        if row:
+            journal_change(cursor, self.owner, "file", file_id)
+            self.events.append((event, data))
+            if usage:
+                self.events.append(("usage.changed", None))
+        return row
+
+    def rename_file(self, file_id, new_filename):
+        """Change a file's name."""
+        return self.update_file(
+            file_id, "filename = ?", (new_filename,),
+            "file.updated", {"id": file_id, "filename": new_filename},
+        )
+
+    def move_file(self, file_id, folder_id):
+        """Move a file to a different folder."""
+        return self.update_file(
+            file_id, "folder_id = ?", (folder_id,),
+            "file.moved", {"id": file_id, "folder_id": folder_id},
+        )
+
+    def trash_file(self, file_id):
+        """Move a file to trash."""
+        return self.update_file(
+            file_id, "is_trashed = 1, trashed_at = CURRENT_TIMESTAMP", (),
+            "file.trashed", {"id": file_id}, usage=True,
+        )
+
+    def restore_file(self, file_id):
+        """Restore a file from trash."""
+        return self.update_file(
+            file_id, "is_trashed = 0, trashed_at = NULL", (),
+            "file.restored", {"id": file_id}, usage=True,
+        )
+
+    def delete_file(self, file_id):
+        """Permanently delete a file, its share links and share copies. Returns the deleted row, or None."""
+        cursor = self.cursor(write=True)
+        cursor.execute(
+            f"DELETE FROM files WHERE id = ? AND owner = ? RETURNING {FILE_COLUMNS}",
+            (file_id, self.owner),
+        )
+        row = cursor.fetchone()
+        self.rows[("file", file_id)] = None
+        if row:
+            cursor.execute(
+                "DELETE FROM share_links WHERE file_id = ? RETURNING token",
+                (file_id,),
+            )
+            self.unindexed.extend(link["token"] for link in cursor.fetchall())
+            cursor.execute(
+                "DELETE FROM share_copies WHERE file_id = ? RETURNING stored_path",
+                (file_id,),
+            )
+            self.share_copy_paths.extend(copy["stored_path"] for copy in cursor.fetchall())
+            journal_change(cursor, self.owner, "file", file_id, "delete")
+            self.events.append(("file.deleted", {"id": file_id}))
+            self.events.append(("usage.changed", None))
+        return row
+
+    def create_share_link(self, file_id, password_hash=None, expires_in_days=None, max_downloads=None,
+                          share_stored_path=None, content_hash=None, share_size=None):
+        """Create a share link for a file, see create_share_link. Returns the token, or None."""
+        token = secrets.token_urlsafe(32)
+        expires_at = None
+        if expires_in_days:
+            expires_at = (datetime.now() + timedelta(days=expires_in_days)).isoformat()
+
+        cursor = self.cursor(write=True)
+        share_copy_id = None
+        if content_hash:
+            if share_stored_path:
+                # If another request stored the same copy first we use theirs,
+                # ours is left for the storage scrubber
+                cursor.execute(
+                    f"""INSERT INTO share_copies (id, file_id, content_hash, stored_path, size, ref_count)
+                        VALUES ({new_id_sql(self.conn, "share_copies")}, ?, ?, ?, ?, 1)
+                        ON CONFLICT (file_id, content_hash) DO UPDATE SET ref_count = ref_count + 1
+                        RETURNING id, stored_path""",
+                    (file_id, content_hash, share_stored_path, share_size or 0),
+                )
+            else:
+                cursor.execute(
+                    """UPDATE share_copies SET ref_count = ref_count + 1
+                       WHERE file_id = ? AND content_hash = ?
+                       RETURNING id, stored_path""",
+                    (file_id, content_hash),
+                )
+            copy = cursor.fetchone()
+            if copy is None:
+                return None
+            share_copy_id = copy["id"]
+            share_stored_path = copy["stored_path"]
+
+        cursor.execute(
+            f"""INSERT INTO share_links (id, file_id, token, password_hash, expires_at, max_downloads,
+                                         share_stored_path, share_copy_id, created_by)
+                VALUES ({new_id_sql(self.conn, "share_links")}, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (file_id, token, password_hash, expires_at, max_downloads, share_stored_path, share_copy_id,
+             self.owner),
+        )
+        self.indexed.append(token)
+        self.events.append(("share.created", {"file_id": file_id}))
+        return token
+
+    def log_activity(self, action, target_type=None, target_id=None, target_name=None, details=None,
+                     ip_address=None, size=None):
+        """Record an action of the owner, committed with the unit's changes."""
+        self.partitions.append(insert_activity(
+            self.cursor(write=True), self.owner, action,
+            target_type, target_id, target_name, details, ip_address, size,
+        ))
 
 
 # ============== Activity Log Functions ==============
+#
+# Activity is kept in one table per month, activity_log_YYYY_MM, indexed on
+# (username, created_at). Writes only touch the current month, reads walk
+# the months newest first and stop once they have enough rows, and months
+# older than ACTIVITY_RETENTION_MONTHS are exported to gzipped JSON Lines
+# and dropped whole instead of deleting rows one at a time.
 
-def log_activity(username, action, target_type=None, target_id=None, target_name=None, details=None, ip_address=None):
-    """Record a user action."""
-    conn = db_connection()
-    cursor = conn.cursor()
+# Months of activity kept in the database, counting the current one. 0 keeps everything.
+ACTIVITY_RETENTION_MONTHS = int(os.getenv("ACTIVITY_RETENTION_MONTHS", "12"))
+
+# Where archive_activity writes the months it drops
+ACTIVITY_ARCHIVE_DIR = os.getenv("ACTIVITY_ARCHIVE_DIR", "activity_archive")
+
+ACTIVITY_COLUMNS = "id, username, action, target_type, target_id, target_name, details, ip_address, created_at, size"
+
+# (shard, partition) this process has already created or seen
+_activity_partitions = set()
+
+
+def activity_partition_name(created_at):
+    """Name of the partition for a "YYYY-MM..." timestamp."""
+    return f"activity_log_{created_at[:4]}_{created_at[5:7]}"
+
+
+def activity_partitions(cursor):
+    """Names of all activity partitions, newest first."""
+    cursor.execute(
+        """SELECT name FROM sqlite_master
+           WHERE type = 'table' AND name GLOB 'activity_log_[0-9][0-9][0-9][0-9]_[0-9][0-9]'
+           ORDER BY name DESC"""
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def ensure_activity_partition(cursor, name):
+    """Create an activity partition if needed. Returns (name, created)."""
+    shard = getattr(cursor.connection, "shard", 0)
+    if (shard, name) in _activity_partitions:
+        return name, False
+    cursor.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {name}(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            action TEXT NOT NULL,
+            target_type TEXT,
+            target_id INTEGER,
+            target_name TEXT,
+            details TEXT,
+            ip_address TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            size INTEGER
+        )
+        """
+    )
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_user_created ON {name}(username, created_at)")
+
+    # Carry on from the highest id in the other months so ids stay unique.
+    # Only one worker gets to insert the sequence row, that one created it.
+    highest = 0
+    for other in activity_partitions(cursor):
+        if other != name:
+            highest = max(highest, cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {other}").fetchone()[0])
+    cursor.execute(
+        """INSERT INTO sqlite_sequence (name, seq)
+           SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)""",
+        (name, highest, name),
+    )
+    created = cursor.rowcount == 1
+    _activity_partitions.add((shard, name))
+    return name, created
+
+
+def insert_activity(cursor, username, action, target_type=None, target_id=None, target_name=None, details=None,
+                    ip_address=None, size=None):
+    """Insert an activity entry. Returns (partition, created), see ensure_activity_partition."""
+    created_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    partition, created = ensure_activity_partition(cursor, activity_partition_name(created_at))
     cursor.execute(
-        """INSERT INTO activity_log (username, action, target_type, target_id, target_name, details, ip_address)
-           VALUES (?, ?, ?, ?, ?, ?, ?)""",
-        (username, action, target_type, target_id, target_name, details, ip_address),
+        f"""INSERT INTO {partition} (username, action, target_type, target_id, target_name, details,
+                                    ip_address, created_at, size)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (username, action, target_type, target_id, target_name, details, ip_address, created_at, size),
+    )
+    return partition, created
+
+
+def archive_new_month():
+    """Called after the first entry of a month, a month may have aged out."""
+    if ACTIVITY_RETENTION_MONTHS > 0:
+        threading.Thread(target=archive_activity, daemon=True).start()
+
+
+def log_activity(username, action, target_type=None, target_id=None, target_name=None, details=None, ip_address=None,
+                 size=None):
+    """Record a user action. size is the number of bytes involved, if any."""
+    conn = db_connection(username)
+    _, created = insert_activity(
+        conn.cursor(), username, action, target_type, target_id, target_name, details, ip_address, size
     )
     conn.commit()
     conn.close()
+    if created:
+        archive_new_month()
 
 
 def get_user_activity(username, limit=50):
     """Get recent activity for a user."""
-    conn = db_connection()
+    conn = db_read_connection(username)
     cursor = conn.cursor()
-    cursor.execute(
-        """SELECT id, action, target_type, target_id, target_name, details, created_at
-           FROM activity_log
-           WHERE username = ?
-           ORDER BY created_at DESC
-           LIMIT ?""",
-        (username, limit),
-    )
-    rows = cursor.fetchall()
+    rows = []
+    for partition in activity_partitions(cursor):
+        cursor.execute(
+            f"""SELECT id, action, target_type, target_id, target_name, details, created_at
+                FROM {partition}
+                WHERE username = ?
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?""",
+            (username, limit - len(rows)),
+        )
+        rows.extend(cursor.fetchall())
+        if len(rows) >= limit:
+            break
     conn.close()
 
     return [
@@ -851,14 +2026,202 @@ def get_user_activity(username, limit=50):
     ]
 
 
+def archive_activity(retention_months=None, archive_dir=None):
+    """Export activity months past the retention period and drop them.
+
+    Each month is written to <archive_dir>/activity_log_YYYY_MM.jsonl.gz, one
+    JSON object per row, before its table is dropped. Returns a list of
+    {"partition", "rows", "path"} for the months archived.
+    """
+    months = ACTIVITY_RETENTION_MONTHS if retention_months is None else retention_months
+    if months <= 0:
+        return []
+    archive_dir = archive_dir or ACTIVITY_ARCHIVE_DIR
+
+    now = datetime.now(timezone.utc)
+    index = now.year * 12 + now.month - 1 - (months - 1)
+    oldest_kept = activity_partition_name(f"{index // 12:04d}-{index % 12 + 1:02d}")
+
+    archived = []
+    for shard in all_shards():
+        archived += archive_shard_activity(shard, oldest_kept, archive_dir)
+    return archived
+
+
+def archive_shard_activity(shard, oldest_kept, archive_dir):
+    """archive_activity for one shard. Shards past 0 get their number in the file names."""
+    conn = db_read_connection(shard=shard)
+    partitions = [p for p in activity_partitions(conn.cursor()) if p < oldest_kept]
+    conn.close()
+    if partitions:
+        # Count everything in the daily rollups before it goes
+        rollup_activity(shard)
+
+    archived = []
+    for partition in reversed(partitions):
+        os.makedirs(archive_dir, exist_ok=True)
+        suffix = f".shard{shard}" if shard else ""
+        path = os.path.join(archive_dir, f"{partition}{suffix}.jsonl.gz")
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        rows = 0
+        conn = db_read_connection(shard=shard)
+        cursor = conn.cursor()
+        with gzip.open(temp_path, "wt", encoding="utf-8") as out:
+            cursor.execute(f"SELECT {ACTIVITY_COLUMNS} FROM {partition} ORDER BY id")
+            for row in cursor:
+                out.write(json.dumps(dict(row)) + "\n")
+                rows += 1
+        conn.close()
+        os.replace(temp_path, path)
+
+        conn = db_connection(shard=shard)
+        # Another worker may have archived it at the same time
+        conn.execute(f"DROP TABLE IF EXISTS {partition}")
+        conn.commit()
+        conn.close()
+        _activity_partitions.discard((shard, partition))
+        archived.append({"partition": partition, "shard": shard, "rows": rows, "path": path})
+    return archived
+
+
+# ============== Activity Analytics ==============
+#
+# activity_daily holds one row per day, user and action with the number of
+# events and bytes involved. rollup_activity folds in only the activity rows
+# added since its last run (tracked per partition in activity_rollup_state),
+# and the analytics queries read nothing but the rollups.
+
+def rollup_activity(shard=None):
+    """Fold new activity rows into activity_daily, on one shard or all of them.
+
+    Returns the number of rows folded.
+    """
+    folded = 0
+    for number in all_shards() if shard is None else [shard]:
+        conn = db_connection(shard=number)
+        cursor = conn.cursor()
+        # Take the write lock before reading the state, so two workers rolling
+        # up at the same time can't both fold the same rows
+        cursor.execute("BEGIN IMMEDIATE")
+        folded += fold_activity(cursor)
+        conn.commit()
+        conn.close()
+    return folded
+
+
+def fold_activity(cursor):
+    """Fold new activity rows into activity_daily inside the caller's transaction."""
+    partitions = activity_partitions(cursor)
+    cursor.execute("SELECT partition_name, last_id FROM activity_rollup_state")
+    state = {row["partition_name"]: row["last_id"] for row in cursor.fetchall()}
+
+    folded = 0
+    for partition in reversed(partitions):
+        last_id = state.get(partition, 0)
+        # Rows added while this runs are left for the next run
+        upto = cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {partition}").fetchone()[0]
+        if upto <= last_id:
+            continue
+        cursor.execute(
+            f"""INSERT INTO activity_daily (day, username, action, events, bytes)
+                SELECT date(created_at), username, action, COUNT(*), COALESCE(SUM(size), 0)
+                FROM {partition}
+                WHERE id > ? AND id <= ?
+                GROUP BY date(created_at), username, action
+                ON CONFLICT (day, username, action)
+                DO UPDATE SET events = events + excluded.events, bytes = bytes + excluded.bytes""",
+            (last_id, upto),
+        )
+        cursor.execute(f"SELECT COUNT(*) FROM {partition} WHERE id > ? AND id <= ?", (last_id, upto))
+        folded += cursor.fetchone()[0]
+        cursor.execute(
+            """INSERT INTO activity_rollup_state (partition_name, last_id) VALUES (?, ?)
+               ON CONFLICT (partition_name) DO UPDATE SET last_id = excluded.last_id""",
+            (partition, upto),
+        )
+
+    # Forget partitions that were archived
+    if partitions:
+        cursor.execute(
+            f"DELETE FROM activity_rollup_state WHERE partition_name NOT IN ({', '.join('?' * len(partitions))})",
+            partitions,
+        )
+    return folded
+
+
+def get_activity_rollups(days=30, username=None, action=None):
+    """Daily event and byte counts for the last `days` days, newest day first.
+
+    Per user and action, optionally only for one user or action.
+    """
+    conditions = ["day >= date('now', ?)"]
+    params = [f"-{days - 1} days"]
+    if username:
+        conditions.append("username = ?")
+        params.append(username)
+    if action:
+        conditions.append("action = ?")
+        params.append(action)
+
+    rows = []
+    for shard in [user_shard(username)] if username else all_shards():
+        conn = db_read_connection(shard=shard)
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""SELECT day, username, action, events, bytes
+                FROM activity_daily
+                WHERE {' AND '.join(conditions)}
+                ORDER BY day DESC, username, action""",
+            params,
+        )
+        rows += [dict(row) for row in cursor.fetchall()]
+        conn.close()
+    if len(rows) > 1:
+        rows.sort(key=lambda row: (row["username"], row["action"]))
+        rows.sort(key=lambda row: row["day"], reverse=True)
+    return rows
+
+
+def get_top_active_users(days=7, action=None, by="events", limit=10):
+    """Users with the most events (or bytes) in the last `days` days."""
+    order = "bytes" if by == "bytes" else "events"
+    conditions = ["day >= date('now', ?)"]
+    params = [f"-{days - 1} days"]
+    if action:
+        conditions.append("action = ?")
+        params.append(action)
+
+    # Each user's rollups are on their own shard, so the top of every shard
+    # together holds the overall top
+    rows = []
+    for shard in all_shards():
+        conn = db_read_connection(shard=shard)
+        cursor = conn.cursor()
+        # The unary + keeps SQLite on the day range of the primary key instead of
+        # walking every user in the username index
+        cursor.execute(
+            f"""SELECT username, SUM(events) AS events, SUM(bytes) AS bytes
+                FROM activity_daily
+                WHERE {' AND '.join(conditions)}
+                GROUP BY +username
+                ORDER BY {order} DESC, username
+                LIMIT ?""",
+            params + [limit],
+        )
+        rows += [dict(row) for row in cursor.fetchall()]
+        conn.close()
+    rows.sort(key=lambda row: (-row[order], row["username"]))
+    return rows[:limit]
+
+
 # ============== Storage Stats ==============
 
 def get_storage_used(owner):
     """Get total bytes used by a user."""
-    conn = db_connection()
+    conn = db_read_connection(owner)
     cursor = conn.cursor()
     cursor.execute(
-        "SELECT COALESCE(SUM(size), 0) as total FROM files WHERE owner = ? AND is_trashed = 0",
+        "SELECT COALESCE(SUM(bytes), 0) as total FROM storage_usage WHERE owner = ? AND is_trashed = 0",
         (owner,),
     )
     row = cursor.fetchone()
@@ -868,12 +2231,649 @@ def get_storage_used(owner):
 
 def get_file_count(owner):
     """Get number of files for a user."""
-    conn = db_connection()
+    conn = db_read_connection(owner)
     cursor = conn.cursor()
     cursor.execute(
-        "SELECT COUNT(*) as count FROM files WHERE owner = ? AND is_trashed = 0",
+        "SELECT COALESCE(SUM(files), 0) as count FROM storage_usage WHERE owner = ? AND is_trashed = 0",
         (owner,),
     )
     row = cursor.fetchone()
     conn.close()
     return row["count"] if row else 0
+
+
+def get_user_summary(username):
+    """Get user profile data plus storage used and file count in one query.
+
+    Two queries when the user's files are on another shard than DB_FILE.
+    """
+    if user_shard(username) != 0:
+        user = get_user_info(username)
+        if user:
+            user["storage_used"] = get_storage_used(username)
+            user["file_count"] = get_file_count(username)
+        return user
+
+    conn = db_read_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        """SELECT u.id, u.username, u.email, u.created_at,
+                  COALESCE(SUM(s.bytes), 0) as storage_used,
+                  COALESCE(SUM(s.files), 0) as file_count
+           FROM users u
+           LEFT JOIN storage_usage s ON s.owner = u.username AND s.is_trashed = 0
+           WHERE u.username = ?
+           GROUP BY u.id""",
+        (username,),
+    )
+    row = cursor.fetchone()
+    conn.close()
+
+    if row:
+        return {
+            "id": row["id"],
+            "username": row["username"],
+            "email": row["email"],
+            "created_at": row["created_at"],
+            "storage_used": row["storage_used"],
+            "file_count": row["file_count"],
+        }
+    return None
+
+
+def get_storage_breakdown(owner):
+    """Get bytes and file counts per category, plus what the trash holds.
+
+    Read from storage_usage, so the cost doesn't depend on the number of files.
+    """
+    conn = db_read_connection(owner)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT category, is_trashed, bytes, files FROM storage_usage WHERE owner = ? AND files > 0",
+        (owner,),
+    )
+    rows = cursor.fetchall()
+    conn.close()
+
+    categories = [
+        {"category": row["category"], "bytes": row["bytes"], "files": row["files"]}
+        for row in rows
+        if not row["is_trashed"]
+    ]
+    categories.sort(key=lambda c: c["bytes"], reverse=True)
+    trashed = [row for row in rows if row["is_trashed"]]
+    return {
+        "categories": categories,
+        "trash": {
+            "bytes": sum(row["bytes"] for row in trashed),
+            "files": sum(row["files"] for row in trashed),
+        },
+    }
+
+
+def get_largest_files(owner, limit=10):
+    """Get a user's biggest files outside the trash, largest first."""
+    conn = db_read_connection(owner)
+    cursor = conn.cursor()
+    cursor.execute(
+        """SELECT id, filename, size, mime_type, folder_id, created_at, updated_at
+           FROM files
+           WHERE owner = ? AND is_trashed = 0
+           ORDER BY size DESC
+           LIMIT ?""",
+        (owner, limit),
+    )
+    rows = cursor.fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+
+# ============== Sync Functions ==============
+
+# Changes older than this are folded into journal_snapshot by compact_change_journal
+SYNC_COMPACT_AFTER_DAYS = int(os.getenv("SYNC_COMPACT_AFTER_DAYS", "30"))
+
+SYNC_FILE_COLUMNS = "id, filename, size, mime_type, folder_id, is_trashed, created_at, updated_at"
+SYNC_FOLDER_COLUMNS = "id, name, parent_id, is_trashed, created_at, updated_at"
+
+
+def journal_change(cursor, owner, entity_type, entity_id, op="upsert"):
+    """Record a file or folder change. Call inside the mutation's own transaction."""
+    cursor.execute(
+        "INSERT INTO change_journal (username, entity_type, entity_id, op) VALUES (?, ?, ?, ?)",
+        (owner, entity_type, entity_id, op),
+    )
+
+
+def journal_folder_files(cursor, owner, folder_id, op="upsert"):
+    """Record a change for every file directly inside a folder."""
+    cursor.execute(
+        """INSERT INTO change_journal (username, entity_type, entity_id, op)
+           SELECT owner, 'file', id, ? FROM files WHERE folder_id = ? AND owner = ?""",
+        (op, folder_id, owner),
+    )
+
+
+def backfill_change_journal(conn):
+    """Add a journal entry for every existing file and folder, so a first sync sees them."""
+    cursor = conn.cursor()
+    cursor.execute(
+        """INSERT INTO change_journal (username, entity_type, entity_id, op)
+           SELECT owner, 'folder', id, 'upsert' FROM folders ORDER BY id"""
+    )
+    cursor.execute(
+        """INSERT INTO change_journal (username, entity_type, entity_id, op)
+           SELECT owner, 'file', id, 'upsert' FROM files ORDER BY id"""
+    )
+
+
+def get_changes(owner, cursor_seq=0, limit=1000):
+    """Get what changed for a user after cursor_seq.
+
+    Each file or folder shows up once, at its latest change, with its current
+    data or as a delete. Returns (changes, next_cursor, has_more).
+    """
+    conn = db_read_connection(owner)
+    cursor = conn.cursor()
+
+    # Latest change per entity, from both the compacted snapshot and the journal
+    cursor.execute(
+        """SELECT entity_type, entity_id, MAX(seq) AS seq
+           FROM (
+               SELECT entity_type, entity_id, seq FROM journal_snapshot
+               WHERE username = ? AND seq > ?
+               UNION ALL
+               SELECT entity_type, entity_id, seq FROM change_journal
+               WHERE username = ? AND seq > ?
+           )
+           GROUP BY entity_type, entity_id
+           ORDER BY seq
+           LIMIT ?""",
+        (owner, cursor_seq, owner, cursor_seq, limit + 1),
+    )
+    entries = cursor.fetchall()
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    # Look up the current state of everything that changed, one query per type
+    current = {"file": {}, "folder": {}}
+    for entity_type, table, columns in (
+        ("file", "files", SYNC_FILE_COLUMNS),
+        ("folder", "folders", SYNC_FOLDER_COLUMNS),
+    ):
+        ids = [e["entity_id"] for e in entries if e["entity_type"] == entity_type]
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            cursor.execute(
+                f"""SELECT {columns} FROM {table}
+                    WHERE owner = ? AND id IN ({",".join("?" * len(chunk))})""",
+                (owner, *chunk),
+            )
+            for row in cursor.fetchall():
+                data = dict(row)
+                data["is_trashed"] = bool(data["is_trashed"])
+                current[entity_type][row["id"]] = data
+    conn.close()
+
+    changes = []
+    for e in entries:
+        data = current[e["entity_type"]].get(e["entity_id"])
+        change = {
+            "seq": e["seq"],
+            "type": e["entity_type"],
+            "id": e["entity_id"],
+            "op": "upsert" if data else "delete",
+        }
+        if data:
+            change["data"] = data
+        changes.append(change)
+
+    next_cursor = entries[-1]["seq"] if entries else cursor_seq
+    return changes, next_cursor, has_more
+
+
+def compact_change_journal(older_than_days=None):
+    """Fold old journal entries into journal_snapshot and delete them.
+
+    The snapshot keeps the latest seq per file or folder, so syncing from any
+    cursor still returns the same result, just from fewer rows.
+    Returns the number of journal entries removed.
+    """
+    days = SYNC_COMPACT_AFTER_DAYS if older_than_days is None else older_than_days
+    return sum(compact_shard_change_journal(shard, days) for shard in all_shards())
+
+
+def compact_shard_change_journal(shard, days):
+    """compact_change_journal for one shard."""
+    conn = db_connection(shard=shard)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT MAX(seq) AS seq FROM change_journal WHERE created_at < datetime('now', ?)",
+        (f"-{days} days",),
+    )
+    horizon = cursor.fetchone()["seq"]
+    if horizon is None:
+        conn.close()
+        return 0
+
+    # SQLite returns op from the row holding MAX(seq)
+    cursor.execute(
+        """INSERT INTO journal_snapshot (username, entity_type, entity_id, seq, op)
+           SELECT username, entity_type, entity_id, MAX(seq), op
+           FROM change_journal
+           WHERE seq <= ?
+           GROUP BY username, entity_type, entity_id
+           ON CONFLICT (username, entity_type, entity_id)
+           DO UPDATE SET seq = excluded.seq, op = excluded.op
+           WHERE excluded.seq > journal_snapshot.seq""",
+        (horizon,),
+    )
+    cursor.execute("DELETE FROM change_journal WHERE seq <= ?", (horizon,))
+    removed = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return removed
+
+
+# ============== Token Revocation Functions ==============
+
+def save_token_revocation(username, expires_at, jti=None, not_before=None):
+    """Record a revoked token (jti) or all of a user's tokens issued before not_before."""
+    conn = db_connection()
+    cursor = conn.cursor()
+    # Nothing can use an expired token, so drop rows nobody needs anymore
+    cursor.execute("DELETE FROM token_revocations WHERE expires_at < ?", (time.time(),))
+    cursor.execute(
+        """INSERT INTO token_revocations (username, jti, not_before, expires_at)
+           VALUES (?, ?, ?, ?)""",
+        (username, jti, not_before, expires_at),
+    )
+    seq = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return seq
+
+
+def get_token_revocations(after_seq=0):
+    """Get unexpired revocations recorded after after_seq, oldest first."""
+    conn = db_read_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        """SELECT seq, username, jti, not_before, expires_at
+           FROM token_revocations
+           WHERE seq > ? AND expires_at >= ?
+           ORDER BY seq""",
+        (after_seq, time.time()),
+    )
+    rows = cursor.fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+
+# ============== Sharding ==============
+#
+# With DB_SHARDS above 1, each user's files, folders, share links, activity
+# and sync journal live in one of DB_SHARDS database files: DB_FILE itself
+# (shard 0) or DB_FILE with .shardN before its extension. Every shard has
+# its own write lock, so a heavy uploader only holds up the users on the
+# same shard. DB_FILE keeps what is looked up across users: the users,
+# token revocations, user_shards (the shard of each user) and share_index
+# (the owner of each public share token).
+#
+# New users are placed by a hash of their name. Users without a row in
+# user_shards, like everyone from before sharding was turned on, are on
+# shard 0. move_user moves a user to another shard while the server runs.
+#
+# Files, folders, share links and share copies keep their ids when their
+# user moves: shard n hands out ids above n << SHARD_ID_BITS, so ids made on
+# different shards never collide.
+
+SHARD_ID_BITS = 40
+
+# How long move_user waits after refusing a user's writes before copying,
+# so writes that had already picked the old shard can finish
+SHARD_MOVE_DRAIN_SECONDS = float(os.getenv("SHARD_MOVE_DRAIN_SECONDS", str(DB_BUSY_TIMEOUT_MS / 1000 + 1)))
+
+
+class UserMoving(Exception):
+    """The user's data is being moved to another shard, their writes have to wait."""
+
+
+def placement(username):
+    """Shard a new user goes to."""
+    digest = hashlib.sha256(username.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % DB_SHARDS
+
+
+def user_shard(username, write=False):
+    """Shard holding a user's data. Raises UserMoving for a write while they are moved."""
+    if DB_SHARDS <= 1:
+        return 0
+    conn = db_read_connection(shard=0)
+    row = conn.execute("SELECT shard, moving FROM user_shards WHERE username = ?", (username,)).fetchone()
+    conn.close()
+    if row is None:
+        return 0
+    if write and row["moving"]:
+        raise UserMoving(f"{username} is being moved to another shard")
+    return row["shard"]
+
+
+def all_shards():
+    """Every shard in use: the first DB_SHARDS and any a user was moved to past those."""
+    if DB_SHARDS <= 1:
+        return [0]
+    conn = db_read_connection(shard=0)
+    shards = set(range(DB_SHARDS))
+    shards.update(row[0] for row in conn.execute("SELECT DISTINCT shard FROM user_shards"))
+    conn.close()
+    return sorted(shards)
+
+
+def new_id_sql(conn, table):
+    """SQL for the id of a row inserted into table on conn's shard, NULL for the next rowid."""
+    if DB_SHARDS <= 1:
+        return "NULL"
+    low = conn.shard << SHARD_ID_BITS
+    high = low + (1 << SHARD_ID_BITS)
+    return f"COALESCE((SELECT id FROM {table} WHERE id > {low} AND id < {high} ORDER BY id DESC LIMIT 1), {low}) + 1"
+
+
+def share_owner(token):
+    """Owner of a share token from share_index. None without sharding or if it isn't there.
+
+    Links made before sharding was turned on aren't indexed, they are on shard 0.
+    """
+    if DB_SHARDS <= 1:
+        return None
+    conn = db_read_connection(shard=0)
+    row = conn.execute("SELECT owner FROM share_index WHERE token = ?", (token,)).fetchone()
+    conn.close()
+    return row["owner"] if row else None
+
+
+def index_share_tokens(owner, tokens):
+    """Record who owns share tokens, so a token finds its shard."""
+    if DB_SHARDS <= 1 or not tokens:
+        return
+    conn = db_connection(shard=0)
+    conn.executemany(
+        "INSERT OR REPLACE INTO share_index (token, owner) VALUES (?, ?)",
+        [(token, owner) for token in tokens],
+    )
+    conn.commit()
+    conn.close()
+
+
+def unindex_share_tokens(tokens):
+    """Forget deleted share tokens."""
+    if DB_SHARDS <= 1 or not tokens:
+        return
+    conn = db_connection(shard=0)
+    conn.executemany("DELETE FROM share_index WHERE token = ?", [(token,) for token in tokens])
+    conn.commit()
+    conn.close()
+
+
+def get_user_shards():
+    """Every user's shard, {username: shard}."""
+    conn = db_read_connection(shard=0)
+    cursor = conn.cursor()
+    cursor.execute(
+        """SELECT u.username, COALESCE(s.shard, 0) AS shard
+           FROM users u LEFT JOIN user_shards s ON s.username = u.username"""
+    )
+    shards = {row["username"]: row["shard"] for row in cursor.fetchall()}
+    conn.close()
+    return shards
+
+
+def get_shard_usage(shard):
+    """Bytes and files of each user with files on a shard, {username: (bytes, files)}."""
+    conn = db_read_connection(shard=shard)
+    cursor = conn.cursor()
+    cursor.execute("SELECT owner, SUM(bytes) AS bytes, SUM(files) AS files FROM storage_usage GROUP BY owner")
+    usage = {row["owner"]: (row["bytes"], row["files"]) for row in cursor.fetchall()}
+    conn.close()
+    return usage
+
+
+def claim_user(username):
+    """Refuse a user's writes while their rows are moved or cleaned up.
+
+    Raises ValueError if something else already has them.
+    """
+    conn = db_connection(shard=0)
+    cursor = conn.cursor()
+    cursor.execute(
+        """INSERT INTO user_shards (username, shard, moving) VALUES (?, 0, 1)
+           ON CONFLICT (username) DO UPDATE SET moving = 1 WHERE moving = 0""",
+        (username,),
+    )
+    claimed = cursor.rowcount
+    conn.commit()
+    conn.close()
+    if not claimed:
+        raise ValueError(f"{username} is already being moved")
+
+
+def release_user(username, shard=None):
+    """Let a user write again, on a new shard if given."""
+    conn = db_connection(shard=0)
+    if shard is None:
+        conn.execute("UPDATE user_shards SET moving = 0 WHERE username = ?", (username,))
+    else:
+        conn.execute("UPDATE user_shards SET shard = ?, moving = 0 WHERE username = ?", (shard, username))
+    conn.commit()
+    conn.close()
+
+
+def delete_user_rows(cursor, username):
+    """Delete all of a user's rows from the shard cursor is on."""
+    user_files = "file_id IN (SELECT id FROM files WHERE owner = ?)"
+    cursor.execute(f"DELETE FROM share_links WHERE {user_files}", (username,))
+    cursor.execute(f"DELETE FROM share_copies WHERE {user_files}", (username,))
+    # Folders first, so the file triggers find no folder totals to update
+    cursor.execute("DELETE FROM folders WHERE owner = ?", (username,))
+    cursor.execute("DELETE FROM files WHERE owner = ?", (username,))
+    cursor.execute("DELETE FROM storage_usage WHERE owner = ?", (username,))
+    cursor.execute("DELETE FROM change_journal WHERE username = ?", (username,))
+    cursor.execute("DELETE FROM journal_snapshot WHERE username = ?", (username,))
+    for partition in activity_partitions(cursor):
+        cursor.execute(f"DELETE FROM {partition} WHERE username = ?", (username,))
+    cursor.execute("DELETE FROM activity_daily WHERE username = ?", (username,))
+
+
+def journal_sequence(conn):
+    """Highest change_journal seq a shard has handed out."""
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_journal'").fetchone()
+    return row[0] if row else 0
+
+
+def copy_user(username, source, target):
+    """Copy a user's rows to another shard in one transaction. Returns rows copied per table.
+
+    The user's writes must already be refused.
+    """
+    # Their activity so far is counted in activity_daily, which is copied
+    rollup_activity(source)
+
+    src = db_read_connection(shard=source)
+    dst = db_connection(shard=target)
+    cursor = dst.cursor()
+    try:
+        # All reads from one snapshot of the source
+        src.execute("BEGIN")
+        cursor.execute("BEGIN IMMEDIATE")
+        # Left by a move to this shard that didn't finish
+        delete_user_rows(cursor, username)
+        fold_activity(cursor)
+        copied = {}
+
+        def copy(table, columns, where, params=(username,)):
+            rows = src.cursor()
+            rows.row_factory = None
+            rows.execute(f"SELECT {columns} FROM {table} WHERE {where}", params)
+            placeholders = ", ".join("?" * len(columns.split(",")))
+            cursor.executemany(f"INSERT INTO {table} ({columns}) VALUES ({placeholders})", rows)
+            copied[table] = max(cursor.rowcount, 0)
+
+        # Files before folders, so the triggers don't add to folder totals
+        # that are copied as they are. storage_usage is filled by its triggers.
+        copy("files", "id, owner, filename, stored_path, size, mime_type, folder_id, is_trashed, trashed_at, "
+                      "created_at, updated_at, compression", "owner = ?")
+        copy("folders", "id, owner, name, parent_id, is_trashed, trashed_at, created_at, updated_at, "
+                        "subtree_bytes, subtree_files", "owner = ?")
+        user_files = "file_id IN (SELECT id FROM files WHERE owner = ?)"
+        copy("share_copies", "id, file_id, content_hash, stored_path, size, ref_count, created_at", user_files)
+        copy("share_links", "id, file_id, token, password_hash, expires_at, max_downloads, download_count, "
+                            "share_stored_path, share_copy_id, created_by, created_at", user_files)
+        copy("activity_daily", "day, username, action, events, bytes", "username = ?")
+
+        # Clients sync from cursors into the source's seq numbers. Numbering
+        # the entries again above both shards' counters keeps their order,
+        # and every client gets them all once more, which is harmless.
+        entries = src.execute(
+            """SELECT seq, entity_type, entity_id, op, created_at, 0 AS snapshot
+               FROM change_journal WHERE username = ?
+               UNION ALL
+               SELECT seq, entity_type, entity_id, op, NULL, 1
+               FROM journal_snapshot WHERE username = ?
+               ORDER BY seq""",
+            (username, username),
+        ).fetchall()
+        base = max(journal_sequence(src), journal_sequence(dst))
+        cursor.executemany(
+            """INSERT INTO change_journal (seq, username, entity_type, entity_id, op, created_at)
+               VALUES (?, ?, ?, ?, ?, ?)""",
+            [(base + i, username, e["entity_type"], e["entity_id"], e["op"], e["created_at"])
+             for i, e in enumerate(entries, start=1) if not e["snapshot"]],
+        )
+        cursor.executemany(
+            "INSERT INTO journal_snapshot (username, entity_type, entity_id, seq, op) VALUES (?, ?, ?, ?, ?)",
+            [(username, e["entity_type"], e["entity_id"], base + i, e["op"])
+             for i, e in enumerate(entries, start=1) if e["snapshot"]],
+        )
+        copied["change_journal"] = len(entries)
+
+        # Activity rows get new ids. They are already in activity_daily, and
+        # everything else on the target was folded above, so the rollup
+        # state moves past them.
+        copied["activity_log"] = 0
+        for partition in activity_partitions(src.cursor()):
+            ensure_activity_partition(cursor, partition)
+            rows = src.cursor()
+            rows.row_factory = None
+            rows.execute(
+                f"""SELECT username, action, target_type, target_id, target_name, details, ip_address, created_at, size
+                    FROM {partition} WHERE username = ?""",
+                (username,),
+            )
+            cursor.executemany(
+                f"""INSERT INTO {partition} (username, action, target_type, target_id, target_name, details,
+                                            ip_address, created_at, size)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                rows,
+            )
+            copied["activity_log"] += max(cursor.rowcount, 0)
+            cursor.execute(
+                f"""INSERT INTO activity_rollup_state (partition_name, last_id)
+                    SELECT ?, COALESCE(MAX(id), 0) FROM {partition} WHERE true
+                    ON CONFLICT (partition_name) DO UPDATE SET last_id = excluded.last_id""",
+                (partition,),
+            )
+        dst.commit()
+    finally:
+        src.close()
+        dst.close()
+    return copied
+
+
+def move_user(username, target, drain=None, progress=print):
+    """Move a user's rows to another shard while the server keeps running.
+
+    From the start until the user is switched to the new shard, their writes
+    are refused with UserMoving and reads go to the old shard. Share tokens
+    are indexed on the way, so links made before sharding keep working.
+    Returns the rows copied per table.
+    """
+    if DB_SHARDS <= 1:
+        raise ValueError("Sharding is off, set DB_SHARDS")
+    if target < 0:
+        raise ValueError(f"No shard {target}")
+    if not user_exists(username):
+        raise ValueError(f"User {username} does not exist")
+    source = user_shard(username)
+    if source == target:
+        return {}
+    check_shard_schema(target)
+
+    claim_user(username)
+    try:
+        time.sleep(SHARD_MOVE_DRAIN_SECONDS if drain is None else drain)
+        copied = copy_user(username, source, target)
+        progress(f"{username}: copied to shard {target}: {copied}")
+
+        conn = db_read_connection(shard=target)
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT token FROM share_links WHERE file_id IN (SELECT id FROM files WHERE owner = ?)",
+            (username,),
+        )
+        tokens = [row["token"] for row in cursor.fetchall()]
+        conn.close()
+        index_share_tokens(username, tokens)
+    except BaseException:
+        release_user(username)
+        raise
+    release_user(username, target)
+
+    # What's left on the old shard is never read again, sweep_shards picks
+    # it up if this fails
+    conn = db_connection(shard=source)
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    delete_user_rows(cursor, username)
+    conn.commit()
+    conn.close()
+    progress(f"{username}: moved from shard {source} to {target}")
+
+    publish(username, "resync")
+    publish(username, "usage.changed")
+    return copied
+
+
+def sweep_shards(progress=print):
+    """Delete rows left on shards their users aren't on. Returns {username: shard swept}."""
+    swept = {}
+    for shard in all_shards():
+        conn = db_read_connection(shard=shard)
+        cursor = conn.cursor()
+        cursor.execute(
+            """SELECT owner FROM folders UNION SELECT owner FROM files
+               UNION SELECT username FROM change_journal UNION SELECT username FROM activity_daily"""
+        )
+        owners = [row[0] for row in cursor.fetchall()]
+        conn.close()
+
+        for owner in owners:
+            if user_shard(owner) == shard:
+                continue
+            try:
+                claim_user(owner)
+            except ValueError:
+                continue  # being moved, maybe to here
+            try:
+                if user_shard(owner) != shard:
+                    conn = db_connection(shard=shard)
+                    cursor = conn.cursor()
+                    cursor.execute("BEGIN IMMEDIATE")
+                    delete_user_rows(cursor, owner)
+                    conn.commit()
+                    conn.close()
+                    swept[owner] = shard
+                    progress(f"{owner}: removed leftover rows from shard {shard}")
+            finally:
+                release_user(owner)
+    return swept
+
@@ -0,0 +1,225 @@
+# GuardCloud Change Events
+# Per-user change notifications for files, folders, shares and usage
+#
+# The mutation functions in database.py call publish() after they commit.
+# Every worker process keeps its own subscribers (open /events streams) and
+# delivers to them directly. When EVENT_BROKER is set, events are also sent
+# to a broker so the other workers can deliver them to their subscribers.
+#
+# The broker bundled here is a small local stand-in that relays every line
+# it gets to every other connected worker:
+#
+#   python events.py broker            # listens on EVENT_BROKER (127.0.0.1:8765)
+
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+
+import config
+
+# host:port of the event broker, leave empty for a single worker
+EVENT_BROKER = os.getenv("EVENT_BROKER", "")
+
+# Events buffered per subscriber before we give up and tell it to resync
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "256"))
+
+# Identifies this process so it ignores its own events coming back from the broker
+WORKER_ID = uuid.uuid4().hex
+
+_subscribers = {}
+_listeners = []
+_lock = threading.Lock()
+_broker = None
+
+
+class Subscription:
+    """One open event stream for a user."""
+
+    def __init__(self, username, loop):
+        self.username = username
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+
+    def deliver(self, event):
+        """Hand an event to the stream. Safe to call from any thread."""
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # Event loop already closed, the stream is gone
+            unsubscribe(self)
+
+    def _put(self, event):
+        if self.queue.full():
+            # The client is too far behind, drop what it has and make it refetch
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            event = {"type": "resync", "data": {}, "time": time.time()}
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout):
+        """Wait for the next event. Returns None on timeout."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+def subscribe(username):
+    """Start receiving events for a user. Call from the event loop."""
+    _ensure_broker()
+    subscription = Subscription(username, asyncio.get_running_loop())
+    with _lock:
+        _subscribers.setdefault(username, set()).add(subscription)
+    return subscription
+
+
+def unsubscribe(subscription):
+    """Stop receiving events."""
+    with _lock:
+        subs = _subscribers.get(subscription.username)
+        if subs:
+            subs.discard(subscription)
+            if not subs:
+                del _subscribers[subscription.username]
+
+
+def add_listener(callback):
+    """Call callback(event) for every event, local or from other workers."""
+    _ensure_broker()
+    _listeners.append(callback)
+
+
+def publish(username, event_type, data=None):
+    """Send a change event to a user's open streams on every worker."""
+    event = {
+        "type": event_type,
+        "user": username,
+        "data": data or {},
+        "origin": WORKER_ID,
+        "time": time.time(),
+    }
+    _dispatch(event)
+    if EVENT_BROKER:
+        _ensure_broker()
+        _broker.send(event)
+
+
+def _dispatch(event):
+    for callback in _listeners:
+        callback(event)
+    with _lock:
+        subs = list(_subscribers.get(event["user"], ()))
+    for subscription in subs:
+        subscription.deliver(event)
+
+
+def format_sse(event):
+    """Format an event as a Server-Sent Events message."""
+    payload = json.dumps({"type": event["type"], "data": event["data"], "time": event["time"]})
+    return f"event: {event['type']}\ndata: {payload}\n\n"
+
+
+# ============== Broker ==============
+
+def _parse_address(address):
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def _ensure_broker():
+    global _broker
+    if EVENT_BROKER and _broker is None:
+        with _lock:
+            if _broker is None:
+                _broker = BrokerClient(EVENT_BROKER)
+
+
+class BrokerClient:
+    """Keeps a connection to the broker in a background thread."""
+
+    def __init__(self, address):
+        self.address = _parse_address(address)
+        self.sock = None
+        self.send_lock = threading.Lock()
+        thread = threading.Thread(target=self._run, name="event-broker", daemon=True)
+        thread.start()
+
+    def send(self, event):
+        """Forward an event. Dropped if the broker is unreachable right now."""
+        line = (json.dumps(event) + "\n").encode("utf-8")
+        with self.send_lock:
+            if self.sock is None:
+                return
+            try:
+                self.sock.sendall(line)
+            except OSError:
+                self._close()
+
+    def _close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def _run(self):
+        while True:
+            try:
+                sock = socket.create_connection(self.address, timeout=5)
+                sock.settimeout(None)
+            except OSError:
+                time.sleep(1)
+                continue
+            with self.send_lock:
+                self.sock = sock
+            try:
+                for line in sock.makefile("rb"):
+                    event = json.loads(line)
+                    if event.get("origin") != WORKER_ID:
+                        _dispatch(event)
+            except (OSError, ValueError):
+                pass
+            with self.send_lock:
+                self._close()
+            time.sleep(1)
+
+
+async def run_broker(address):
+    """Relay every line from one worker to all the others."""
+    writers = set()
+
+    async def handle(reader, writer):
+        writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                for other in list(writers):
+                    if other is not writer:
+                        try:
+                            other.write(line)
+                        except (ConnectionError, RuntimeError):
+                            writers.discard(other)
+        finally:
+            writers.discard(writer)
+            writer.close()
+
+    host, port = _parse_address(address)
+    server = await asyncio.start_server(handle, host, port)
+    print(f"Event broker listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] != ["broker"]:
+        print("Usage: python events.py broker")
+        sys.exit(1)
+    asyncio.run(run_broker(os.getenv("EVENT_BROKER") or "127.0.0.1:8765"))
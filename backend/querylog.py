@@ -0,0 +1,306 @@
+# GuardCloud Query Log
+# Times every SQL statement run through the database layer
+#
+# Each statement is reduced to a fingerprint (whitespace collapsed, literals
+# replaced with ?) and we keep per-fingerprint timing stats. Statements slower
+# than SLOW_QUERY_MS are logged together with their EXPLAIN QUERY PLAN output.
+
+from sqlcipher3 import dbapi2 as sqlite3
+from contextlib import contextmanager
+import itertools
+import logging
+import os
+import re
+import threading
+import time
+import weakref
+
+import config
+
+logger = logging.getLogger("guardcloud.db")
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+SLOW_QUERY_TOP_N = int(os.getenv("SLOW_QUERY_TOP_N", "20"))
+
+# Cap on how many distinct fingerprints we remember
+MAX_FINGERPRINTS = 500
+
+_stats = {}
+_lock = threading.Lock()
+
+# Per-thread list of statements being captured, see capture()
+_local = threading.local()
+
+# How many VM instructions between progress handler calls while counting
+VM_STEP_GRANULARITY = 10
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_SPACE_RE = re.compile(r"\s+")
+_EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+
+def fingerprint(sql):
+    """Normalize a SQL statement so the same query with different values groups together."""
+    sql = _STRING_RE.sub("?", sql)
+    sql = _NUMBER_RE.sub("?", sql)
+    return _SPACE_RE.sub(" ", sql).strip()
+
+
+def explain(conn, sql, parameters):
+    """Get the EXPLAIN QUERY PLAN output for a statement as a list of lines."""
+    if not sql.lstrip().upper().startswith(_EXPLAINABLE):
+        return []
+    try:
+        cursor = conn.cursor(sqlite3.Cursor)
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, parameters)
+        return [row[3] for row in cursor.fetchall()]
+    except sqlite3.Error:
+        return []
+
+
+@contextmanager
+def capture(plans=False):
+    """Collect every statement run by this thread inside the block.
+
+    Yields a list that fills with one dict per statement (fingerprint,
+    duration_ms, rows). With plans=True each entry also gets its query plan
+    and vm_steps, the number of SQLite VM instructions it ran, which tracks
+    how many rows it had to visit. Counting steps slows queries down, so only
+    use it for diagnostics, not timing.
+    """
+    records = []
+    previous = getattr(_local, "capture", None)
+    _local.capture = (records, plans)
+    try:
+        yield records
+    finally:
+        _local.capture = previous
+
+
+def _capturing():
+    return getattr(_local, "capture", None)
+
+
+def record(conn, sql, parameters, elapsed, rows, vm_steps=None):
+    """Add one statement execution to the stats and log it if it was slow."""
+    # Never record PRAGMAs, PRAGMA key carries the database key
+    if sql.lstrip().upper().startswith("PRAGMA"):
+        return
+
+    duration_ms = elapsed * 1000
+    key = fingerprint(sql)
+    slow = duration_ms >= SLOW_QUERY_MS
+    captured = _capturing()
+    want_plan = slow or (captured is not None and captured[1])
+    plan = explain(conn, sql, parameters) if want_plan else None
+
+    if captured is not None:
+        sample = {"fingerprint": key, "duration_ms": duration_ms, "rows": rows}
+        if captured[1]:
+            sample["plan"] = plan
+            sample["vm_steps"] = vm_steps
+        captured[0].append(sample)
+
+    with _lock:
+        entry = _stats.get(key)
+        if entry is None:
+            if len(_stats) >= MAX_FINGERPRINTS:
+                # Forget the fastest statement to make room
+                fastest = min(_stats, key=lambda k: _stats[k]["max_ms"])
+                del _stats[fastest]
+            entry = _stats[key] = {
+                "fingerprint": key,
+                "calls": 0,
+                "slow_calls": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "rows": 0,
+                "plan": [],
+            }
+        entry["calls"] += 1
+        entry["total_ms"] += duration_ms
+        entry["rows"] += rows
+        if duration_ms > entry["max_ms"]:
+            entry["max_ms"] = duration_ms
+        if slow:
+            entry["slow_calls"] += 1
+            entry["plan"] = plan
+
+    if slow:
+        logger.warning(
+            "Slow query (%.1f ms, %d rows): %s | plan: %s",
+            duration_ms, rows, key, "; ".join(plan) or "n/a",
+        )
+
+
+def get_slow_queries(limit=None):
+    """Get the slowest statements seen so far, slowest first."""
+    limit = limit or SLOW_QUERY_TOP_N
+    with _lock:
+        entries = sorted(_stats.values(), key=lambda e: e["max_ms"], reverse=True)[:limit]
+        return [
+            {
+                "fingerprint": e["fingerprint"],
+                "calls": e["calls"],
+                "slow_calls": e["slow_calls"],
+                "avg_ms": round(e["total_ms"] / e["calls"], 3),
+                "max_ms": round(e["max_ms"], 3),
+                "avg_rows": round(e["rows"] / e["calls"], 1),
+                "plan": list(e["plan"]),
+            }
+            for e in entries
+        ]
+
+
+def reset_stats():
+    """Clear all recorded query stats."""
+    with _lock:
+        _stats.clear()
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that times execute() plus the fetches or iteration that read its rows.
+
+    A query whose rows aren't all read is recorded when the cursor is closed
+    or dropped, or when its connection is closed, whichever comes first.
+    """
+
+    _pending = None
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        steps = self._count_steps()
+        start = time.perf_counter()
+        super().execute(sql, parameters)
+        elapsed = time.perf_counter() - start
+
+        self._pending = [sql, parameters, elapsed, 0, steps]
+        if self.description is None:
+            # Not a query, nothing to fetch
+            self._pending[3] = max(self.rowcount, 0)
+            self._finish()
+        else:
+            self.connection.track(self)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        # The first set of parameters is kept for the query plan
+        parameters = iter(seq_of_parameters)
+        first = next(parameters, None)
+        if first is not None:
+            parameters = itertools.chain([first], parameters)
+        steps = self._count_steps()
+        start = time.perf_counter()
+        super().executemany(sql, parameters)
+        elapsed = time.perf_counter() - start
+
+        # executemany() only runs statements that return no rows
+        self._pending = [sql, first or (), elapsed, max(self.rowcount, 0), steps]
+        self._finish()
+        return self
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        if self._pending:
+            self._pending[2] += time.perf_counter() - start
+            self._pending[3] += row is not None
+            self._finish()
+        return row
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        if self._pending:
+            self._pending[2] += time.perf_counter() - start
+            self._pending[3] += len(rows)
+            self._finish()
+        return rows
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        start = time.perf_counter()
+        rows = super().fetchmany(size)
+        if self._pending:
+            self._pending[2] += time.perf_counter() - start
+            self._pending[3] += len(rows)
+            if len(rows) < size:
+                # Nothing left to fetch
+                self._finish()
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            if self._pending:
+                self._pending[2] += time.perf_counter() - start
+                self._finish()
+            raise
+        if self._pending:
+            self._pending[2] += time.perf_counter() - start
+            self._pending[3] += 1
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._finish()
+        except sqlite3.Error:
+            # The connection was closed under it
+            pass
+
+    def _count_steps(self):
+        captured = _capturing()
+        if captured is None or not captured[1]:
+            return None
+        steps = [0]
+
+        def tick():
+            steps[0] += VM_STEP_GRANULARITY
+            return 0
+
+        self.connection.set_progress_handler(tick, VM_STEP_GRANULARITY)
+        return steps
+
+    def _finish(self):
+        if self._pending:
+            sql, parameters, elapsed, rows, steps = self._pending
+            self._pending = None
+            if steps is not None:
+                self.connection.set_progress_handler(None, 0)
+                steps = steps[0]
+            record(self.connection, sql, parameters, elapsed, rows, steps)
+
+
+class QueryLogConnection(sqlite3.Connection):
+    """Connection whose cursors are timed by default."""
+
+    # Cursors that may still have a query being read, see track()
+    _unfinished = None
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or TimedCursor)
+
+    def track(self, cursor):
+        """Remember a cursor whose query is still being read."""
+        if self._unfinished is None:
+            self._unfinished = weakref.WeakSet()
+        self._unfinished.add(cursor)
+
+    def finish_statements(self):
+        """Record the queries whose rows were never all read."""
+        if self._unfinished:
+            for cursor in list(self._unfinished):
+                cursor._finish()
+            self._unfinished.clear()
+
+    def close(self):
+        self.finish_statements()
+        super().close()
@@ -0,0 +1,109 @@
+# GuardCloud Token Revocation
+# Ends sessions before their token expires, on logout and password change
+#
+# Revocations are stored in the token_revocations table and every worker
+# keeps a copy in memory, so checking a token on each request never touches
+# the database. Workers pull only the rows added since the last one they
+# saw, at most every REVOCATION_SYNC_SECONDS, and straight away when another
+# worker announces a revocation through the change events.
+
+import os
+import threading
+import time
+
+import config
+from database import save_token_revocation, get_token_revocations
+from security import TOKEN_EXPIRY_MINUTES
+import events
+
+# Longest a revocation made on another worker can go unnoticed if its event is lost
+REVOCATION_SYNC_SECONDS = float(os.getenv("REVOCATION_SYNC_SECONDS", "5"))
+
+# jti -> expires_at of single revoked tokens
+_revoked = {}
+
+# username -> (not_before, expires_at): tokens issued before not_before are revoked
+_not_before = {}
+
+_last_seq = 0
+_next_sync = 0.0
+_sync_lock = threading.Lock()
+
+
+def _apply(row):
+    if row["jti"]:
+        _revoked[row["jti"]] = row["expires_at"]
+    else:
+        current = _not_before.get(row["username"])
+        if current is None or row["not_before"] > current[0]:
+            _not_before[row["username"]] = (row["not_before"], row["expires_at"])
+
+
+def _prune():
+    now = time.time()
+    for jti in [j for j, expires in _revoked.items() if expires < now]:
+        _revoked.pop(jti, None)
+    for user in [u for u, entry in _not_before.items() if entry[1] < now]:
+        _not_before.pop(user, None)
+
+
+def sync(force=False):
+    """Pull revocations recorded since the last sync, if one is due."""
+    global _last_seq, _next_sync
+    if not force and time.monotonic() < _next_sync:
+        return
+    # One thread syncs, the others keep using what is already loaded
+    if not _sync_lock.acquire(blocking=force):
+        return
+    try:
+        rows = get_token_revocations(_last_seq)
+        for row in rows:
+            _apply(row)
+        if rows:
+            _last_seq = rows[-1]["seq"]
+        _prune()
+        _next_sync = time.monotonic() + REVOCATION_SYNC_SECONDS
+    finally:
+        _sync_lock.release()
+
+
+def is_revoked(claims):
+    """Check decoded token claims against the revocations. No I/O unless a sync is due."""
+    sync()
+    jti = claims.get("jti")
+    if jti and jti in _revoked:
+        return True
+    entry = _not_before.get(claims["sub"])
+    # Tokens from before iat was added count as issued at 0
+    return entry is not None and claims.get("iat", 0) < entry[0]
+
+
+def revoke_token(claims):
+    """Revoke one token. Returns False for old tokens without a jti."""
+    jti = claims.get("jti")
+    if not jti:
+        return False
+    username = claims["sub"]
+    seq = save_token_revocation(username, claims["exp"], jti=jti)
+    _apply({"seq": seq, "username": username, "jti": jti, "expires_at": claims["exp"]})
+    events.publish(username, "session.revoked")
+    return True
+
+
+def revoke_all(username):
+    """Revoke every token the user has been given until now."""
+    now = round(time.time(), 3)
+    expires_at = now + TOKEN_EXPIRY_MINUTES * 60
+    seq = save_token_revocation(username, expires_at, not_before=now)
+    _apply({"seq": seq, "username": username, "jti": None, "not_before": now, "expires_at": expires_at})
+    events.publish(username, "session.revoked")
+
+
+def _on_event(event):
+    global _next_sync
+    if event["type"] == "session.revoked":
+        # Another worker saved a revocation, pick it up on the next check
+        _next_sync = 0.0
+
+
+events.add_listener(_on_event)
@@ -0,0 +1,301 @@
+# GuardCloud Storage Scrub
+# Checks that the database and STORAGE_ROOT still agree
+#
+#   cd backend
+#   python scrub.py --workers 4 --checkpoint scrub.json --output report.json
+#   python scrub.py --repair
+#
+# Every file and share copy row is checked for a blob at its stored_path
+# holding as many bytes (of original data, for compressed uploads and
+# encrypted share copies) as the row says. At the same time the storage tree
+# is walked for orphans, files no row refers to. Files younger than
+# SCRUB_MIN_AGE_SECONDS are never orphans, they may be uploads whose row is
+# still being written. --workers and --max-per-s bound how much I/O the
+# scrub puts on the disk next to live traffic.
+#
+# With --checkpoint, progress and findings are saved as the scrub goes, and
+# running the same command again after an interruption continues from it.
+# The file is removed once a scrub completes.
+#
+# --repair deletes orphans and the rows of files whose blob is missing,
+# checking each again first. Size mismatches and broken share copies are
+# only reported, they need someone to look at them.
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import argparse
+import json
+import os
+import struct
+import sys
+import threading
+import time
+
+import config
+from database import (
+    check_schema,
+    get_file_blobs,
+    get_share_copy_blobs,
+    get_referenced_paths,
+    delete_file_permanent,
+    log_activity,
+)
+import storage
+
+STORAGE_ROOT = Path(os.getenv("STORAGE_ROOT", "storage"))
+
+# Files younger than this are not reported as orphans
+SCRUB_MIN_AGE_SECONDS = float(os.getenv("SCRUB_MIN_AGE_SECONDS", "3600"))
+
+FINDINGS = ("missing", "size_mismatch", "unreadable", "orphans")
+
+
+class RateLimit:
+    """Lets at most `per_second` checks through per second, across threads."""
+
+    def __init__(self, per_second):
+        self.interval = 1 / per_second if per_second else 0
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next - now
+            self.next = max(self.next, now) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Checkpoint:
+    """Scrub progress and findings, saved to `path` so a scrub can resume."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {"files_after": 0, "copies_after": 0, "dirs_done": [], **{kind: [] for kind in FINDINGS}}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.state.update(json.load(f))
+        self.dirs_done = set(self.state["dirs_done"])
+
+        # Drop what was found past the last save, it gets checked again
+        after = {"files": self.state["files_after"], "share_copies": self.state["copies_after"]}
+        for kind in ("missing", "size_mismatch", "unreadable"):
+            self.state[kind] = [f for f in self.state[kind] if f["id"] <= after[f["table"]]]
+        self.state["orphans"] = [f for f in self.state["orphans"] if os.path.dirname(f["path"]) in self.dirs_done]
+
+    def add(self, kind, finding):
+        with self.lock:
+            self.state[kind].append(finding)
+
+    def advance(self, key, value):
+        with self.lock:
+            self.state[key] = value
+        self.save()
+
+    def dir_done(self, path):
+        with self.lock:
+            self.dirs_done.add(path)
+            self.state["dirs_done"].append(path)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            text = json.dumps(self.state)
+            tmp = f"{self.path}.{threading.get_ident()}.tmp"
+            with open(tmp, "w") as f:
+                f.write(text)
+            os.replace(tmp, self.path)
+
+    def remove(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def check_blob(table, row):
+    """Compare a row with its blob. Returns (kind, finding) or None if they agree."""
+    path = row["stored_path"]
+    finding = {"table": table, **row}
+    try:
+        if table == "share_copies" and storage.is_encrypted(path):
+            size = storage.EncryptedFile(path).size
+        else:
+            size = storage.blob_size(path, row.get("compression", storage.CODEC_NONE))
+    except FileNotFoundError:
+        return "missing", finding
+    except (OSError, ValueError, struct.error) as e:
+        return "unreadable", {**finding, "error": str(e)}
+    if size != row["size"]:
+        return "size_mismatch", {**finding, "actual_size": size}
+    return None
+
+
+def scan_rows(table, fetch, key, checkpoint, executor, limit, batch_size, progress):
+    """Check every row of a table against its blob, one batch at a time."""
+    def check(row):
+        limit()
+        return check_blob(table, row)
+
+    checked = 0
+    while True:
+        rows = fetch(checkpoint.state[key], batch_size)
+        if not rows:
+            return
+        for result in executor.map(check, rows):
+            if result:
+                checkpoint.add(*result)
+        checked += len(rows)
+        checkpoint.advance(key, rows[-1]["id"])
+        progress(f"{table}: {checked} checked, up to id {rows[-1]['id']}")
+
+
+def scan_tree(referenced, checkpoint, limit, min_age, progress):
+    """Walk STORAGE_ROOT for files no row refers to."""
+    started = time.time()
+    for dirpath, dirnames, filenames in os.walk(str(STORAGE_ROOT)):
+        dirnames.sort()
+        if dirpath in checkpoint.dirs_done:
+            continue
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if path in referenced:
+                continue
+            limit()
+            try:
+                stat = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            if started - stat.st_mtime < min_age:
+                continue
+            checkpoint.add("orphans", {"path": path, "size": stat.st_size, "mtime": stat.st_mtime})
+        checkpoint.dir_done(dirpath)
+        if len(checkpoint.dirs_done) % 100 == 0:
+            checkpoint.save()
+            progress(f"storage: {len(checkpoint.dirs_done)} directories walked")
+
+
+def repair(findings, min_age, progress):
+    """Delete orphans and rows of missing files, checking each again first."""
+    rows_deleted = 0
+    for finding in findings["missing"]:
+        if finding["table"] != "files" or os.path.exists(finding["stored_path"]):
+            continue
+        paths = delete_file_permanent(finding["id"], finding["owner"])
+        if paths:
+            log_activity(
+                finding["owner"], "delete",
+                target_type="file", target_id=finding["id"], target_name=finding["filename"],
+                details="scrub: stored file missing",
+            )
+            rows_deleted += 1
+            # The file's share copies
+            for path in paths[1:]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    # Rows may have been added since the scan started
+    referenced = get_referenced_paths()
+    orphans_removed = 0
+    orphan_bytes = 0
+    now = time.time()
+    for finding in findings["orphans"]:
+        path = finding["path"]
+        if path in referenced:
+            continue
+        try:
+            stat = os.lstat(path)
+            if now - stat.st_mtime < min_age:
+                continue
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        orphans_removed += 1
+        orphan_bytes += stat.st_size
+    progress(f"repair: {rows_deleted} rows deleted, {orphans_removed} orphans removed")
+    return {"rows_deleted": rows_deleted, "orphans_removed": orphans_removed, "orphan_bytes": orphan_bytes}
+
+
+def scrub(workers=4, max_per_s=0, batch_size=1000, min_age=None, checkpoint_path=None,
+          repair_found=False, progress=print):
+    """Check the database rows and the storage tree against each other. Returns a report."""
+    min_age = SCRUB_MIN_AGE_SECONDS if min_age is None else min_age
+    checkpoint = Checkpoint(checkpoint_path)
+    limit = RateLimit(max_per_s)
+    started = time.monotonic()
+
+    # Loaded before the walk starts, anything newer is skipped by min_age
+    referenced = get_referenced_paths()
+    walker_error = []
+
+    def walk():
+        try:
+            scan_tree(referenced, checkpoint, limit, min_age, progress)
+        except Exception as e:
+            walker_error.append(e)
+
+    walker = threading.Thread(target=walk, name="scrub-walk")
+    walker.start()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        scan_rows("files", get_file_blobs, "files_after", checkpoint, executor, limit, batch_size, progress)
+        scan_rows("share_copies", get_share_copy_blobs, "copies_after", checkpoint, executor, limit, batch_size,
+                  progress)
+    walker.join()
+    if walker_error:
+        checkpoint.save()
+        raise walker_error[0]
+
+    findings = {kind: checkpoint.state[kind] for kind in FINDINGS}
+    report = {
+        "seconds": round(time.monotonic() - started, 3),
+        "counts": {kind: len(items) for kind, items in findings.items()},
+        "orphan_bytes": sum(item["size"] for item in findings["orphans"]),
+        **findings,
+    }
+    if repair_found:
+        report["repaired"] = repair(findings, min_age, progress)
+    checkpoint.remove()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find missing, wrong-sized and orphaned stored files.")
+    parser.add_argument("--workers", type=int, default=4, help="rows checked at the same time")
+    parser.add_argument("--max-per-s", type=float, default=0, help="most files checked per second (0 for no limit)")
+    parser.add_argument("--batch-size", type=int, default=1000, help="rows read per query")
+    parser.add_argument("--min-age", type=float, help="seconds before a file can be an orphan (SCRUB_MIN_AGE_SECONDS)")
+    parser.add_argument("--checkpoint", help="save progress here and resume from it")
+    parser.add_argument("--repair", action="store_true", help="delete orphans and rows of missing files")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    check_schema()
+    report = scrub(
+        workers=args.workers,
+        max_per_s=args.max_per_s,
+        batch_size=args.batch_size,
+        min_age=args.min_age,
+        checkpoint_path=args.checkpoint,
+        repair_found=args.repair,
+        progress=lambda message: print(message, file=sys.stderr),
+    )
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    print(text)
+    if args.repair:
+        # Only orphans and missing files are repaired
+        unresolved = report["counts"]["size_mismatch"] + report["counts"]["unreadable"]
+        unresolved += sum(1 for f in report["missing"] if f["table"] != "files")
+    else:
+        unresolved = sum(report["counts"].values())
+    sys.exit(1 if unresolved else 0)
+
+
+if __name__ == "__main__":
+    main()
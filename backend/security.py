@@ -4,16 +4,17 @@
 # This security file supports the following Functional Requirements:
 # FR-2: User authentication (login/signup) via JWT tokens and password hashing
 # FR-6: Data encryption in transit via secure token-based authentication
-# FR-20: Logout via token expiration (TOKEN_EXPIRY_MINUTES)
+# FR-20: Logout via token expiration (TOKEN_EXPIRY_MINUTES) and revocation (revocation.py)
 
 from datetime import datetime, timedelta
-from dotenv import load_dotenv
 import re
 import bcrypt
 import jwt
 import os
+import secrets
+import time
 
-load_dotenv()
+import config
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
@@ -22,23 +23,36 @@ TOKEN_EXPIRY_MINUTES = int(os.getenv("TOKEN_EXPIRY_MINUTES", "60"))
 def create_jwt_token(username):
     """Create a JWT token for a logged in user."""
     expiration = datetime.utcnow() + timedelta(minutes=TOKEN_EXPIRY_MINUTES)
-    payload = {"sub": username, "exp": expiration}
+    payload = {
+        "sub": username,
+        "exp": expiration,
+        # Millisecond issue time, so a password change can revoke tokens
+        # issued a moment before it without touching ones issued right after
+        "iat": round(time.time(), 3),
+        # Unique id so this one token can be revoked on logout
+        "jti": secrets.token_hex(16),
+    }
     return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
 
 
-def verify_jwt_token(token):
-    """Check if a JWT token is valid and not expired. Returns username or None."""
+def decode_jwt_token(token):
+    """Check if a JWT token is valid and not expired. Returns its claims or None."""
     if not token:
         return None
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload["sub"]
+        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     except jwt.ExpiredSignatureError:
         return None
     except jwt.InvalidTokenError:
         return None
 
 
+def verify_jwt_token(token):
+    """Check if a JWT token is valid and not expired. Returns username or None."""
+    payload = decode_jwt_token(token)
+    return payload["sub"] if payload else None
+
+
 def password_req(password):
     """Check password strength. Returns error message or empty list if OK."""
     corrections = []
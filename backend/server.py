@@ -1,18 +1,33 @@
 # GuardCloud Backend Server
 # REST API for file storage, sharing, and user authentication
 
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Request, Header, Response, Query, Form
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Request, Header, Response, Query, Form
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from dotenv import load_dotenv
+from starlette.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
 from pathlib import Path
+from urllib.parse import quote
+import asyncio
 import os
-import uvicorn
+import json
+import codecs
+import hashlib
+import logging
+import re
 import mimetypes
+import threading
+import time
 from typing import Optional
 
+try:
+    import orjson
+except ImportError:  # optional, only makes compact listings faster
+    orjson = None
+
+import config
 from database import (
-    Initialize_db,
+    check_schema,
     signup_db,
     login_db,
     save_file_metadata,
@@ -21,77 +36,299 @@ from database import (
     get_user_info,
     update_user_email,
     update_user_password,
-    rename_file,
-    move_file,
-    trash_file,
-    restore_file,
-    delete_file_permanent,
     search_files,
     get_trashed_files,
     create_folder,
     get_folders,
     get_folder_by_id,
     rename_folder,
+    move_folder,
     trash_folder,
     delete_folder_permanent,
     get_folder_path,
-    create_share_link,
     get_share_link,
     get_file_share_links,
+    get_share_download_count,
     increment_share_download,
     delete_share_link,
+    find_share_copy,
+    collect_share_copies,
     log_activity,
     get_user_activity,
+    archive_activity,
+    rollup_activity,
+    get_activity_rollups,
+    get_top_active_users,
     get_storage_used,
-    get_file_count,
+    get_user_summary,
+    get_storage_breakdown,
+    get_largest_files,
+    get_changes,
+    compact_change_journal,
+    UnitOfWork,
+    UserMoving,
 )
-from security import password_req, hash_it, create_jwt_token, verify_jwt_token, authentication
-
-load_dotenv()
+from security import password_req, hash_it, create_jwt_token, decode_jwt_token, authentication
+from querylog import get_slow_queries, SLOW_QUERY_MS
+from cache import TTLCache
+from admission import UploadAdmission
+import events
+import revocation
+import storage
 
-"""
-This meets Functional Requirement #1:
-FR-1: The user SHALL be able to access the web app from their browser of choice by entering in a URL.
-
-The FastAPI server hosts all endpoints that the frontend uses.
-"""
-app = FastAPI(title="GuardCloud API", version="1.0.0")
-
-# Allow cross-origin requests from the frontend
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+logger = logging.getLogger("guardcloud.storage")
 
 # File storage location
 STORAGE_ROOT = Path(os.getenv("STORAGE_ROOT", "storage"))
-STORAGE_ROOT.mkdir(parents=True, exist_ok=True)
 
 # 15GB storage limit per user
 STORAGE_LIMIT = int(os.getenv("STORAGE_LIMIT", 15 * 1024 * 1024 * 1024))
 
-# Set up database on startup
-Initialize_db()
+# Largest single upload in bytes, 0 for no limit besides the storage limit
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", "0"))
+
+# Usernames allowed to use the /admin endpoints
+ADMIN_USERS = {u.strip() for u in os.getenv("ADMIN_USERS", "").split(",") if u.strip()}
+
+# Per-user profile and storage summary used by /auth/me and /storage.
+# Entries are dropped when a change event says the numbers moved, the TTL
+# only bounds staleness if an event from another worker is lost.
+user_summary_cache = TTLCache(
+    "user_summary",
+    max_entries=int(os.getenv("SUMMARY_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("SUMMARY_CACHE_TTL", "30")),
+)
+
+# Public share link metadata by token. Download counts aren't cached, they
+# are read and limited in the database.
+share_cache = TTLCache(
+    "share_links",
+    max_entries=int(os.getenv("SHARE_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("SHARE_CACHE_TTL", "60")),
+)
+
+# Tokens that don't exist, so each guess in a scan doesn't cost a query
+share_miss_cache = TTLCache(
+    "share_link_misses",
+    max_entries=int(os.getenv("SHARE_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("SHARE_NEGATIVE_TTL", "30")),
+)
+
+# Longest the analytics endpoints go without folding new activity into the rollups
+ACTIVITY_ROLLUP_SECONDS = float(os.getenv("ACTIVITY_ROLLUP_SECONDS", "60"))
+
+# How often a worker sweeps for share copies of dead links (0 turns it off,
+# leaving it to POST /admin/share-copies/collect)
+SHARE_COPY_COLLECT_SECONDS = float(os.getenv("SHARE_COPY_COLLECT_SECONDS", "3600"))
+
+# Listings requested with ?format=compact or this Accept type list the column
+# names once and every entry as an array, instead of one object per entry
+COMPACT_MEDIA_TYPE = "application/vnd.guardcloud.compact+json"
+
+# Every endpoint is registered here and added to the app by create_app()
+router = APIRouter()
 
 
 # ============== Helper Functions ==============
 
-def get_current_user(authorization: str = Header(default=None)):
-    """Get the username from the JWT token in the Authorization header."""
+def get_token_claims(authorization: str = Header(default=None)):
+    """Get the claims of the JWT token in the Authorization header."""
     if not authorization:
         raise HTTPException(status_code=401, detail="Missing Authorization header")
     if not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Invalid Authorization header")
 
     token = authorization.split(" ", 1)[1]
-    username = verify_jwt_token(token)
-    if not username:
+    claims = decode_jwt_token(token)
+    if not claims or revocation.is_revoked(claims):
         raise HTTPException(status_code=401, detail="Invalid or expired token")
 
-    return username
+    return claims
+
+
+def get_current_user(authorization: str = Header(default=None)):
+    """Get the username from the JWT token in the Authorization header."""
+    return get_token_claims(authorization)["sub"]
+
+
+def get_admin_user(current_user: str = Depends(get_current_user)):
+    """Only let users listed in ADMIN_USERS through."""
+    if current_user not in ADMIN_USERS:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return current_user
+
+
+def get_cached_summary(username: str):
+    """Get a user's profile, storage used and file count, cached per user."""
+    return user_summary_cache.get_or_load(username, lambda: get_user_summary(username))
+
+
+def invalidate_summary(event):
+    """Drop a user's cached summary when their usage or profile changes."""
+    if event["type"] in ("usage.changed", "user.updated"):
+        user_summary_cache.invalidate(event["user"])
+
+
+events.add_listener(invalidate_summary)
+
+
+def load_share(token: str):
+    """A share link without its download count, which changes too often to cache."""
+    share = get_share_link(token)
+    if share:
+        del share["download_count"]
+    return share
+
+
+def get_cached_share(token: str):
+    """Get share link metadata by token, cached along with unknown tokens.
+
+    The download count isn't in it, see get_share_download_count.
+    """
+    if share_miss_cache.get(token):
+        return None
+    share = share_cache.get_or_load(token, lambda: load_share(token))
+    if share is None:
+        share_miss_cache.set(token, True)
+    return share
+
+
+def forget_share(token: str):
+    """Drop a share link found to be gone, for workers that missed its event."""
+    share_cache.invalidate(token)
+    share_miss_cache.set(token, True)
+
+
+def invalidate_shares(event):
+    """Drop cached share links whose link, file or folder changed."""
+    data = event["data"]
+    if event["type"] == "share.deleted":
+        share_cache.invalidate_where(lambda share: share["id"] == data["id"])
+    elif event["type"] in ("file.deleted", "file.updated"):
+        share_cache.invalidate_where(lambda share: share["file_id"] == data["id"])
+    elif event["type"] == "folder.deleted":
+        # We don't know which files were in it, drop all of the owner's links
+        share_cache.invalidate_where(lambda share: share["owner"] == event["user"])
+
+
+events.add_listener(invalidate_shares)
+
+
+def wants_compact(request: Request, format: Optional[str]) -> bool:
+    """Check if the client asked for the compact columnar listing format."""
+    return format == "compact" or COMPACT_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def compact_response(payload: dict) -> Response:
+    """Serialize a compact listing without going through FastAPI's encoder."""
+    if orjson:
+        body = orjson.dumps(payload)
+    else:
+        body = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    return Response(content=body, media_type=COMPACT_MEDIA_TYPE)
+
+
+def parse_range(range_header: Optional[str], size: int):
+    """Parse a single `bytes=start-end` Range header.
+
+    Returns (start, end) inclusive, or None to send the whole file.
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    first, _, last = range_header[len("bytes="):].partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            start = max(size - int(last), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, min(end, size - 1)
+
+
+def segmented_file_response(blob, filename: Optional[str], media_type: str, range_header: Optional[str]):
+    """Stream a storage.EncryptedFile or storage.CompressedFile, honoring Range.
+
+    Only the segments covering the requested bytes are read and decoded.
+    Sizes are always those of the original file.
+    """
+    byte_range = parse_range(range_header, blob.size)
+    start, end = byte_range or (0, blob.size - 1)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(max(end - start + 1, 0)),
+    }
+    if filename:
+        headers["Content-Disposition"] = f"attachment; filename*=utf-8''{quote(filename)}"
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{blob.size}"
+    return StreamingResponse(
+        blob.read_range(start, end),
+        status_code=206 if byte_range else 200,
+        media_type=media_type,
+        headers=headers,
+    )
+
+
+def blob_response(path: str, media_type: str, range_header: Optional[str], filename: Optional[str] = None,
+                  compression: int = storage.CODEC_NONE):
+    """Send an uploaded file, decompressing it on the fly if its row says it was stored compressed."""
+    compressed = storage.open_compressed(path, compression)
+    if compressed:
+        return segmented_file_response(compressed, filename, media_type, range_header)
+    return FileResponse(path=path, filename=filename, media_type=media_type)
+
+
+def remove_blob(path):
+    """Delete a stored file whose row is gone. Failures are left for scrub.py to find."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning("Could not remove %s: %s", path, e)
+
+
+def remove_share_copies():
+    """Delete share copies that no link needs anymore, from the database and disk."""
+    paths = collect_share_copies()
+    for path in paths:
+        remove_blob(path)
+    return len(paths)
+
+
+async def sweep_share_copies():
+    """Run remove_share_copies every SHARE_COPY_COLLECT_SECONDS."""
+    while True:
+        await asyncio.sleep(SHARE_COPY_COLLECT_SECONDS)
+        try:
+            await run_in_threadpool(remove_share_copies)
+        except Exception:
+            logger.exception("Share copy sweep failed")
+
+
+_next_rollup = 0.0
+_rollup_lock = threading.Lock()
+
+
+def refresh_activity_rollups():
+    """Fold new activity into the daily rollups if the last run is old enough."""
+    global _next_rollup
+    if time.monotonic() < _next_rollup or not _rollup_lock.acquire(blocking=False):
+        return
+    try:
+        rollup_activity()
+        _next_rollup = time.monotonic() + ACTIVITY_ROLLUP_SECONDS
+    finally:
+        _rollup_lock.release()
 
 
 def get_client_ip(request: Request) -> str:
@@ -104,12 +341,12 @@ def get_client_ip(request: Request) -> str:
 
 # ============== Health Check ==============
 
-@app.get("/health")
+@router.get("/health")
 def health():
     return {"status": "ok"}
 
 
-@app.head("/health")
+@router.head("/health")
 def health_head():
     return Response(status_code=200)
 
@@ -123,7 +360,7 @@ FR-2: The user SHALL be prompted for a login or create account option.
 The signup and login endpoints handle user registration and authentication.
 """
 
-@app.post("/auth/signup")
+@router.post("/auth/signup")
 async def signup(request: Request):
     """Create a new user account."""
     data = await request.json()
@@ -152,7 +389,7 @@ async def signup(request: Request):
     return {"message": "User created. Please log in."}
 
 
-@app.post("/auth/login")
+@router.post("/auth/login")
 async def login(request: Request):
     """Log in and get an authentication token."""
     data = await request.json()
@@ -176,21 +413,20 @@ async def login(request: Request):
     }
 
 
-@app.get("/auth/me")
+@router.get("/auth/me")
 def get_me(current_user: str = Depends(get_current_user)):
     """Get current user's profile and storage info."""
-    user_info = get_user_info(current_user)
-    if not user_info:
+    summary = get_cached_summary(current_user)
+    if not summary:
         raise HTTPException(status_code=404, detail="User not found")
     
-    user_info["storage_used"] = get_storage_used(current_user)
+    user_info = dict(summary)
     user_info["storage_limit"] = STORAGE_LIMIT
-    user_info["file_count"] = get_file_count(current_user)
     
     return user_info
 
 
-@app.put("/auth/profile")
+@router.put("/auth/profile")
 async def update_profile(request: Request, current_user: str = Depends(get_current_user)):
     """Update user's email address."""
     data = await request.json()
@@ -203,7 +439,7 @@ async def update_profile(request: Request, current_user: str = Depends(get_curre
     return {"message": "Profile updated"}
 
 
-@app.put("/auth/password")
+@router.put("/auth/password")
 async def change_password(request: Request, current_user: str = Depends(get_current_user)):
     """Change user's password."""
     data = await request.json()
@@ -224,9 +460,24 @@ async def change_password(request: Request, current_user: str = Depends(get_curr
 
     hashed = hash_it(new_password)
     update_user_password(current_user, hashed)
+
+    # Sign out every other session, this one continues with a fresh token
+    revocation.revoke_all(current_user)
     
     log_activity(current_user, "change_password", ip_address=get_client_ip(request))
-    return {"message": "Password changed successfully"}
+    return {"message": "Password changed successfully", "token": create_jwt_token(current_user)}
+
+
+"""
+This meets Functional Requirement #20:
+FR-20: The user SHALL be able to log out and end an authenticated session.
+"""
+@router.post("/auth/logout")
+def logout(request: Request, claims: dict = Depends(get_token_claims)):
+    """Revoke the token used for this request."""
+    revocation.revoke_token(claims)
+    log_activity(claims["sub"], "logout", ip_address=get_client_ip(request))
+    return {"message": "Logged out"}
 
 
 # ============== File Endpoints ==============
@@ -238,54 +489,68 @@ FR-3: The user SHALL be presented with a file management system after successful
 The file listing endpoints provide the data for the dashboard file view.
 """
 
-@app.get("/files")
+@router.get("/files")
 def list_files(
+    request: Request,
     folder_id: Optional[int] = Query(None),
+    format: Optional[str] = Query(None),
     current_user: str = Depends(get_current_user)
 ):
     """List files and folders in a directory."""
-    files = get_user_files(current_user, folder_id)
-    folders = get_folders(current_user, folder_id)
+    compact = wants_compact(request, format)
+    files = get_user_files(current_user, folder_id, compact=compact)
+    folders = get_folders(current_user, folder_id, compact=compact)
     
     # Build breadcrumb path for navigation
     path = []
     if folder_id:
         path = get_folder_path(folder_id, current_user)
     
-    return {
+    result = {
         "files": files,
         "folders": folders,
         "path": path,
         "current_folder": folder_id
     }
+    return compact_response(result) if compact else result
 
 
 """
 This meets Functional Requirement #10:
 FR-10: The user SHALL be able find files using a search function.
 """
-@app.get("/files/search")
+@router.get("/files/search")
 def search_user_files(
+    request: Request,
     q: str = Query(..., min_length=1),
+    format: Optional[str] = Query(None),
     current_user: str = Depends(get_current_user)
 ):
     """Search files by name."""
-    files = search_files(current_user, q)
-    return {"files": files, "query": q}
+    compact = wants_compact(request, format)
+    files = search_files(current_user, q, compact=compact)
+    result = {"files": files, "query": q}
+    return compact_response(result) if compact else result
 
 
-@app.get("/files/trash")
-def list_trash(current_user: str = Depends(get_current_user)):
+@router.get("/files/trash")
+def list_trash(
+    request: Request,
+    format: Optional[str] = Query(None),
+    current_user: str = Depends(get_current_user)
+):
     """List files in trash."""
-    files = get_trashed_files(current_user)
-    return {"files": files}
+    compact = wants_compact(request, format)
+    files = get_trashed_files(current_user, compact=compact)
+    result = {"files": files}
+    return compact_response(result) if compact else result
 
 
 """
 This meets Functional Requirement #4:
 FR-4: The user SHALL be able to upload files in the file management system.
 """
-@app.post("/files/upload")
+@router.post("/files/upload")
 async def upload_file(
     request: Request,
     file: UploadFile = File(...),
@@ -294,12 +559,17 @@ async def upload_file(
     encrypted: Optional[str] = Form(None),
     current_user: str = Depends(get_current_user),
 ):
-    """Upload a file. Supports encrypted files from the frontend."""
+    """Upload a file. Supports encrypted files from the frontend.
+
+    Uploads that can't fit are usually turned away by UploadAdmission before
+    the body is read, this re-checks the exact size of the received file.
+    """
     # Check storage limit
     current_usage = get_storage_used(current_user)
-    contents = await file.read()
-    file_size = len(contents)
-    
+    file_size = file.size
+
+    if MAX_UPLOAD_SIZE and file_size > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail="File exceeds the maximum upload size")
     if current_usage + file_size > STORAGE_LIMIT:
         raise HTTPException(status_code=413, detail="Storage limit exceeded")
 
@@ -322,8 +592,10 @@ async def upload_file(
         stored_path = user_dir / f"{name}_{counter}{ext}"
         counter += 1
 
-    # Save the file
-    stored_path.write_bytes(contents)
+    # Save the file. Encrypted uploads won't compress, don't even try.
+    file_size, _, compression = await run_in_threadpool(
+        storage.write_blob, stored_path, file.file, encrypted != "true"
+    )
 
     # Use original mime type for encrypted files
     if encrypted == "true" and original_mime_type:
@@ -331,19 +603,25 @@ async def upload_file(
     else:
         mime_type, _ = mimetypes.guess_type(file.filename)
 
-    file_id = save_file_metadata(
-        owner=current_user,
-        filename=file.filename,
-        stored_path=str(stored_path),
-        size=file_size,
-        mime_type=mime_type,
-        folder_id=folder_id,
-    )
+    try:
+        file_id = save_file_metadata(
+            owner=current_user,
+            filename=file.filename,
+            stored_path=str(stored_path),
+            size=file_size,
+            mime_type=mime_type,
+            folder_id=folder_id,
+            compression=compression,
+        )
+    except UserMoving:
+        # Nothing refers to the blob, the client uploads it again
+        remove_blob(stored_path)
+        raise
 
     log_activity(
         current_user, "upload", 
         target_type="file", target_id=file_id, target_name=file.filename,
-        ip_address=get_client_ip(request)
+        ip_address=get_client_ip(request), size=file_size
     )
 
     return {"message": "File uploaded", "file_id": file_id, "encrypted": encrypted == "true"}
@@ -354,7 +632,7 @@ This meets Functional Requirements #8 and #15:
 FR-8: The user SHALL be able to view file information via the web app.
 FR-15: The user SHALL be able to view file details.
 """
-@app.get("/files/{file_id}")
+@router.get("/files/{file_id}")
 def get_file_info(file_id: int, current_user: str = Depends(get_current_user)):
     """Get details about a file."""
     row = get_file_by_id(file_id, current_user)
@@ -375,8 +653,8 @@ def get_file_info(file_id: int, current_user: str = Depends(get_current_user)):
 This meets Functional Requirement #12:
 FR-12: The user SHALL be able to download files.
 """
-@app.get("/files/{file_id}/download")
-def download_file(file_id: int, current_user: str = Depends(get_current_user)):
+@router.get("/files/{file_id}/download")
+def download_file(file_id: int, request: Request, current_user: str = Depends(get_current_user)):
     """Download a file."""
     row = get_file_by_id(file_id, current_user)
     if not row:
@@ -385,15 +663,17 @@ def download_file(file_id: int, current_user: str = Depends(get_current_user)):
     if row["is_trashed"]:
         raise HTTPException(status_code=400, detail="Cannot download trashed file")
 
-    return FileResponse(
-        path=row["stored_path"],
+    return blob_response(
+        row["stored_path"],
+        row["mime_type"] or "application/octet-stream",
+        request.headers.get("range"),
         filename=row["filename"],
-        media_type=row["mime_type"] or "application/octet-stream",
+        compression=row["compression"],
     )
 
 
-@app.get("/files/{file_id}/preview")
-def preview_file(file_id: int, current_user: str = Depends(get_current_user)):
+@router.get("/files/{file_id}/preview")
+def preview_file(file_id: int, request: Request, current_user: str = Depends(get_current_user)):
     """Preview a file (images, text, PDFs)."""
     row = get_file_by_id(file_id, current_user)
     if not row:
@@ -403,18 +683,18 @@ def preview_file(file_id: int, current_user: str = Depends(get_current_user)):
     
     # Images and PDFs - return the file
     if mime_type.startswith("image/") or mime_type == "application/pdf":
-        return FileResponse(
-            path=row["stored_path"],
-            media_type=mime_type,
-        )
+        return blob_response(row["stored_path"], mime_type, request.headers.get("range"),
+                             compression=row["compression"])
     
     # Text files - return content
     if mime_type.startswith("text/") or mime_type in ["application/json", "application/javascript"]:
         try:
-            with open(row["stored_path"], "r", encoding="utf-8") as f:
-                content = f.read(100000)  # Limit to 100KB
+            # Limit to 100KB
+            data = b"".join(storage.read_blob(row["stored_path"], 0, 100000 - 1, compression=row["compression"]))
+            # Don't fail on a character cut in half at the limit
+            content = codecs.getincrementaldecoder("utf-8")().decode(data, final=False)
             return {"content": content, "mime_type": mime_type}
-        except:
+        except Exception:
             raise HTTPException(status_code=400, detail="Cannot read file")
     
     raise HTTPException(status_code=400, detail="Preview not available for this file type")
@@ -425,7 +705,7 @@ This meets Functional Requirements #9 and #11:
 FR-9: The user SHALL be able to manage properties of files within the system.
 FR-11: The user SHALL be able to manage files.
 """
-@app.put("/files/{file_id}/rename")
+@router.put("/files/{file_id}/rename")
 async def rename_file_endpoint(
     file_id: int,
     request: Request,
@@ -438,20 +718,21 @@ async def rename_file_endpoint(
     if not new_name:
         raise HTTPException(status_code=400, detail="Name is required")
 
-    row = get_file_by_id(file_id, current_user)
-    if not row:
-        raise HTTPException(status_code=404, detail="File not found")
+    with UnitOfWork(current_user) as work:
+        row = work.file(file_id)
+        if not row:
+            raise HTTPException(status_code=404, detail="File not found")
 
-    old_name = row["filename"]
-    if not rename_file(file_id, current_user, new_name):
-        raise HTTPException(status_code=400, detail="Could not rename file")
+        old_name = row["filename"]
+        if not work.rename_file(file_id, new_name):
+            raise HTTPException(status_code=400, detail="Could not rename file")
 
-    log_activity(
-        current_user, "rename",
-        target_type="file", target_id=file_id, target_name=new_name,
-        details=f"Renamed from {old_name}",
-        ip_address=get_client_ip(request)
-    )
+        work.log_activity(
+            "rename",
+            target_type="file", target_id=file_id, target_name=new_name,
+            details=f"Renamed from {old_name}",
+            ip_address=get_client_ip(request)
+        )
 
     return {"message": "File renamed"}
 
@@ -462,7 +743,7 @@ FR-16: The user SHALL be able to view the location of files.
 
 Moving files between folders updates their location.
 """
-@app.put("/files/{file_id}/move")
+@router.put("/files/{file_id}/move")
 async def move_file_endpoint(
     file_id: int,
     request: Request,
@@ -472,24 +753,20 @@ async def move_file_endpoint(
     data = await request.json()
     folder_id = data.get("folder_id")  # None means root
 
-    row = get_file_by_id(file_id, current_user)
-    if not row:
-        raise HTTPException(status_code=404, detail="File not found")
-
-    # Verify destination exists
-    if folder_id:
-        folder = get_folder_by_id(folder_id, current_user)
-        if not folder:
+    with UnitOfWork(current_user) as work:
+        # Verify destination exists
+        if folder_id and not work.folder(folder_id):
             raise HTTPException(status_code=404, detail="Destination folder not found")
 
-    if not move_file(file_id, current_user, folder_id):
-        raise HTTPException(status_code=400, detail="Could not move file")
+        row = work.move_file(file_id, folder_id)
+        if not row:
+            raise HTTPException(status_code=404, detail="File not found")
 
-    log_activity(
-        current_user, "move",
-        target_type="file", target_id=file_id, target_name=row["filename"],
-        ip_address=get_client_ip(request)
-    )
+        work.log_activity(
+            "move",
+            target_type="file", target_id=file_id, target_name=row["filename"],
+            ip_address=get_client_ip(request)
+        )
 
     return {"message": "File moved"}
 
@@ -498,85 +775,77 @@ async def move_file_endpoint(
 This meets Functional Requirement #13:
 FR-13: The user SHALL be able to delete files.
 """
-@app.post("/files/{file_id}/trash")
+@router.post("/files/{file_id}/trash")
 async def trash_file_endpoint(
     file_id: int,
     request: Request,
     current_user: str = Depends(get_current_user)
 ):
     """Move a file to trash."""
-    row = get_file_by_id(file_id, current_user)
-    if not row:
-        raise HTTPException(status_code=404, detail="File not found")
-
-    if not trash_file(file_id, current_user):
-        raise HTTPException(status_code=400, detail="Could not trash file")
-
-    log_activity(
-        current_user, "trash",
-        target_type="file", target_id=file_id, target_name=row["filename"],
-        ip_address=get_client_ip(request)
-    )
+    with UnitOfWork(current_user) as work:
+        row = work.trash_file(file_id)
+        if not row:
+            raise HTTPException(status_code=404, detail="File not found")
+
+        work.log_activity(
+            "trash",
+            target_type="file", target_id=file_id, target_name=row["filename"],
+            ip_address=get_client_ip(request)
+        )
 
     return {"message": "File moved to trash"}
 
 
-@app.post("/files/{file_id}/restore")
+@router.post("/files/{file_id}/restore")
 async def restore_file_endpoint(
     file_id: int,
     request: Request,
     current_user: str = Depends(get_current_user)
 ):
     """Restore a file from trash."""
-    row = get_file_by_id(file_id, current_user)
-    if not row:
-        raise HTTPException(status_code=404, detail="File not found")
-
-    if not restore_file(file_id, current_user):
-        raise HTTPException(status_code=400, detail="Could not restore file")
-
-    log_activity(
-        current_user, "restore",
-        target_type="file", target_id=file_id, target_name=row["filename"],
-        ip_address=get_client_ip(request)
-    )
+    with UnitOfWork(current_user) as work:
+        row = work.restore_file(file_id)
+        if not row:
+            raise HTTPException(status_code=404, detail="File not found")
+
+        work.log_activity(
+            "restore",
+            target_type="file", target_id=file_id, target_name=row["filename"],
+            ip_address=get_client_ip(request)
+        )
 
     return {"message": "File restored"}
 
 
-@app.delete("/files/{file_id}")
+@router.delete("/files/{file_id}")
 async def delete_file_endpoint(
     file_id: int,
     request: Request,
     current_user: str = Depends(get_current_user)
 ):
     """Permanently delete a file."""
-    row = get_file_by_id(file_id, current_user)
-    if not row:
-        raise HTTPException(status_code=404, detail="File not found")
-
-    filename = row["filename"]
-    stored_path = delete_file_permanent(file_id, current_user)
-    
-    # Remove file from disk
-    if stored_path:
-        try:
-            os.remove(stored_path)
-        except:
-            pass
+    with UnitOfWork(current_user) as work:
+        row = work.delete_file(file_id)
+        if not row:
+            raise HTTPException(status_code=404, detail="File not found")
+
+        work.log_activity(
+            "delete",
+            target_type="file", target_id=file_id, target_name=row["filename"],
+            ip_address=get_client_ip(request), size=row["size"]
+        )
 
-    log_activity(
-        current_user, "delete",
-        target_type="file", target_id=file_id, target_name=filename,
-        ip_address=get_client_ip(request)
-    )
+    # Remove file and its share copies from disk
+    remove_blob(row["stored_path"])
+    for path in work.share_copy_paths:
+        remove_blob(path)
 
     return {"message": "File deleted permanently"}
 
 
 # ============== Folder Endpoints ==============
 
-@app.post("/folders")
+@router.post("/folders")
 async def create_folder_endpoint(
     request: Request,
     current_user: str = Depends(get_current_user)
@@ -606,7 +875,7 @@ async def create_folder_endpoint(
     return {"message": "Folder created", "folder_id": folder_id}
 
 
-@app.get("/folders/{folder_id}")
+@router.get("/folders/{folder_id}")
 def get_folder_info(folder_id: int, current_user: str = Depends(get_current_user)):
     """Get folder details."""
     folder = get_folder_by_id(folder_id, current_user)
@@ -616,7 +885,7 @@ def get_folder_info(folder_id: int, current_user: str = Depends(get_current_user
     return folder
 
 
-@app.put("/folders/{folder_id}/rename")
+@router.put("/folders/{folder_id}/rename")
 async def rename_folder_endpoint(
     folder_id: int,
     request: Request,
@@ -647,7 +916,39 @@ async def rename_folder_endpoint(
     return {"message": "Folder renamed"}
 
 
-@app.post("/folders/{folder_id}/trash")
+@router.put("/folders/{folder_id}/move")
+async def move_folder_endpoint(
+    folder_id: int,
+    request: Request,
+    current_user: str = Depends(get_current_user)
+):
+    """Move a folder into another folder."""
+    data = await request.json()
+    parent_id = data.get("parent_id")  # None means root
+
+    folder = get_folder_by_id(folder_id, current_user)
+    if not folder:
+        raise HTTPException(status_code=404, detail="Folder not found")
+
+    # Verify destination exists
+    if parent_id:
+        parent = get_folder_by_id(parent_id, current_user)
+        if not parent:
+            raise HTTPException(status_code=404, detail="Destination folder not found")
+
+    if not move_folder(folder_id, current_user, parent_id):
+        raise HTTPException(status_code=400, detail="Cannot move a folder into itself or its subfolders")
+
+    log_activity(
+        current_user, "move",
+        target_type="folder", target_id=folder_id, target_name=folder["name"],
+        ip_address=get_client_ip(request)
+    )
+
+    return {"message": "Folder moved"}
+
+
+@router.post("/folders/{folder_id}/trash")
 async def trash_folder_endpoint(
     folder_id: int,
     request: Request,
@@ -669,7 +970,7 @@ async def trash_folder_endpoint(
     return {"message": "Folder moved to trash"}
 
 
-@app.delete("/folders/{folder_id}")
+@router.delete("/folders/{folder_id}")
 async def delete_folder_endpoint(
     folder_id: int,
     request: Request,
@@ -683,12 +984,9 @@ async def delete_folder_endpoint(
     folder_name = folder["name"]
     file_paths = delete_folder_permanent(folder_id, current_user)
 
-    # Delete files from disk
+    # Delete files and their share copies from disk
     for path in file_paths:
-        try:
-            os.remove(path)
-        except:
-            pass
+        remove_blob(path)
 
     log_activity(
         current_user, "delete",
@@ -707,7 +1005,7 @@ FR-5: The user SHALL be able to share files.
 FR-14: The user SHALL be able to share files.
 FR-18: The user SHALL be able to grant file access permissions.
 """
-@app.post("/files/{file_id}/share")
+@router.post("/files/{file_id}/share")
 async def create_share(
     file_id: int,
     request: Request,
@@ -715,57 +1013,90 @@ async def create_share(
     password: Optional[str] = Form(None),
     expires_in_days: Optional[int] = Form(None),
     max_downloads: Optional[int] = Form(None),
+    content_hash: Optional[str] = Form(None),
     current_user: str = Depends(get_current_user)
 ):
     """Create a share link for a file.
     
     Accepts a decrypted copy of the file for sharing so recipients 
-    don't need the encryption key.
+    don't need the encryption key. All links to the same file share one
+    copy per content_hash (SHA-256 of the decrypted file, hex). Send just
+    the hash first, if the server has no copy with it yet the answer is 409
+    and the file has to be uploaded.
     """
-    row = get_file_by_id(file_id, current_user)
-    if not row:
+    if not get_file_by_id(file_id, current_user):
         raise HTTPException(status_code=404, detail="File not found")
 
-    # Store decrypted file for sharing if provided
+    if content_hash:
+        content_hash = content_hash.lower()
+        if not re.fullmatch(r"[0-9a-f]{64}", content_hash):
+            raise HTTPException(status_code=400, detail="content_hash must be a hex SHA-256 digest")
+
+    # Store decrypted file for sharing if provided and not already stored,
+    # encrypted at rest with the server's storage key
     share_stored_path = None
-    if file:
+    share_size = None
+    if file and not (content_hash and find_share_copy(file_id, current_user, content_hash)):
         import uuid
         shares_dir = STORAGE_ROOT / "shares" / current_user
         shares_dir.mkdir(parents=True, exist_ok=True)
         
-        share_filename = f"{uuid.uuid4().hex}_{row['filename']}"
-        share_stored_path = shares_dir / share_filename
-        
-        contents = await file.read()
-        share_stored_path.write_bytes(contents)
-        share_stored_path = str(share_stored_path)
-
+        share_stored_path = shares_dir / uuid.uuid4().hex
+        hasher = hashlib.sha256()
+        share_size = await run_in_threadpool(storage.write_encrypted, share_stored_path, file.file, None, hasher)
+        if content_hash and hasher.hexdigest() != content_hash:
+            share_stored_path.unlink()
+            raise HTTPException(status_code=400, detail="Uploaded file does not match content_hash")
+        content_hash = hasher.hexdigest()
+        if find_share_copy(file_id, current_user, content_hash):
+            # Same content as an existing copy, the client just didn't say so
+            share_stored_path.unlink()
+            share_stored_path = None
+        else:
+            share_stored_path = str(share_stored_path)
+
+    # The unit only opens once the copy is written. Its connection is on the
+    # user's shard at that moment, a unit held across the upload could commit
+    # on a shard the user has been moved away from.
     password_hash = hash_it(password) if password else None
-    token = create_share_link(
-        file_id, current_user,
-        password_hash=password_hash,
-        expires_in_days=expires_in_days,
-        max_downloads=max_downloads,
-        share_stored_path=share_stored_path
-    )
-
-    log_activity(
-        current_user, "share",
-        target_type="file", target_id=file_id, target_name=row["filename"],
-        ip_address=get_client_ip(request)
-    )
-
-    return {"token": token, "url": f"/share/{token}"}
-
-
-@app.get("/files/{file_id}/shares")
+    try:
+        with UnitOfWork(current_user) as work:
+            row = work.file(file_id)
+            if not row:
+                raise HTTPException(status_code=404, detail="File not found")
+
+            token = work.create_share_link(
+                file_id,
+                password_hash=password_hash,
+                expires_in_days=expires_in_days,
+                max_downloads=max_downloads,
+                share_stored_path=share_stored_path,
+                content_hash=content_hash,
+                share_size=share_size,
+            )
+            if not token:
+                raise HTTPException(status_code=409, detail="No share copy with this content_hash, upload the file")
+
+            work.log_activity(
+                "share",
+                target_type="file", target_id=file_id, target_name=row["filename"],
+                ip_address=get_client_ip(request)
+            )
+    except Exception:
+        # Rolled back, nothing refers to the copy we just wrote
+        if share_stored_path:
+            remove_blob(share_stored_path)
+        raise
+
+    return {"token": token, "url": f"/share/{token}", "content_hash": content_hash}
+
+
+@router.get("/files/{file_id}/shares")
 def list_file_shares(file_id: int, current_user: str = Depends(get_current_user)):
     """List all share links for a file."""
-    row = get_file_by_id(file_id, current_user)
-    if not row:
-        raise HTTPException(status_code=404, detail="File not found")
-
     shares = get_file_share_links(file_id, current_user)
+    if shares is None:
+        raise HTTPException(status_code=404, detail="File not found")
     return {"shares": shares}
 
 
@@ -774,25 +1105,28 @@ This meets Functional Requirements #17 and #19:
 FR-17: The user SHALL be able to delete shared files.
 FR-19: The user SHALL be able to revoke file access permissions.
 """
-@app.delete("/shares/{link_id}")
+@router.delete("/shares/{link_id}")
 async def delete_share(
     link_id: int,
     request: Request,
     current_user: str = Depends(get_current_user)
 ):
     """Delete a share link to revoke access."""
-    if not delete_share_link(link_id, current_user):
+    paths = delete_share_link(link_id, current_user)
+    if paths is None:
         raise HTTPException(status_code=404, detail="Share link not found")
+    for path in paths:
+        remove_blob(path)
 
     return {"message": "Share link deleted"}
 
 
 # ============== Public Share Download ==============
 
-@app.get("/share/{token}")
+@router.get("/share/{token}")
 def get_shared_file_info(token: str):
     """Get info about a shared file (no auth required)."""
-    share = get_share_link(token)
+    share = get_cached_share(token)
     if not share:
         raise HTTPException(status_code=404, detail="Share link not found")
 
@@ -802,8 +1136,13 @@ def get_shared_file_info(token: str):
         if datetime.fromisoformat(share["expires_at"]) < datetime.now():
             raise HTTPException(status_code=410, detail="Share link has expired")
 
-    # Check download limit
-    if share["max_downloads"] and share["download_count"] >= share["max_downloads"]:
+    # The cached link may have been deleted by another worker, and the
+    # download limit is checked against the live count
+    download_count = get_share_download_count(token, share["owner"])
+    if download_count is None:
+        forget_share(token)
+        raise HTTPException(status_code=404, detail="Share link not found")
+    if share["max_downloads"] and download_count >= share["max_downloads"]:
         raise HTTPException(status_code=410, detail="Download limit reached")
 
     return {
@@ -813,10 +1152,10 @@ def get_shared_file_info(token: str):
     }
 
 
-@app.post("/share/{token}/download")
+@router.post("/share/{token}/download")
 async def download_shared_file(token: str, request: Request):
     """Download a shared file (no auth required)."""
-    share = get_share_link(token)
+    share = get_cached_share(token)
     if not share:
         raise HTTPException(status_code=404, detail="Share link not found")
 
@@ -826,10 +1165,6 @@ async def download_shared_file(token: str, request: Request):
         if datetime.fromisoformat(share["expires_at"]) < datetime.now():
             raise HTTPException(status_code=410, detail="Share link has expired")
 
-    # Check download limit
-    if share["max_downloads"] and share["download_count"] >= share["max_downloads"]:
-        raise HTTPException(status_code=410, detail="Download limit reached")
-
     # Verify password if set
     if share["has_password"]:
         data = await request.json()
@@ -837,19 +1172,90 @@ async def download_shared_file(token: str, request: Request):
         if not authentication(password, share["password_hash"]):
             raise HTTPException(status_code=401, detail="Invalid password")
 
-    # Count this download
-    increment_share_download(token)
+    # Count this download, the database decides whether the link is still
+    # there and under its limit
+    download_count = increment_share_download(token, share["owner"])
+    if download_count is None:
+        forget_share(token)
+        raise HTTPException(status_code=404, detail="Share link not found")
+    if not download_count:
+        raise HTTPException(status_code=410, detail="Download limit reached")
+
+    media_type = share["mime_type"] or "application/octet-stream"
+    if share["share_stored_path"] and storage.is_encrypted(share["stored_path"]):
+        return segmented_file_response(
+            storage.EncryptedFile(share["stored_path"]), share["filename"], media_type, request.headers.get("range")
+        )
 
-    return FileResponse(
-        path=share["stored_path"],
-        filename=share["filename"],
-        media_type=share["mime_type"] or "application/octet-stream",
+    # Files shared without a server copy, and copies made before encryption,
+    # which were never compressed
+    compression = storage.CODEC_NONE if share["share_stored_path"] else share["compression"]
+    return blob_response(
+        share["stored_path"], media_type, request.headers.get("range"),
+        filename=share["filename"], compression=compression,
     )
 
 
+# ============== Change Events ==============
+
+# Seconds between keep-alive comments on an idle event stream
+EVENT_KEEPALIVE_SECONDS = 15
+
+
+@router.get("/events")
+async def change_events(
+    request: Request,
+    token: Optional[str] = Query(None),
+    authorization: str = Header(default=None),
+):
+    """Stream the user's file, folder, share and usage changes as Server-Sent Events.
+
+    EventSource can't set headers, so the token may also be passed as ?token=.
+    """
+    if token:
+        authorization = f"Bearer {token}"
+    current_user = get_current_user(authorization)
+    subscription = events.subscribe(current_user)
+
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                event = await subscription.get(EVENT_KEEPALIVE_SECONDS)
+                if event is None:
+                    yield ": keep-alive\n\n"
+                else:
+                    yield events.format_sse(event)
+        finally:
+            events.unsubscribe(subscription)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# ============== Delta Sync ==============
+
+@router.get("/sync/changes")
+def sync_changes(
+    cursor: int = Query(0, ge=0),
+    limit: int = Query(1000, ge=1, le=5000),
+    current_user: str = Depends(get_current_user)
+):
+    """Get files and folders that changed since a cursor.
+
+    Start with cursor=0 for a full sync, then pass back the returned cursor.
+    Keep calling while has_more is true.
+    """
+    changes, next_cursor, has_more = get_changes(current_user, cursor, limit)
+    return {"changes": changes, "cursor": next_cursor, "has_more": has_more}
+
+
 # ============== Activity Log ==============
 
-@app.get("/activity")
+@router.get("/activity")
 def get_activity(
     limit: int = Query(50, ge=1, le=100),
     current_user: str = Depends(get_current_user)
@@ -859,13 +1265,27 @@ def get_activity(
     return {"activities": activities}
 
 
+@router.get("/activity/daily")
+def get_activity_daily(
+    days: int = Query(30, ge=1, le=366),
+    action: Optional[str] = Query(None),
+    current_user: str = Depends(get_current_user)
+):
+    """Get the user's event and byte counts per day and action, from the rollups."""
+    refresh_activity_rollups()
+    return {"days": get_activity_rollups(days, username=current_user, action=action)}
+
+
 # ============== Storage Stats ==============
 
-@app.get("/storage")
+@router.get("/storage")
 def get_storage_stats(current_user: str = Depends(get_current_user)):
     """Get storage usage statistics."""
-    used = get_storage_used(current_user)
-    file_count = get_file_count(current_user)
+    summary = get_cached_summary(current_user)
+    if not summary:
+        raise HTTPException(status_code=404, detail="User not found")
+    used = summary["storage_used"]
+    file_count = summary["file_count"]
     
     return {
         "used": used,
@@ -876,8 +1296,175 @@ def get_storage_stats(current_user: str = Depends(get_current_user)):
     }
 
 
+@router.get("/storage/breakdown")
+def get_storage_breakdown_stats(
+    top: int = Query(10, ge=0, le=100),
+    current_user: str = Depends(get_current_user)
+):
+    """Get storage used per file category, the space held in trash and the largest files."""
+    breakdown = get_storage_breakdown(current_user)
+    used = sum(c["bytes"] for c in breakdown["categories"])
+    return {
+        "used": used,
+        "limit": STORAGE_LIMIT,
+        "available": STORAGE_LIMIT - used,
+        "categories": breakdown["categories"],
+        "trash": breakdown["trash"],
+        "largest_files": get_largest_files(current_user, top) if top else [],
+    }
+
+
+# ============== Admin ==============
+
+@router.get("/admin/slow-queries")
+def list_slow_queries(
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    admin: str = Depends(get_admin_user)
+):
+    """Get the slowest SQL statements seen by this worker."""
+    return {
+        "threshold_ms": SLOW_QUERY_MS,
+        "queries": get_slow_queries(limit),
+    }
+
+
+@router.get("/admin/metrics")
+def get_metrics(admin: str = Depends(get_admin_user)):
+    """Get cache hit/miss counters for this worker."""
+    return {
+        "worker_pid": os.getpid(),
+        "caches": {
+            user_summary_cache.name: user_summary_cache.stats(),
+            share_cache.name: share_cache.stats(),
+            share_miss_cache.name: share_miss_cache.stats(),
+        },
+    }
+
+
+@router.post("/admin/share-copies/collect")
+def collect_share_copies_endpoint(admin: str = Depends(get_admin_user)):
+    """Delete share copies whose links are all gone, expired or used up."""
+    return {"removed": remove_share_copies()}
+
+
+@router.post("/admin/sync/compact")
+def compact_sync_journal(
+    older_than_days: Optional[int] = Query(None, ge=0),
+    admin: str = Depends(get_admin_user)
+):
+    """Fold old change journal entries into the sync snapshot."""
+    removed = compact_change_journal(older_than_days)
+    return {"removed": removed}
+
+
+@router.get("/admin/analytics/daily")
+def admin_activity_daily(
+    days: int = Query(30, ge=1, le=366),
+    username: Optional[str] = Query(None),
+    action: Optional[str] = Query(None),
+    admin: str = Depends(get_admin_user)
+):
+    """Event and byte counts per day, user and action, from the rollups."""
+    refresh_activity_rollups()
+    return {"days": get_activity_rollups(days, username=username, action=action)}
+
+
+@router.get("/admin/analytics/top-users")
+def admin_top_users(
+    days: int = Query(7, ge=1, le=366),
+    action: Optional[str] = Query(None),
+    by: str = Query("events", pattern="^(events|bytes)$"),
+    limit: int = Query(10, ge=1, le=100),
+    admin: str = Depends(get_admin_user)
+):
+    """Most active users over the last days, by event count or bytes."""
+    refresh_activity_rollups()
+    return {"users": get_top_active_users(days, action=action, by=by, limit=limit)}
+
+
+@router.post("/admin/activity/archive")
+def archive_activity_log(
+    retention_months: Optional[int] = Query(None, ge=1),
+    admin: str = Depends(get_admin_user)
+):
+    """Export activity months past the retention period to gzip files and drop them."""
+    archived = archive_activity(retention_months)
+    return {"archived": archived}
+
+
+# ============== App ==============
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Get a worker ready before it takes requests."""
+    STORAGE_ROOT.mkdir(parents=True, exist_ok=True)
+    # One PRAGMA when the schema is current, which is every start but the
+    # first after an upgrade. Also leaves a keyed read connection in the pool.
+    check_schema()
+    # Refuse to start without STORAGE_KEY in production, not at the first share
+    storage.storage_key()
+    sweeper = asyncio.create_task(sweep_share_copies()) if SHARE_COPY_COLLECT_SECONDS > 0 else None
+    yield
+    if sweeper:
+        sweeper.cancel()
+
+
+async def user_moving_handler(request: Request, exc: UserMoving):
+    """A user's writes wait while shards.py moves them, ask the client to retry."""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Your files are being moved, try again in a moment"},
+        headers={"Retry-After": "5"},
+    )
+
+
+"""
+This meets Functional Requirement #1:
+FR-1: The user SHALL be able to access the web app from their browser of choice by entering in a URL.
+
+The FastAPI server hosts all endpoints that the frontend uses.
+"""
+def create_app():
+    """Build the FastAPI app. Nothing touches the database until it starts up."""
+    app = FastAPI(title="GuardCloud API", version="1.0.0", lifespan=lifespan)
+
+    # Check uploads against the storage limit before reading their body. Added
+    # before CORS so CORS wraps it and its errors still reach the browser.
+    app.add_middleware(
+        UploadAdmission,
+        paths=["/files/upload"],
+        storage_limit=STORAGE_LIMIT,
+        max_upload_size=MAX_UPLOAD_SIZE,
+    )
+
+    # Allow cross-origin requests from the frontend
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    app.add_exception_handler(UserMoving, user_moving_handler)
+    app.include_router(router)
+    return app
+
+
+app = create_app()
+
+
 # Start the server
+# SERVER_MODE=production runs WORKERS processes without the auto-reloader.
+# The database is in WAL mode, so the workers can read while one of them writes.
 if __name__ == "__main__":
+    import uvicorn
+
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", "8000"))
-    uvicorn.run("server:app", host=host, port=port, reload=True)
+
+    if os.getenv("SERVER_MODE", "development") == "production":
+        workers = int(os.getenv("WORKERS", str(os.cpu_count() or 1)))
+        uvicorn.run("server:app", host=host, port=port, workers=workers, proxy_headers=True)
+    else:
+        uvicorn.run("server:app", host=host, port=port, reload=True)
@@ -0,0 +1,154 @@
+# GuardCloud Shards
+# Shows how users are spread over the database shards and moves them
+# between shards while the server runs, see Sharding in database.py
+#
+#   cd backend
+#   python shards.py status
+#   python shards.py move alice 2
+#   python shards.py rebalance --by events --dry-run
+#   python shards.py sweep
+#
+# rebalance evens out the shards by moving users from the most loaded shard
+# to the least loaded one, one at a time, until they are within --tolerance
+# of each other. Load is what the users store (bytes or files) or how much
+# they did lately (events), which is closer to how often they write.
+#
+# A user's writes are refused with 503 while they are moved, for a few
+# seconds plus the time to copy their rows. Run one of these at a time.
+
+import argparse
+import os
+import sys
+
+import config
+from database import (
+    DB_SHARDS,
+    check_schema,
+    all_shards,
+    shard_file,
+    get_user_shards,
+    get_shard_usage,
+    get_activity_rollups,
+    rollup_activity,
+    move_user,
+    sweep_shards,
+)
+
+
+def user_loads(by="bytes", days=30):
+    """Every user's shard and load, {username: (shard, load)}."""
+    shards = get_user_shards()
+    loads = {}
+    if by == "events":
+        rollup_activity()
+        for row in get_activity_rollups(days):
+            loads[row["username"]] = loads.get(row["username"], 0) + row["events"]
+    else:
+        for shard in all_shards():
+            for username, (size, files) in get_shard_usage(shard).items():
+                if shards.get(username, 0) == shard:
+                    loads[username] = size if by == "bytes" else files
+    return {username: (shard, loads.get(username, 0)) for username, shard in shards.items()}
+
+
+def plan_rebalance(users, shards, tolerance=0.1, max_moves=None):
+    """Moves that even out the load of shards. Returns [(username, from, to)].
+
+    users is {username: (shard, load)}. Each step moves the user from the
+    most loaded shard whose load is closest to half the gap to the least
+    loaded shard, which narrows the gap the most.
+    """
+    users = dict(users)
+    load = {shard: 0 for shard in shards}
+    for shard, weight in users.values():
+        load[shard] = load.get(shard, 0) + weight
+    average = sum(load.values()) / len(shards)
+
+    moves = []
+    while max_moves is None or len(moves) < max_moves:
+        heavy = max(load, key=load.get)
+        light = min(shards, key=load.get)
+        gap = load[heavy] - load[light]
+        if gap <= tolerance * average:
+            break
+        candidates = [
+            (username, weight) for username, (shard, weight) in users.items()
+            if shard == heavy and 0 < weight < gap
+        ]
+        if not candidates:
+            break
+        username, weight = min(candidates, key=lambda c: abs(c[1] - gap / 2))
+        moves.append((username, heavy, light))
+        users[username] = (light, weight)
+        load[heavy] -= weight
+        load[light] += weight
+    return moves
+
+
+def database_size(path):
+    """Bytes of a database file and its WAL."""
+    return sum(os.path.getsize(p) for p in (path, f"{path}-wal") if os.path.exists(p))
+
+
+def print_status(by):
+    users = user_loads(by)
+    for shard in all_shards():
+        on_shard = [load for number, load in users.values() if number == shard]
+        print(
+            f"shard {shard}: {len(on_shard)} users, {by} {sum(on_shard)}, "
+            f"{database_size(shard_file(shard))} bytes on disk ({shard_file(shard)})"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect and rebalance database shards.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    status = commands.add_parser("status", help="users and load per shard")
+    status.add_argument("--by", choices=("bytes", "files", "events"), default="bytes")
+
+    move = commands.add_parser("move", help="move one user to a shard")
+    move.add_argument("username")
+    move.add_argument("shard", type=int)
+
+    rebalance = commands.add_parser("rebalance", help="move users until the shards are even")
+    rebalance.add_argument("--by", choices=("bytes", "files", "events"), default="bytes")
+    rebalance.add_argument("--days", type=int, default=30, help="days of activity for --by events")
+    rebalance.add_argument("--tolerance", type=float, default=0.1, help="allowed gap, as a share of the average")
+    rebalance.add_argument("--max-moves", type=int, help="stop after this many moves")
+    rebalance.add_argument("--dry-run", action="store_true", help="only print the moves")
+
+    commands.add_parser("sweep", help="delete rows left behind by moves that didn't finish")
+
+    args = parser.parse_args(argv)
+    log = lambda message: print(message, file=sys.stderr)
+
+    check_schema()
+    try:
+        if args.command == "status":
+            print_status(args.by)
+        elif args.command == "move":
+            if args.shard >= DB_SHARDS:
+                raise ValueError(f"Shard {args.shard} is past DB_SHARDS ({DB_SHARDS})")
+            move_user(args.username, args.shard, progress=log)
+        elif args.command == "rebalance":
+            if DB_SHARDS <= 1:
+                raise ValueError("Sharding is off, set DB_SHARDS")
+            users = user_loads(args.by, args.days)
+            moves = plan_rebalance(users, list(range(DB_SHARDS)), args.tolerance, args.max_moves)
+            for username, source, target in moves:
+                print(f"{username}: shard {source} -> {target} ({args.by} {users[username][1]})")
+                if not args.dry_run:
+                    move_user(username, target, progress=log)
+            if not moves:
+                print("Shards are already even")
+        else:
+            swept = sweep_shards(progress=log)
+            print(f"Removed leftover rows of {len(swept)} users")
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+# GuardCloud Storage
+# Blob formats used under STORAGE_ROOT: at-rest encryption for the decrypted
+# share copies the server keeps, and optional compression of uploads.
+#
+# Share copies are written in a chunked AEAD format so a download or Range
+# request only decrypts the segments it touches, with bounded memory:
+#
+#   header:   b"GCS1" | segment size (4 bytes) | salt (16 bytes) | nonce prefix (7 bytes)
+#   segments: AES-256-GCM(segment plaintext) + 16 byte tag, one per segment
+#
+# Every file is encrypted with its own key, derived with HKDF from the storage
+# key and the random salt, so nonces never have to be unique across files.
+# Each segment's nonce is the prefix, its index (4 bytes) and a flag byte
+# that is 1 only on the last segment, so segments can't be reordered,
+# swapped between files or cut off the end without failing authentication.
+# The header is authenticated as associated data of every segment.
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from collections import Counter
+import math
+import os
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional, zlib is used without it
+    zstandard = None
+
+import config
+
+MAGIC = b"GCS1"
+HEADER = struct.Struct(">4sI16s7s")
+TAG_SIZE = 16
+
+# Plaintext bytes per segment, the most a range read decrypts beyond what it needs
+STORAGE_SEGMENT_SIZE = int(os.getenv("STORAGE_SEGMENT_SIZE", str(64 * 1024)))
+
+_key = None
+
+
+def storage_key():
+    """The key share copies are encrypted with.
+
+    STORAGE_KEY (64 hex chars) if set, otherwise derived from SECRET_KEY,
+    which ties share copies to the JWT secret: rotating it makes every
+    existing copy unreadable. So production servers have to set STORAGE_KEY.
+    """
+    global _key
+    if _key is None:
+        configured = os.getenv("STORAGE_KEY")
+        if configured:
+            _key = bytes.fromhex(configured)
+        else:
+            if os.getenv("SERVER_MODE", "development") == "production":
+                raise RuntimeError("Missing STORAGE_KEY environment variable, required with SERVER_MODE=production")
+            secret = os.getenv("SECRET_KEY")
+            if not secret:
+                raise RuntimeError("Missing STORAGE_KEY or SECRET_KEY environment variable")
+            _key = HKDF(
+                algorithm=hashes.SHA256(),
+                length=32,
+                salt=None,
+                info=b"guardcloud share copies",
+            ).derive(secret.encode("utf-8"))
+    return _key
+
+
+def _file_key(salt):
+    """The key of one encrypted file, from the storage key and the file's salt."""
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        info=b"guardcloud share copy",
+    ).derive(storage_key())
+
+
+def _nonce(prefix, index, last):
+    return prefix + struct.pack(">IB", index, 1 if last else 0)
+
+
+def write_encrypted(path, source, segment_size=None, hasher=None):
+    """Encrypt everything read from the file object `source` into `path`.
+
+    Reads one segment at a time. If a hashlib object is given as hasher it
+    is fed the plaintext along the way. Returns the plaintext size.
+    """
+    segment_size = segment_size or STORAGE_SEGMENT_SIZE
+    salt = os.urandom(16)
+    prefix = os.urandom(7)
+    aead = AESGCM(_file_key(salt))
+    header = HEADER.pack(MAGIC, segment_size, salt, prefix)
+    size = 0
+
+    with open(path, "wb") as out:
+        out.write(header)
+        index = 0
+        segment = source.read(segment_size)
+        while True:
+            # Read ahead one segment to know whether this one is the last
+            following = source.read(segment_size) if len(segment) == segment_size else b""
+            last = not following
+            if hasher:
+                hasher.update(segment)
+            out.write(aead.encrypt(_nonce(prefix, index, last), segment, header))
+            size += len(segment)
+            if last:
+                return size
+            segment = following
+            index += 1
+
+
+def is_encrypted(path):
+    """Check if a file is in the encrypted storage format."""
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class EncryptedFile:
+    """Random access reads from a file written by write_encrypted."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.header = f.read(HEADER.size)
+        if len(self.header) < HEADER.size:
+            raise ValueError(f"{path} is not an encrypted storage file")
+        magic, self.segment_size, self.salt, self.prefix = HEADER.unpack(self.header)
+        if magic != MAGIC or self.segment_size <= 0:
+            raise ValueError(f"{path} is not an encrypted storage file")
+
+        stored = os.path.getsize(path) - HEADER.size
+        full = self.segment_size + TAG_SIZE
+        # An empty file still has one (empty) segment
+        self.segments = max(1, -(-stored // full))
+        self.size = stored - self.segments * TAG_SIZE
+        if self.size < 0 or 0 < stored % full < TAG_SIZE:
+            raise ValueError(f"{path} is truncated")
+
+    def read_range(self, start=0, end=None):
+        """Yield the plaintext bytes start..end (inclusive), one segment at a time."""
+        if end is None or end >= self.size:
+            end = self.size - 1
+        if self.size == 0 or start > end:
+            return
+
+        aead = AESGCM(_file_key(self.salt))
+        full = self.segment_size + TAG_SIZE
+        first = start // self.segment_size
+        last = end // self.segment_size
+
+        with open(self.path, "rb") as f:
+            f.seek(HEADER.size + first * full)
+            for index in range(first, last + 1):
+                nonce = _nonce(self.prefix, index, index == self.segments - 1)
+                plain = aead.decrypt(nonce, f.read(full), self.header)
+                offset = index * self.segment_size
+                yield plain[max(start - offset, 0):end - offset + 1]
+
+
+# ============== Compression ==============
+#
+# With STORAGE_COMPRESSION on, uploads are compressed one segment at a time
+# while they stream to disk, so Range reads can still jump to any segment:
+#
+#   header:   b"GCZ1" | segment size (4 bytes) | codec (1 byte)
+#   segments: each compressed on its own (or stored raw if that's smaller)
+#   index:    stored length of every segment (4 bytes each, top bit = raw)
+#   footer:   plaintext size (8 bytes) | segment count (4 bytes) | b"GCZ1"
+#
+# Client-side encrypted uploads and anything that looks incompressible are
+# stored as-is, in which case the file on disk is exactly the upload. Which
+# one it is goes in files.compression: the codec, or CODEC_NONE. Stored
+# uploads are the users' own bytes, so a header only counts when the row
+# says the blob was compressed.
+
+COMPRESSED_MAGIC = b"GCZ1"
+COMPRESSED_HEADER = struct.Struct(">4sIB")
+COMPRESSED_FOOTER = struct.Struct(">QI4s")
+RAW_SEGMENT = 1 << 31
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+# off, zlib, zstd, or auto (zstd if the zstandard package is installed, else zlib)
+STORAGE_COMPRESSION = os.getenv("STORAGE_COMPRESSION", "off").lower()
+
+# Codec level, defaults to a fast setting for each codec
+STORAGE_COMPRESSION_LEVEL = os.getenv("STORAGE_COMPRESSION_LEVEL")
+
+# Uploads whose first segment has more entropy than this (bits per byte) are
+# almost certainly compressed or encrypted already
+MAX_ENTROPY = 7.5
+
+# Store as-is unless the first segment shrinks by at least this much
+MIN_SAVINGS = 0.1
+
+
+def compression_codec():
+    """The codec new uploads are compressed with, or None when compression is off."""
+    if STORAGE_COMPRESSION in ("", "off", "none"):
+        return None
+    if STORAGE_COMPRESSION == "zstd" or (STORAGE_COMPRESSION == "auto" and zstandard):
+        if not zstandard:
+            raise RuntimeError("STORAGE_COMPRESSION=zstd needs the zstandard package")
+        return CODEC_ZSTD
+    return CODEC_ZLIB
+
+
+def _compressor(codec):
+    if codec == CODEC_ZSTD:
+        level = int(STORAGE_COMPRESSION_LEVEL or 3)
+        return zstandard.ZstdCompressor(level=level).compress
+    level = int(STORAGE_COMPRESSION_LEVEL or 6)
+    return lambda data: zlib.compress(data, level)
+
+
+def _decompressor(codec):
+    """A function decompressing one segment into at most `limit` bytes."""
+    if codec == CODEC_ZSTD:
+        if not zstandard:
+            raise RuntimeError("Reading zstd compressed blobs needs the zstandard package")
+        decompressor = zstandard.ZstdDecompressor()
+
+        def decompress(data, limit):
+            with decompressor.stream_reader(data) as reader:
+                return reader.read(limit)
+        return decompress
+    return lambda data, limit: zlib.decompressobj().decompress(data, limit)
+
+
+def entropy(data):
+    """Shannon entropy of a byte string in bits per byte."""
+    if not data:
+        return 0.0
+    total = len(data)
+    return -sum(n / total * math.log2(n / total) for n in Counter(data).values())
+
+
+def _worth_compressing(sample, compress):
+    if not sample or entropy(sample) > MAX_ENTROPY:
+        return False
+    return len(compress(sample)) <= len(sample) * (1 - MIN_SAVINGS)
+
+
+def write_blob(path, source, compress=True, segment_size=None):
+    """Store everything read from the file object `source` at `path`.
+
+    Compressed segment by segment when compression is on, compress is True
+    and the start of the data compresses well. Returns (size, stored_size,
+    codec): the bytes read, the bytes written to disk and the codec, or
+    CODEC_NONE when stored as-is. Keep the codec with the row.
+    """
+    segment_size = segment_size or STORAGE_SEGMENT_SIZE
+    codec = compression_codec() if compress else None
+    compress_segment = _compressor(codec) if codec else None
+    segment = source.read(segment_size)
+    if codec and not _worth_compressing(segment, compress_segment):
+        codec = None
+
+    size = 0
+    with open(path, "wb") as out:
+        if codec is None:
+            while segment:
+                out.write(segment)
+                size += len(segment)
+                segment = source.read(segment_size)
+            return size, size, CODEC_NONE
+
+        out.write(COMPRESSED_HEADER.pack(COMPRESSED_MAGIC, segment_size, codec))
+        lengths = []
+        while segment:
+            packed = compress_segment(segment)
+            if len(packed) < len(segment):
+                lengths.append(len(packed))
+            else:
+                packed = segment
+                lengths.append(len(segment) | RAW_SEGMENT)
+            out.write(packed)
+            size += len(segment)
+            segment = source.read(segment_size)
+        out.write(struct.pack(f">{len(lengths)}I", *lengths))
+        out.write(COMPRESSED_FOOTER.pack(size, len(lengths), COMPRESSED_MAGIC))
+        return size, out.tell(), codec
+
+
+class CompressedFile:
+    """Random access reads from a file written compressed by write_blob."""
+
+    def __init__(self, path):
+        self.path = path
+        stored = os.path.getsize(path)
+        with open(path, "rb") as f:
+            magic, self.segment_size, self.codec = COMPRESSED_HEADER.unpack(f.read(COMPRESSED_HEADER.size))
+            f.seek(stored - COMPRESSED_FOOTER.size)
+            self.size, count, trailer = COMPRESSED_FOOTER.unpack(f.read(COMPRESSED_FOOTER.size))
+            if magic != COMPRESSED_MAGIC or trailer != COMPRESSED_MAGIC:
+                raise ValueError(f"{path} is not a compressed storage file")
+            if self.codec not in (CODEC_ZLIB, CODEC_ZSTD) or self.segment_size <= 0:
+                raise ValueError(f"{path} has an unknown codec or segment size")
+            # Every segment but the last is full
+            if count != -(-self.size // self.segment_size):
+                raise ValueError(f"{path} says {self.size} bytes in {count} segments")
+            f.seek(stored - COMPRESSED_FOOTER.size - count * 4)
+            lengths = struct.unpack(f">{count}I", f.read(count * 4))
+
+        # Where each segment starts on disk, and whether it's stored raw
+        self.segments = []
+        offset = COMPRESSED_HEADER.size
+        for length in lengths:
+            self.segments.append((offset, length & ~RAW_SEGMENT, bool(length & RAW_SEGMENT)))
+            offset += length & ~RAW_SEGMENT
+        if offset + count * 4 + COMPRESSED_FOOTER.size != stored:
+            raise ValueError(f"{path} is not a compressed storage file")
+
+    def read_range(self, start=0, end=None):
+        """Yield the original bytes start..end (inclusive), one segment at a time."""
+        if end is None or end >= self.size:
+            end = self.size - 1
+        if self.size == 0 or start > end:
+            return
+
+        decompress = _decompressor(self.codec)
+        first = start // self.segment_size
+        last = end // self.segment_size
+        with open(self.path, "rb") as f:
+            for index in range(first, last + 1):
+                offset, length, raw = self.segments[index]
+                base = index * self.segment_size
+                expected = min(self.segment_size, self.size - base)
+                f.seek(offset)
+                data = f.read(length)
+                # One byte over is enough to tell a segment is too long, never inflate more
+                plain = data if raw else decompress(data, expected + 1)
+                if len(plain) != expected:
+                    raise ValueError(f"{self.path}: segment {index} holds {len(plain)} bytes, not {expected}")
+                yield plain[max(start - base, 0):end - base + 1]
+
+
+def open_compressed(path, compression):
+    """Get a CompressedFile for path, or None if its row says it is stored as-is."""
+    if not compression:
+        return None
+    compressed = CompressedFile(path)
+    if compressed.codec != compression:
+        raise ValueError(f"{path} is compressed with codec {compressed.codec}, not {compression}")
+    return compressed
+
+
+def detect_compression(path):
+    """Codec of a blob going by its header. Only for blobs stored before files.compression."""
+    try:
+        with open(path, "rb") as f:
+            if f.read(len(COMPRESSED_MAGIC)) != COMPRESSED_MAGIC:
+                return CODEC_NONE
+        return CompressedFile(path).codec
+    except (OSError, ValueError, struct.error):
+        # Gone, or an upload that happens to start with the magic bytes
+        return CODEC_NONE
+
+
+def read_blob(path, start=0, end=None, chunk_size=64 * 1024, compression=CODEC_NONE):
+    """Yield the original bytes start..end (inclusive) of a stored upload.
+
+    compression is the codec from the file's row.
+    """
+    compressed = open_compressed(path, compression)
+    if compressed:
+        yield from compressed.read_range(start, end)
+        return
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = None if end is None else end - start + 1
+        while remaining is None or remaining > 0:
+            chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                return
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+
+def blob_size(path, compression=CODEC_NONE):
+    """Size of the original data of a stored upload, compressed or not."""
+    compressed = open_compressed(path, compression)
+    return compressed.size if compressed else os.path.getsize(path)
@@ -0,0 +1,114 @@
+import io
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from cryptography.exceptions import InvalidTag
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import storage
+
+SEGMENT = 64
+FULL = SEGMENT + storage.TAG_SIZE
+
+
+@pytest.fixture(autouse=True)
+def key(monkeypatch):
+    monkeypatch.setenv("STORAGE_KEY", "11" * 32)
+    monkeypatch.setattr(storage, "_key", None)
+
+
+def encrypt(tmp_path, data, name="copy"):
+    path = tmp_path / name
+    assert storage.write_encrypted(str(path), io.BytesIO(data), SEGMENT) == len(data)
+    return path
+
+
+def read(path, start=0, end=None):
+    return b"".join(storage.EncryptedFile(str(path)).read_range(start, end))
+
+
+@pytest.mark.parametrize("size", [0, 1, SEGMENT - 1, SEGMENT, SEGMENT + 1, 5 * SEGMENT, 5 * SEGMENT + 7])
+def test_round_trip(tmp_path, size):
+    data = os.urandom(size)
+    path = encrypt(tmp_path, data)
+    assert storage.is_encrypted(str(path))
+    assert storage.EncryptedFile(str(path)).size == size
+    assert read(path) == data
+
+
+def test_range_reads_across_segments(tmp_path):
+    data = os.urandom(5 * SEGMENT + 7)
+    path = encrypt(tmp_path, data)
+    for start, end in [(0, 0), (SEGMENT - 1, SEGMENT), (SEGMENT - 3, 3 * SEGMENT + 2), (2 * SEGMENT, 3 * SEGMENT - 1), (4 * SEGMENT + 5, len(data) + 100)]:
+        assert read(path, start, end) == data[start:end + 1]
+
+
+def test_files_get_their_own_salt_and_key(tmp_path):
+    data = b"x" * (2 * SEGMENT)
+    a, b = encrypt(tmp_path, data, "a"), encrypt(tmp_path, data, "b")
+    assert storage.EncryptedFile(str(a)).salt != storage.EncryptedFile(str(b)).salt
+    assert a.read_bytes()[storage.HEADER.size:] != b.read_bytes()[storage.HEADER.size:]
+
+
+@pytest.mark.parametrize("cut", [1, storage.TAG_SIZE, 7 + storage.TAG_SIZE, 7 + storage.TAG_SIZE + FULL, FULL + 3])
+def test_truncation_fails(tmp_path, cut):
+    path = encrypt(tmp_path, os.urandom(3 * SEGMENT + 7))
+    path.write_bytes(path.read_bytes()[:-cut])
+    with pytest.raises((InvalidTag, ValueError)):
+        read(path)
+
+
+def test_truncated_to_header_fails(tmp_path):
+    path = encrypt(tmp_path, os.urandom(SEGMENT))
+    path.write_bytes(path.read_bytes()[:storage.HEADER.size + 5])
+    with pytest.raises(ValueError):
+        read(path)
+
+
+def test_swapped_segments_fail(tmp_path):
+    path = encrypt(tmp_path, os.urandom(3 * SEGMENT))
+    raw = path.read_bytes()
+    h = storage.HEADER.size
+    path.write_bytes(raw[:h] + raw[h + FULL:h + 2 * FULL] + raw[h:h + FULL] + raw[h + 2 * FULL:])
+    with pytest.raises(InvalidTag):
+        read(path, 0, SEGMENT - 1)
+
+
+def test_segment_from_another_file_fails(tmp_path):
+    data = os.urandom(2 * SEGMENT)
+    a, b = encrypt(tmp_path, data, "a"), encrypt(tmp_path, data, "b")
+    h = storage.HEADER.size
+    a.write_bytes(a.read_bytes()[:h] + b.read_bytes()[h:h + FULL] + a.read_bytes()[h + FULL:])
+    with pytest.raises(InvalidTag):
+        read(a)
+
+
+@pytest.mark.parametrize("offset", [4 + 4, 4 + 4 + 16])  # first byte of the salt, of the nonce prefix
+def test_modified_header_fails(tmp_path, offset):
+    path = encrypt(tmp_path, os.urandom(SEGMENT + 1))
+    raw = bytearray(path.read_bytes())
+    raw[offset] ^= 1
+    path.write_bytes(bytes(raw))
+    with pytest.raises(InvalidTag):
+        read(path)
+
+
+def test_wrong_key_fails(tmp_path, monkeypatch):
+    path = encrypt(tmp_path, os.urandom(SEGMENT))
+    monkeypatch.setenv("STORAGE_KEY", "22" * 32)
+    monkeypatch.setattr(storage, "_key", None)
+    with pytest.raises(InvalidTag):
+        read(path)
+
+
+def test_production_needs_storage_key(monkeypatch):
+    monkeypatch.delenv("STORAGE_KEY")
+    monkeypatch.setenv("SECRET_KEY", "secret")
+    monkeypatch.setenv("SERVER_MODE", "production")
+    with pytest.raises(RuntimeError):
+        storage.storage_key()
+    monkeypatch.setenv("SERVER_MODE", "development")
+    assert len(storage.storage_key()) == 32
@@ -251,6 +251,13 @@ export function useAuth() {
    * Logs out the user and clears all session data
    */
   function logout() {
+    // Revoke the token on the server too, local cleanup doesn't wait for it
+    if (token.value) {
+      apiClient
+        .post('/auth/logout', null, { headers: { Authorization: `Bearer ${token.value}` } })
+        .catch(() => {})
+    }
+
     token.value = null
     user.value = null
     cryptoInitialized.value = false
@@ -324,10 +331,16 @@ export function useAuth() {
     }
 
     try {
-      await apiClient.put('/auth/password', {
+      const res = await apiClient.put('/auth/password', {
         current_password: currentPassword,
         new_password: newPassword,
       })
+
+      // Older tokens are revoked, keep this session going with the new one
+      if (res.data?.token) {
+        token.value = res.data.token
+        localStorage.setItem('gc_token', res.data.token)
+      }
       
       // Update encryption with new password
       await initializeCrypto(newPassword)
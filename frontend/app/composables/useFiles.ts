@@ -23,6 +23,8 @@ interface FolderItem {
   name: string
   parent_id?: number
   created_at: string
+  subtree_bytes?: number
+  subtree_files?: number
 }
 
 interface PathItem {
@@ -74,6 +76,10 @@ const CACHE_DURATION = 30000
 let lastFetch = 0
 let lastFolderKey = ''
 
+// Live change feed from the server (Server-Sent Events)
+let eventSource: EventSource | null = null
+let storageRefreshTimer: ReturnType<typeof setTimeout> | null = null
+
 /**
  * Pack encrypted data with its metadata for storage
  * Format: [4 bytes length][metadata JSON][encrypted data]
@@ -268,10 +274,14 @@ export function useFiles() {
       
       uploadProgress.value = 40
 
-      // Upload to server
+      // Upload to server. X-Upload-Size lets the server refuse a file that
+      // won't fit before we send it.
       await apiClient.post('/files/upload', formData, {
         params,
-        headers: { 'Content-Type': 'multipart/form-data' },
+        headers: {
+          'Content-Type': 'multipart/form-data',
+          'X-Upload-Size': String(encryptedBlob.size)
+        },
         onUploadProgress: (e) => {
           if (e.total) {
             const percent = 40 + Math.round((e.loaded / e.total) * 60)
@@ -290,7 +300,7 @@ export function useFiles() {
       return true
     } catch (err: any) {
       if (err.response?.status === 413) {
-        error.value = 'Storage limit exceeded'
+        error.value = err.response?.data?.detail || 'Storage limit exceeded'
       } else if (err.name === 'OperationError') {
         error.value = 'Encryption failed. Please try again.'
       } else {
@@ -626,24 +636,43 @@ export function useFiles() {
         return null
       }
 
-      const formData = new FormData()
-      
       // Upload decrypted version for sharing
+      let blob: Blob | null = null
+      let contentHash: string | null = null
       if (isEncryptionReady()) {
         const decrypted = await getDecryptedFileData(file)
         if (decrypted) {
-          const blob = new Blob([decrypted.data], { type: decrypted.mimeType })
-          formData.append('file', blob, file.filename)
+          blob = new Blob([decrypted.data], { type: decrypted.mimeType })
+          const digest = await crypto.subtle.digest('SHA-256', decrypted.data)
+          contentHash = Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('')
         }
       }
-      
-      if (options.password) formData.append('password', options.password)
-      if (options.expires_in_days) formData.append('expires_in_days', String(options.expires_in_days))
-      if (options.max_downloads) formData.append('max_downloads', String(options.max_downloads))
 
-      const res = await apiClient.post(`/files/${fileId}/share`, formData, {
+      const buildForm = (withFile: boolean) => {
+        const formData = new FormData()
+        if (withFile && blob) formData.append('file', blob, file.filename)
+        if (contentHash) formData.append('content_hash', contentHash)
+        if (options.password) formData.append('password', options.password)
+        if (options.expires_in_days) formData.append('expires_in_days', String(options.expires_in_days))
+        if (options.max_downloads) formData.append('max_downloads', String(options.max_downloads))
+        return formData
+      }
+      const post = (withFile: boolean) => apiClient.post(`/files/${fileId}/share`, buildForm(withFile), {
         headers: { 'Content-Type': 'multipart/form-data' }
       })
+
+      // The server keeps one copy per file content, only upload it if it doesn't have it yet
+      let res
+      if (contentHash) {
+        try {
+          res = await post(false)
+        } catch (err: any) {
+          if (err.response?.status !== 409) throw err
+          res = await post(true)
+        }
+      } else {
+        res = await post(true)
+      }
       
       return res.data
     } catch (err: any) {
@@ -704,6 +733,76 @@ export function useFiles() {
     error.value = null
   }
 
+  /**
+   * Listen for changes pushed by the server (from this or any other tab or device)
+   * and apply them to the current view instead of refetching the whole folder
+   */
+  function watchChanges() {
+    if (!process.client || eventSource) return
+    const token = localStorage.getItem('gc_token')
+    if (!token) return
+
+    eventSource = new EventSource(`${apiClient.defaults.baseURL}/events?token=${encodeURIComponent(token)}`)
+
+    const on = (type: string, handler: (data: any) => void) => {
+      eventSource?.addEventListener(type, (e) => handler(JSON.parse((e as MessageEvent).data).data))
+    }
+    const inCurrentFolder = (folderId?: number | null) => (folderId ?? null) === currentFolderId.value
+    const refresh = () => fetchFiles(currentFolderId.value, true)
+
+    on('file.created', (data) => {
+      if (!inCurrentFolder(data.folder_id) || files.value.some(f => f.id === data.id)) return
+      files.value = [{ ...data, created_at: new Date().toISOString() }, ...files.value]
+    })
+    on('file.updated', (data) => {
+      files.value = files.value.map(f => (f.id === data.id ? { ...f, ...data } : f))
+    })
+    on('file.moved', (data) => {
+      if (inCurrentFolder(data.folder_id)) {
+        refresh()
+      } else {
+        files.value = files.value.filter(f => f.id !== data.id)
+      }
+    })
+    on('file.trashed', (data) => {
+      files.value = files.value.filter(f => f.id !== data.id)
+    })
+    on('file.deleted', (data) => {
+      files.value = files.value.filter(f => f.id !== data.id)
+    })
+    on('folder.created', (data) => {
+      if (!inCurrentFolder(data.parent_id) || folders.value.some(f => f.id === data.id)) return
+      folders.value = [...folders.value, { ...data, created_at: new Date().toISOString() }]
+        .sort((a, b) => a.name.localeCompare(b.name))
+    })
+    on('folder.updated', (data) => {
+      folders.value = folders.value.map(f => (f.id === data.id ? { ...f, ...data } : f))
+      path.value = path.value.map(p => (p.id === data.id ? { ...p, name: data.name } : p))
+    })
+    on('folder.trashed', (data) => {
+      folders.value = folders.value.filter(f => f.id !== data.id)
+    })
+    on('folder.deleted', (data) => {
+      folders.value = folders.value.filter(f => f.id !== data.id)
+    })
+    // We don't get the full row back for a restored file, so reload the folder
+    on('file.restored', refresh)
+    on('resync', refresh)
+
+    // Several changes usually arrive together, only refetch usage once
+    on('usage.changed', () => {
+      if (storageRefreshTimer) clearTimeout(storageRefreshTimer)
+      storageRefreshTimer = setTimeout(fetchStorageStats, 1000)
+    })
+  }
+
+  function stopWatchingChanges() {
+    eventSource?.close()
+    eventSource = null
+    if (storageRefreshTimer) clearTimeout(storageRefreshTimer)
+    storageRefreshTimer = null
+  }
+
   function clearCache() {
     lastFetch = 0
     lastFolderKey = ''
@@ -753,5 +852,7 @@ export function useFiles() {
     fetchStorageStats,
     clearError,
     clearCache,
+    watchChanges,
+    stopWatchingChanges,
   }
 }